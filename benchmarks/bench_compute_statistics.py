@@ -0,0 +1,124 @@
+"""
+Peak memory and runtime of `MultiVariateICLTrainer.compute_statistics` against
+the former implementation (deep copy of the PDFs and one `compute_stats` call per
+timestep), on the context sizes used by the SAC-DICL loop.
+
+Each implementation runs in its own process so that the peak resident set sizes
+(`ru_maxrss`) do not interfere.
+
+Usage:
+    python benchmarks/bench_compute_statistics.py --context-length 300 --n-features 17
+"""
+
+import argparse
+import copy
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from dicl.icl.iclearner import MultiVariateICLTrainer
+from dicl.utils.icl import MultiResolutionPDF, PDF_list_from_probs
+
+
+def compute_statistics_loop(trainer):
+    """Former implementation of compute_statistics."""
+    for dim in range(trainer.n_features):
+        PDF_list = trainer.icl_object[dim].PDF_list
+
+        PDF_true_list = copy.deepcopy(PDF_list)
+
+        mean_arr = []
+        mode_arr = []
+        sigma_arr = []
+        for PDF, PDF_true in zip(PDF_list, PDF_true_list):
+            PDF.compute_stats()
+            mean_arr.append(PDF.mean)
+            mode_arr.append(PDF.mode)
+            sigma_arr.append(PDF.sigma)
+
+        trainer.icl_object[dim].mean_arr = np.array(mean_arr)
+        trainer.icl_object[dim].mode_arr = np.array(mode_arr)
+        trainer.icl_object[dim].sigma_arr = np.array(sigma_arr)
+    return trainer.icl_object
+
+
+def make_trainer(context_length, n_features, legacy):
+    """Trainer holding random PDFs, as a list of PDFs if legacy else a PDFBatch."""
+    rng = np.random.default_rng(0)
+    trainer = MultiVariateICLTrainer(model=None, tokenizer=None, n_features=n_features)
+    for dim in range(n_features):
+        logits = rng.normal(size=(context_length, 1000)).astype(np.float32)
+        probs = np.exp(logits) / np.exp(logits).sum(axis=1, keepdims=True)
+        if legacy:
+            # one object and one set of bin arrays per timestep
+            PDF_list = []
+            for height_arr in probs * 100:
+                PDF = MultiResolutionPDF()
+                PDF.bin_center_arr = np.arange(0, 1000) / 100
+                PDF.bin_width_arr = np.array(1000 * [0.01])
+                PDF.bin_height_arr = height_arr
+                PDF_list.append(PDF)
+        else:
+            PDF_list = PDF_list_from_probs(probs)
+        trainer.icl_object[dim].PDF_list = PDF_list
+    return trainer
+
+
+def run(context_length, n_features, legacy, n_repeats):
+    trainer = make_trainer(context_length, n_features, legacy)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    for _ in range(n_repeats):
+        if legacy:
+            compute_statistics_loop(trainer)
+        else:
+            trainer.compute_statistics()
+    elapsed = (time.perf_counter() - start) / n_repeats
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux
+    print(f"{elapsed} {rss_before / 1024} {(rss_after - rss_before) / 1024}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--context-length", type=int, default=300)
+    parser.add_argument("--n-features", type=int, default=17)
+    parser.add_argument("--n-repeats", type=int, default=5)
+    parser.add_argument("--run", choices=["legacy", "vectorized"], default=None)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        run(args.context_length, args.n_features, args.run == "legacy", args.n_repeats)
+        return
+
+    results = {}
+    for mode in ["legacy", "vectorized"]:
+        output = subprocess.run(
+            [
+                sys.executable,
+                __file__,
+                f"--context-length={args.context_length}",
+                f"--n-features={args.n_features}",
+                f"--n-repeats={args.n_repeats}",
+                f"--run={mode}",
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        results[mode] = [float(value) for value in output.split()]
+
+    print(f"context_length={args.context_length} n_features={args.n_features}")
+    for mode, (elapsed, rss_before, rss_increase) in results.items():
+        print(
+            f"  {mode:<10}: {1e3 * elapsed:8.2f} ms, "
+            f"peak RSS {rss_before + rss_increase:7.1f} MiB "
+            f"(+{rss_increase:.1f} MiB during compute_statistics)"
+        )
+
+
+if __name__ == "__main__":
+    main()
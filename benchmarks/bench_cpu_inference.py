@@ -0,0 +1,96 @@
+"""
+Benchmark of the ICL inference on CPU with the small GPT-2 model used in
+`getting_started_gpt2.ipynb`, for the CPU inference options: number of threads,
+restricted-vocabulary LM head and dynamic int8 quantization of the linear layers.
+
+Note that the linear layers of GPT-2 are `Conv1D` modules, which are not affected
+by dynamic quantization; use e.g. `--model meta-llama/Llama-3.2-1B` to measure it.
+
+Usage:
+    python benchmarks/bench_cpu_inference.py --context-length 300 --n-features 4
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from dicl.icl.iclearner import MultiVariateICLTrainer
+from dicl.utils.icl import configure_cpu_inference
+
+
+def load_model(model_name, n_threads, quantize):
+    model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.float32)
+    return configure_cpu_inference(model, n_threads=n_threads, quantize=quantize)
+
+
+def time_icl(trainer, time_series, n_repeats):
+    trainer.update_context(
+        time_series=time_series,
+        mean_series=time_series,
+        sigma_series=np.zeros_like(time_series),
+        context_length=time_series.shape[0],
+    )
+    trainer.icl()  # warm-up
+    start = time.perf_counter()
+    for _ in range(n_repeats):
+        trainer.icl()
+    return (time.perf_counter() - start) / n_repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, default="gpt2")
+    parser.add_argument("--context-length", type=int, default=300)
+    parser.add_argument("--n-features", type=int, default=4)
+    parser.add_argument("--n-threads", type=int, default=None)
+    parser.add_argument("--n-repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model, use_fast=False)
+    rng = np.random.default_rng(0)
+    time_series = np.cumsum(
+        rng.normal(size=(args.context_length, args.n_features)), axis=0
+    )
+
+    configs = [
+        ("default threads", dict(n_threads=None, quantize=False), {}),
+        ("n_threads", dict(n_threads=args.n_threads, quantize=False), {}),
+        (
+            "n_threads + restrict_vocab",
+            dict(n_threads=args.n_threads, quantize=False),
+            dict(restrict_vocab=True),
+        ),
+        (
+            "n_threads + restrict_vocab + int8",
+            dict(n_threads=args.n_threads, quantize=True),
+            dict(restrict_vocab=True),
+        ),
+    ]
+    default_n_threads = torch.get_num_threads()
+
+    print(
+        f"model={args.model} context_length={args.context_length} "
+        f"n_features={args.n_features}"
+    )
+    for name, model_kwargs, trainer_kwargs in configs:
+        torch.set_num_threads(default_n_threads)
+        model = load_model(args.model, **model_kwargs)
+        trainer = MultiVariateICLTrainer(
+            model=model,
+            tokenizer=tokenizer,
+            n_features=args.n_features,
+            device="cpu",
+            **trainer_kwargs,
+        )
+        elapsed = time_icl(trainer, time_series, args.n_repeats)
+        print(
+            f"  {name:<34}: {1e3 * elapsed:9.1f} ms per icl call "
+            f"({torch.get_num_threads()} threads)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Error against cost of the KSD estimators of `ksdp.ksd.estimate_KSD` (incomplete
+U-statistic, block-diagonal, random Fourier features and Nystrom), compared to the
+exact value of `get_KSD` (O(n^2)), on samples of a shifted and scaled Gaussian
+scored against a standard Gaussian target.
+
+For each n, the exact value is computed once (up to --exact-max-n samples, above
+which only the timings of the estimators are reported) and each estimator setting
+is run --repeats times with different random draws. The relative error is the root
+mean square of (estimate - exact) / exact over the repeats.
+
+Usage:
+    python benchmarks/bench_ksd_estimators.py --dim 10 --n 1000,10000,50000
+"""
+
+import argparse
+import time
+
+import torch
+
+from dicl.rl.ksdp import ksd
+
+ESTIMATOR_SETTINGS = [
+    ("incomplete", "num_pairs", [None, 10**5, 10**6]),
+    ("block", "block_size", [64, 256, 1024]),
+    ("rff", "num_features", [128, 512, 2048]),
+    ("nystrom", "num_landmarks", [64, 256, 1024]),
+]
+
+
+def timed(fn):
+    start = time.perf_counter()
+    value = float(fn())
+    return value, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n", type=str, default="1000,5000,20000")
+    parser.add_argument("--dim", type=int, default=10)
+    parser.add_argument("--kernel-type", choices=["rbf", "imq"], default="rbf")
+    parser.add_argument("--h-method", choices=["dim", "med"], default="dim")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--exact-max-n", type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f"dim={args.dim} kernel_type={args.kernel_type} h_method={args.h_method}")
+    for n in [int(n) for n in args.n.split(",")]:
+        torch.manual_seed(0)
+        samples = 1.2 * torch.randn(n, args.dim) + 0.3
+        gradients = -samples
+
+        exact = None
+        if n <= args.exact_max_n:
+            exact, elapsed = timed(
+                lambda: ksd.get_KSD(samples, gradients, args.kernel_type, args.h_method)
+            )
+            print(f"  n={n:<6} {'exact':<28}: {elapsed:9.3f} s, KSD={exact:.6f}")
+
+        for estimator, parameter, values in ESTIMATOR_SETTINGS:
+            if estimator == "rff" and args.kernel_type != "rbf":
+                continue
+            for value in values:
+                kwargs = {} if value is None else {parameter: value}
+                runs = [
+                    timed(
+                        lambda: ksd.estimate_KSD(
+                            samples,
+                            gradients,
+                            args.kernel_type,
+                            args.h_method,
+                            estimator=estimator,
+                            **kwargs,
+                        )
+                    )
+                    for _ in range(args.repeats)
+                ]
+                estimates = torch.tensor([estimate for estimate, _ in runs])
+                elapsed = sum(elapsed for _, elapsed in runs) / len(runs)
+                setting = f"{estimator} {parameter}={value or n}"
+                line = (
+                    f"  n={n:<6} {setting:<28}: {elapsed:9.3f} s, "
+                    f"KSD={float(estimates.mean()):.6f}"
+                )
+                if exact is not None:
+                    error = ((estimates - exact) / exact).pow(2).mean().sqrt()
+                    line += f", rel. error {float(error):.2e}"
+                print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Benchmark of `dicl.utils.icl.serialize_arr` against the former per-timestep
+implementation, on the context sizes used by the SAC-DICL loop.
+
+Usage:
+    python benchmarks/bench_serialize_arr.py --context-length 300 --n-features 17
+"""
+
+import argparse
+import time
+from functools import partial
+
+import numpy as np
+
+from dicl.icl.iclearner import MultiVariateICLTrainer
+from dicl.utils.icl import serialize_arr, vec_num2repr
+
+
+def serialize_arr_loop(arr, settings):
+    """Former implementation of serialize_arr (one Python iteration per value)."""
+    if not settings.signed:
+        plus_sign = minus_sign = ""
+    else:
+        plus_sign = settings.plus_sign
+        minus_sign = settings.minus_sign
+
+    vnum2repr = partial(
+        vec_num2repr, base=settings.base, prec=settings.prec, max_val=settings.max_val
+    )
+    sign_arr, digits_arr = vnum2repr(np.where(np.isnan(arr), np.zeros_like(arr), arr))
+    ismissing = np.isnan(arr)
+
+    def tokenize(arr):
+        return "".join([settings.bit_sep + str(b) for b in arr])
+
+    bit_strs = []
+    for sign, digits, missing in zip(sign_arr, digits_arr, ismissing):
+        if not settings.fixed_length:
+            nonzero_indices = np.where(digits != 0)[0]
+            if len(nonzero_indices) == 0:
+                digits = np.array([0])
+            else:
+                digits = digits[nonzero_indices[0] :]
+            prec = settings.prec
+            if len(settings.decimal_point):
+                digits = np.concatenate(
+                    [digits[:-prec], np.array([settings.decimal_point]), digits[-prec:]]
+                )
+        digits = tokenize(digits)
+        sign_sep = plus_sign if sign == 1 else minus_sign
+        if missing:
+            bit_strs.append(settings.missing_str)
+        else:
+            bit_strs.append(sign_sep + digits)
+    return settings.time_sep.join(bit_strs) + settings.time_sep
+
+
+def timeit(func, n_repeats):
+    start = time.perf_counter()
+    for _ in range(n_repeats):
+        func()
+    return (time.perf_counter() - start) / n_repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--context-length", type=int, default=300)
+    parser.add_argument("--n-features", type=int, default=17)
+    parser.add_argument("--n-repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    settings = MultiVariateICLTrainer._serializer_settings()
+    # rescaled values live in [up_shift, up_shift + rescale_factor]
+    series = rng.uniform(1.5, 8.5, size=(args.n_features, args.context_length))
+
+    for arr in series:
+        assert serialize_arr(arr, settings) == serialize_arr_loop(arr, settings)
+
+    t_loop = timeit(
+        lambda: [serialize_arr_loop(arr, settings) for arr in series], args.n_repeats
+    )
+    t_vec = timeit(
+        lambda: [serialize_arr(arr, settings) for arr in series], args.n_repeats
+    )
+    print(
+        f"context_length={args.context_length} n_features={args.n_features}\n"
+        f"  per-timestep loop: {1e3 * t_loop:8.2f} ms\n"
+        f"  vectorized:        {1e3 * t_vec:8.2f} ms\n"
+        f"  speedup:           {t_loop / t_vec:8.1f}x"
+    )
+
+
+if __name__ == "__main__":
+    main()
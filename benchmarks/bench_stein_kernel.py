@@ -0,0 +1,116 @@
+"""
+Runtime and peak memory of the Stein kernel computations of `ksdp.ksd`
+(`get_sequential_KSDs`) against the former implementation (one `get_K_row` call per
+sample on growing prefixes, assembled with two `torch.cat` calls per row), from
+n=100 to n=20k samples.
+
+Each run is done in its own process so that the peak resident set sizes
+(`ru_maxrss`) do not interfere. The former implementation and the untiled one are
+only run up to --legacy-max-n and --full-max-n samples (O(n^2) Python copies and
+O(n^2) memory respectively).
+
+Usage:
+    python benchmarks/bench_stein_kernel.py --dim 10 --block-size 1024
+"""
+
+import argparse
+import resource
+import subprocess
+import sys
+import time
+
+import torch
+
+from dicl.rl.ksdp import ksd
+
+
+def get_sequential_KSDs_loop(samples, gradients, kernel_type, h_method):
+    """Former implementation of get_sequential_KSDs."""
+    rows = []
+    h = ksd._get_h(samples=samples, h_method=h_method) if kernel_type == "rbf" else None
+    for i in range(samples.shape[0]):
+        rows.append(
+            ksd.get_K_row(
+                samples=samples[: i + 1],
+                gradients=gradients[: i + 1],
+                kernel_type=kernel_type,
+                h=h,
+            )
+        )
+    K = rows[0].reshape(1, 1)
+    for i, row in enumerate(rows[1:]):
+        K = torch.cat([K, row[: i + 1].unsqueeze(0)])
+        K = torch.cat([K, row.unsqueeze(1)], dim=1)
+
+    K_sums = 2.0 * torch.tril(K).sum(dim=1) - K.diag()
+    cum_sums = torch.cumsum(K_sums, dim=0)
+    return cum_sums.sqrt().divide(torch.arange(1, cum_sums.shape[0] + 1))
+
+
+def run(n, dim, kernel_type, mode, block_size):
+    torch.manual_seed(0)
+    samples = torch.randn(n, dim)
+    gradients = -samples
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    if mode == "legacy":
+        KSDs = get_sequential_KSDs_loop(samples, gradients, kernel_type, "dim")
+    else:
+        KSDs = ksd.get_sequential_KSDs(
+            samples,
+            gradients,
+            kernel_type,
+            "dim",
+            block_size=block_size if mode == "tiled" else None,
+        )
+    elapsed = time.perf_counter() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux
+    print(f"{elapsed} {(rss_after - rss_before) / 1024} {float(KSDs[-1])}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n", type=str, default="100,1000,5000,10000,20000")
+    parser.add_argument("--dim", type=int, default=10)
+    parser.add_argument("--kernel-type", choices=["rbf", "imq"], default="rbf")
+    parser.add_argument("--block-size", type=int, default=1024)
+    parser.add_argument("--legacy-max-n", type=int, default=2000)
+    parser.add_argument("--full-max-n", type=int, default=10000)
+    parser.add_argument("--run", choices=["legacy", "full", "tiled"], default=None)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        run(int(args.n), args.dim, args.kernel_type, args.run, args.block_size)
+        return
+
+    print(f"dim={args.dim} kernel_type={args.kernel_type} block_size={args.block_size}")
+    for n in [int(n) for n in args.n.split(",")]:
+        for mode in ["legacy", "full", "tiled"]:
+            if (mode == "legacy" and n > args.legacy_max_n) or (
+                mode == "full" and n > args.full_max_n
+            ):
+                continue
+            output = subprocess.run(
+                [
+                    sys.executable,
+                    __file__,
+                    f"--n={n}",
+                    f"--dim={args.dim}",
+                    f"--kernel-type={args.kernel_type}",
+                    f"--block-size={args.block_size}",
+                    f"--run={mode}",
+                ],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            elapsed, rss_increase, last_KSD = [float(value) for value in output.split()]
+            print(
+                f"  n={n:<6} {mode:<7}: {elapsed:9.3f} s, "
+                f"+{rss_increase:8.1f} MiB peak RSS, KSD_n={last_KSD:.6f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
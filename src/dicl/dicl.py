@@ -1,5 +1,6 @@
 from typing import TYPE_CHECKING, Any, List, Optional, Tuple
 import copy
+import warnings
 
 import numpy as np
 from numpy.typing import NDArray
@@ -9,13 +10,46 @@ import seaborn as sns
 from sklearn.preprocessing import StandardScaler, MinMaxScaler
 from sklearn.pipeline import make_pipeline
 from sklearn.base import BaseEstimator, TransformerMixin
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, IncrementalPCA
+from sklearn.utils.extmath import svd_flip
 
 from dicl.icl.iclearner import MultiVariateICLTrainer
-from dicl.utils.calibration import compute_ks_metric, ks_cdf
+from dicl.utils.calibration import compute_ks_metric, extract_affine_map, ks_cdf
 
 if TYPE_CHECKING:
     from transformers import AutoModel, AutoTokenizer
+    from dicl.icl.iclearner import ICLObject
+
+
+def _remap_incremental_pca(pca: IncrementalPCA, scale: NDArray, shift: NDArray):
+    """
+    Moves the statistics accumulated by an IncrementalPCA to the coordinates
+    z' = scale * z + shift, as if the previous data had been seen in those
+    coordinates: the mean and variances are mapped, and the scatter matrix
+    V^T S^2 V kept by the principal axes becomes (V diag(scale))^T S^2 (V diag(scale)).
+    """
+    weighted_components = pca.singular_values_[:, None] * pca.components_ * scale
+    _, singular_values, components = np.linalg.svd(
+        weighted_components, full_matrices=False
+    )
+    _, components = svd_flip(None, components, u_based_decision=False)
+
+    n_samples = pca.n_samples_seen_
+    pca.mean_ = pca.mean_ * scale + shift
+    pca.var_ = pca.var_ * scale**2
+    pca.components_ = components
+    pca.singular_values_ = singular_values
+    pca.explained_variance_ = singular_values**2 / (n_samples - 1)
+    pca.explained_variance_ratio_ = singular_values**2 / np.sum(pca.var_ * n_samples)
+    n_features = pca.components_.shape[1]
+    if pca.n_components_ < n_features:
+        # mean of the discarded eigenvalues, from the total variance
+        pca.noise_variance_ = (
+            np.sum(pca.var_) * n_samples / (n_samples - 1)
+            - pca.explained_variance_.sum()
+        ) / (n_features - pca.n_components_)
+    else:
+        pca.noise_variance_ = 0.0
 
 
 class IdentityTransformer(BaseEstimator, TransformerMixin):
@@ -31,6 +65,11 @@ class IdentityTransformer(BaseEstimator, TransformerMixin):
                 Fits the transformer (no-op in this case), returning the instance
                 itself.
 
+            partial_fit(
+                input_array: NDArray, y: Optional[NDArray] = None
+            ) -> IdentityTransformer:
+                Incremental fit (no-op as well), returning the instance itself.
+
             transform(input_array: NDArray, y: Optional[NDArray] = None) -> NDArray:
                 Returns the input data without modification.
 
@@ -43,6 +82,13 @@ class IdentityTransformer(BaseEstimator, TransformerMixin):
     def fit(self, input_array: NDArray, y: Optional[NDArray] = None):
         return self
 
+    def partial_fit(self, input_array: NDArray, y: Optional[NDArray] = None):
+        return self
+
+    def __sklearn_is_fitted__(self) -> bool:
+        # stateless, otherwise the pipelines refuse to transform with it
+        return True
+
     def transform(self, input_array: NDArray, y: Optional[NDArray] = None) -> NDArray:
         return input_array * 1
 
@@ -61,6 +107,12 @@ class DICL:
         fit_disentangler(X: NDArray):
             Fit the disentangler on the input data.
 
+        partial_fit_disentangler(X: NDArray):
+            Update the disentangler with new input data instead of refitting it.
+
+        reset_context():
+            Clear the context and predictions, to reuse the model on new data.
+
         transform(X: NDArray) -> NDArray:
             Transform the input data using the disentangler.
 
@@ -70,6 +122,12 @@ class DICL:
         predict_single_step(X: NDArray) -> Tuple[NDArray, ...]:
             Perform single-step time series prediction using the model.
 
+        predict_single_step_batch(
+            windows: List[NDArray],
+            max_batch_tokens: Optional[int] = None
+        ) -> Tuple[NDArray, ...]:
+            Perform single-step predictions on several windows at once.
+
         predict_multi_step(
             X: NDArray,
             prediction_horizon: int,
@@ -78,7 +136,15 @@ class DICL:
         ) -> Tuple[NDArray, ...]:
             Perform multi-step time series prediction for the given horizon.
 
-        compute_metrics(burnin: int = 0) -> dict:
+        sample_multi_step(
+            X: NDArray,
+            prediction_horizon: int,
+            n_particles: int,
+            verbose: int = 1
+        ) -> NDArray:
+            Sample stochastic trajectories over the given horizon.
+
+        compute_metrics(burnin: int = 0, exact: bool = False) -> dict:
             Compute evaluation metrics (e.g., MSE, KS test) after prediction.
 
         plot_single_step(
@@ -112,6 +178,7 @@ class DICL:
         tokenizer: "AutoTokenizer",
         rescale_factor: float = 7.0,
         up_shift: float = 1.5,
+        **iclearner_kwargs,
     ):
         """
         Initialize the DICL model with the specified disentangler, model, and
@@ -127,6 +194,8 @@ class DICL:
                 Defaults to 7.0.
             up_shift (float, optional): Shift factor applied to rescaled data.
                 Defaults to 1.5.
+            **iclearner_kwargs: Additional keyword arguments passed to the
+                MultiVariateICLTrainer (e.g. batch_features=True).
         """
 
         self.n_features = n_features
@@ -144,6 +213,7 @@ class DICL:
             n_features=n_components,
             rescale_factor=rescale_factor,
             up_shift=up_shift,
+            **iclearner_kwargs,
         )
 
     def fit_disentangler(self, X: NDArray):
@@ -155,6 +225,90 @@ class DICL:
         """
         self.disentangler.fit(X)
 
+    def partial_fit_disentangler(self, X: NDArray):
+        """
+        Update the disentangler with new input data instead of refitting it from
+        scratch (e.g. with the new windows of a growing replay buffer). Every step of
+        the pipeline is updated with partial_fit, hence the disentangler must support
+        it (e.g. IncrementalPCA, see DICL_PCA(incremental=True)).
+
+        The statistics of the previous data are moved to the updated scaling before
+        being combined with the new data: the StandardScaler ones when the MinMax
+        range grows, and the IncrementalPCA ones whenever the standardization
+        changes. Other incremental disentanglers are updated as they are.
+
+        Args:
+            X (NDArray): New input time series data.
+        """
+        min_max_scaler, standard_scaler, disentangler = (
+            step for _, step in self.disentangler.steps
+        )
+        if not hasattr(disentangler, "partial_fit"):
+            raise ValueError(
+                f"{type(disentangler).__name__} does not support incremental fits."
+            )
+
+        if hasattr(min_max_scaler, "scale_") and hasattr(standard_scaler, "mean_"):
+            old_scale, old_min = (
+                min_max_scaler.scale_.copy(),
+                min_max_scaler.min_.copy(),
+            )
+            old_mean, old_std = (
+                standard_scaler.mean_.copy(),
+                standard_scaler.scale_.copy(),
+            )
+            min_max_scaler.partial_fit(X)
+            # the statistics of the previous data are moved to the updated min-max
+            # space, otherwise they are mixed with the new data on another scale
+            ratio = min_max_scaler.scale_ / old_scale
+            standard_scaler.mean_ = (
+                standard_scaler.mean_ - old_min
+            ) * ratio + min_max_scaler.min_
+            standard_scaler.var_ = standard_scaler.var_ * ratio**2
+
+            X_scaled = min_max_scaler.transform(X)
+            standard_scaler.partial_fit(X_scaled)
+
+            if isinstance(disentangler, IncrementalPCA) and hasattr(
+                disentangler, "components_"
+            ):
+                # same for the PCA, with the affine map from the previous
+                # standardized space to the updated one
+                new_mean, new_std = standard_scaler.mean_, standard_scaler.scale_
+                _remap_incremental_pca(
+                    disentangler,
+                    scale=old_std * ratio / new_std,
+                    shift=(
+                        (old_mean - old_min) * ratio + min_max_scaler.min_ - new_mean
+                    )
+                    / new_std,
+                )
+        else:
+            min_max_scaler.partial_fit(X)
+            X_scaled = min_max_scaler.transform(X)
+            standard_scaler.partial_fit(X_scaled)
+
+        disentangler.partial_fit(standard_scaler.transform(X_scaled))
+
+    def reset_context(self):
+        """
+        Clear the context and the predictions of the previous calls (the fitted
+        disentangler is kept), to reuse the model on a new time series instead of
+        building a new one.
+        """
+        self.iclearner.reset_context()
+        for name in [
+            "X",
+            "context_length",
+            "prediction_horizon",
+            "icl_object",
+            "mean",
+            "mode",
+            "lb",
+            "ub",
+        ]:
+            self.__dict__.pop(name, None)
+
     def transform(self, X: NDArray) -> NDArray:
         """
         Transform the input data using the disentangler.
@@ -179,6 +333,24 @@ class DICL:
         """
         return self.disentangler.inverse_transform(X_transformed)
 
+    def pin_rescaling_bounds(self, X: NDArray):
+        """
+        Fix the rescaling bounds of the components to their range over X (e.g. a
+        whole episode), instead of recomputing them from every context. Overlapping
+        contexts taken from X are then serialized into prompts sharing prefixes.
+
+        Args:
+            X (NDArray): Input time series data covering the future contexts.
+        """
+        X_transformed = self.transform(X)
+        self.iclearner.pin_rescaling_bounds(
+            X_transformed.min(axis=0), X_transformed.max(axis=0)
+        )
+
+    def unpin_rescaling_bounds(self):
+        """Recompute the rescaling bounds from every context again."""
+        self.iclearner.unpin_rescaling_bounds()
+
     def predict_single_step(self, X: NDArray) -> Tuple[NDArray, ...]:
         """
         Perform single-step prediction on the input data.
@@ -214,37 +386,130 @@ class DICL:
         self.icl_object = self.iclearner.compute_statistics()
 
         # Step 3: Inverse transform the predictions
+        mean, mode, lb, ub = self._statistics(self.icl_object)
+        self.mean = self.inverse_transform(mean)
+        self.mode = self.inverse_transform(mode)
+        self.lb = self.inverse_transform(lb)
+        self.ub = self.inverse_transform(ub)
+
+        return self.mean, self.mode, self.lb, self.ub
+
+    def predict_single_step_batch(
+        self, windows: List[NDArray], max_batch_tokens: Optional[int] = None
+    ) -> Tuple[NDArray, ...]:
+        """
+        Perform single-step predictions on several windows (e.g. from different
+        episodes) at once: the components of all the windows are packed into padded
+        batches of the LLM.
+
+        The disentangler must be fitted beforehand (it is shared by the windows), and
+        the attributes used by the plots and metrics are not updated.
+
+        Args:
+            windows (List[NDArray]): Input time series data, of the same shape
+                (context_length, n_features).
+            max_batch_tokens (Optional[int], optional): Maximum number of (padded)
+                tokens per forward pass of the LLM. If None, the value given to the
+                MultiVariateICLTrainer is used. Default is None.
+
+        Returns:
+            Tuple[NDArray, ...]: Mean, mode, lower bound, and upper bound of the
+                predictions, of shape (n_windows, context_length - 1, n_features).
+        """
+        assert all(
+            X.shape == windows[0].shape for X in windows
+        ), "All the windows must have the same shape"
+        assert (
+            windows[0].shape[1] == self.n_features
+        ), f"N features doesnt correspond to {self.n_features}"
+        n_windows, n_steps = len(windows), windows[0].shape[0] - 1
+
+        contexts = self.iclearner.icl_batch(
+            [self.transform(X[:-1]) for X in windows],
+            stochastic=True,
+            max_batch_tokens=max_batch_tokens,
+        )
+
+        # inverse transform the statistics of all the windows at once
+        statistics = [self._statistics(icl_object) for icl_object in contexts]
+        return tuple(
+            self.inverse_transform(
+                np.concatenate([stats[idx] for stats in statistics], axis=0)
+            ).reshape((n_windows, n_steps, self.n_features))
+            for idx in range(4)
+        )
+
+    def _statistics(self, icl_object: List["ICLObject"]) -> Tuple[NDArray, ...]:
+        """
+        Mean, mode, lower bound, and upper bound of the predictions of the
+        components, in the transformed space.
+        """
         all_mean = []
         all_mode = []
         all_lb = []
         all_ub = []
         for dim in range(self.n_components):
-            ts_max = self.icl_object[dim].rescaling_max
-            ts_min = self.icl_object[dim].rescaling_min
+            ts_max = icl_object[dim].rescaling_max
+            ts_min = icl_object[dim].rescaling_min
             # -------------------- Useful for Plots --------------------
             mode_arr = (
-                (self.icl_object[dim].mode_arr.flatten() - self.up_shift)
+                (icl_object[dim].mode_arr.flatten() - self.up_shift)
                 / self.rescale_factor
             ) * (ts_max - ts_min) + ts_min
             mean_arr = (
-                (self.icl_object[dim].mean_arr.flatten() - self.up_shift)
+                (icl_object[dim].mean_arr.flatten() - self.up_shift)
                 / self.rescale_factor
             ) * (ts_max - ts_min) + ts_min
-            sigma_arr = (
-                self.icl_object[dim].sigma_arr.flatten() / self.rescale_factor
-            ) * (ts_max - ts_min)
+            sigma_arr = (icl_object[dim].sigma_arr.flatten() / self.rescale_factor) * (
+                ts_max - ts_min
+            )
 
             all_mean.append(mean_arr[..., None])
             all_mode.append(mode_arr[..., None])
             all_lb.append(mean_arr[..., None] - sigma_arr[..., None])
             all_ub.append(mean_arr[..., None] + sigma_arr[..., None])
 
-        self.mean = self.inverse_transform(np.concatenate(all_mean, axis=1))
-        self.mode = self.inverse_transform(np.concatenate(all_mode, axis=1))
-        self.lb = self.inverse_transform(np.concatenate(all_lb, axis=1))
-        self.ub = self.inverse_transform(np.concatenate(all_ub, axis=1))
+        return (
+            np.concatenate(all_mean, axis=1),
+            np.concatenate(all_mode, axis=1),
+            np.concatenate(all_lb, axis=1),
+            np.concatenate(all_ub, axis=1),
+        )
 
-        return self.mean, self.mode, self.lb, self.ub
+    def _update_multi_step_context(
+        self,
+        X: NDArray,
+        prediction_horizon: int,
+        stochastic: bool,
+        if_true_mean_else_mode: bool,
+    ):
+        """
+        Run the ICL on the input data without its last prediction_horizon steps,
+        keeping the KV cache of the context for the rollouts.
+        """
+        assert (
+            X.shape[1] == self.n_features
+        ), f"N features doesnt correspond to {self.n_features}"
+
+        # Step 1: Transform the time series
+        X_transformed = self.transform(X[: -1 - prediction_horizon])
+
+        # Step 2: Perform time series forecasting
+        self.iclearner.update_context(
+            time_series=copy.copy(X_transformed),
+            mean_series=copy.copy(X_transformed),
+            sigma_series=np.zeros_like(X_transformed),
+            context_length=X_transformed.shape[0],
+            update_min_max=True,
+        )
+
+        self.iclearner.icl(
+            stochastic=stochastic,
+            use_cache=True,
+            if_true_mean_else_mode=if_true_mean_else_mode,
+            verbose=0,
+            batch_features=False,
+        )
 
     def predict_multi_step(
         self,
@@ -252,6 +517,7 @@ class DICL:
         prediction_horizon: int,
         stochastic: bool = False,
         if_true_mean_else_mode: bool = False,
+        verbose: int = 1,
     ) -> Tuple[NDArray, ...]:
         """
         Perform multi-step prediction for a given horizon.
@@ -264,84 +530,105 @@ class DICL:
                 Defaults to False.
             if_true_mean_else_mode (bool, optional): Whether to return mean predictions
                 (True) or mode predictions (False). Defaults to False.
+            verbose (int, optional): Verbosity level of the rollout progress bar.
+                Defaults to 1.
 
         Returns:
             Tuple[NDArray, ...]: Mean, mode, lower bound, and upper bound of the
                 predictions.
         """
-        assert (
-            X.shape[1] == self.n_features
-        ), f"N features doesnt correspond to {self.n_features}"
+        self._update_multi_step_context(
+            X, prediction_horizon, stochastic, if_true_mean_else_mode
+        )
 
         self.context_length = X.shape[0]
         self.X = X
         self.prediction_horizon = prediction_horizon
 
-        # Step 1: Transform the time series
-        X_transformed = self.transform(X[: -1 - prediction_horizon])
-
-        # Step 2: Perform time series forecasting
-        self.iclearner.update_context(
-            time_series=copy.copy(X_transformed),
-            mean_series=copy.copy(X_transformed),
-            sigma_series=np.zeros_like(X_transformed),
-            context_length=X_transformed.shape[0],
-            update_min_max=True,
-        )
-
-        self.iclearner.icl(
-            stochastic=stochastic,
-            if_true_mean_else_mode=if_true_mean_else_mode,
-            verbose=0,
-        )
-
         self.icl_object = self.iclearner.predict_long_horizon_llm(
             prediction_horizon=prediction_horizon,
             stochastic=stochastic,
             if_true_mean_else_mode=if_true_mean_else_mode,
-            verbose=1,
+            verbose=verbose,
         )
 
         # Step 3: Inverse transform the predictions
-        all_mean = []
-        all_mode = []
-        all_lb = []
-        all_ub = []
-        for dim in range(self.n_components):
-            ts_max = self.icl_object[dim].rescaling_max
-            ts_min = self.icl_object[dim].rescaling_min
-            # -------------------- Useful for Plots --------------------
-            mode_arr = (
-                (self.icl_object[dim].mode_arr.flatten() - self.up_shift)
-                / self.rescale_factor
-            ) * (ts_max - ts_min) + ts_min
-            mean_arr = (
-                (self.icl_object[dim].mean_arr.flatten() - self.up_shift)
-                / self.rescale_factor
-            ) * (ts_max - ts_min) + ts_min
-            sigma_arr = (
-                self.icl_object[dim].sigma_arr.flatten() / self.rescale_factor
-            ) * (ts_max - ts_min)
+        mean, mode, lb, ub = self._statistics(self.icl_object)
+        self.mean = self.inverse_transform(mean)
+        self.mode = self.inverse_transform(mode)
+        self.lb = self.inverse_transform(lb)
+        self.ub = self.inverse_transform(ub)
 
-            all_mean.append(mean_arr[..., None])
-            all_mode.append(mode_arr[..., None])
-            all_lb.append(mean_arr[..., None] - sigma_arr[..., None])
-            all_ub.append(mean_arr[..., None] + sigma_arr[..., None])
+        return self.mean, self.mode, self.lb, self.ub
 
-        self.mean = self.inverse_transform(np.concatenate(all_mean, axis=1))
-        self.mode = self.inverse_transform(np.concatenate(all_mode, axis=1))
-        self.lb = self.inverse_transform(np.concatenate(all_lb, axis=1))
-        self.ub = self.inverse_transform(np.concatenate(all_ub, axis=1))
+    def sample_multi_step(
+        self,
+        X: NDArray,
+        prediction_horizon: int,
+        n_particles: int,
+        verbose: int = 1,
+    ) -> NDArray:
+        """
+        Sample stochastic trajectories over a given horizon.
 
-        return self.mean, self.mode, self.lb, self.ub
+        The n_particles trajectories are rolled out as one batch from the KV cache of
+        the context (this requires use_token_ids=True, otherwise they are rolled out
+        sequentially). Unlike predict_multi_step, the attributes used by the plots
+        and metrics are not updated.
+
+        Args:
+            X (NDArray): Input time series data.
+            prediction_horizon (int): Number of steps to sample into the future
+                (taken from the end of the input time series).
+            n_particles (int): Number of trajectories to sample.
+            verbose (int, optional): Verbosity level of the rollout progress bars.
+                Defaults to 1.
+
+        Returns:
+            NDArray: The sampled trajectories of the last prediction_horizon steps,
+                of shape (n_particles, prediction_horizon, n_features).
+        """
+        # keep the ICLObject instances of the last prediction for the plots and metrics
+        self.iclearner.new_context()
+        self._update_multi_step_context(
+            X, prediction_horizon, stochastic=True, if_true_mean_else_mode=False
+        )
+
+        trajectories = self.iclearner.sample_long_horizon_llm(
+            prediction_horizon=prediction_horizon,
+            n_particles=n_particles,
+            verbose=verbose,
+        )
+        return self.inverse_transform(
+            trajectories.reshape((-1, self.n_components))
+        ).reshape((n_particles, prediction_horizon, self.n_features))
+
+    def _check_exact_calibration(self, exact: bool) -> bool:
+        """
+        Whether the KS quantiles can be computed without sampling: the inverse
+        transform of the disentangler must be affine.
+        """
+        if not exact:
+            return False
+        if extract_affine_map(self.inverse_transform, self.n_components) is None:
+            warnings.warn(
+                "The disentangler is not linear, falling back to Monte-Carlo "
+                "estimation of the KS quantiles."
+            )
+            return False
+        return True
 
-    def compute_metrics(self, burnin: int = 0):
+    def compute_metrics(self, burnin: int = 0, exact: bool = False):
         """
         Compute the prediction metrics such as MSE and KS test.
 
         Args:
             burnin (int, optional): Number of initial steps to ignore when computing
                 metrics. Defaults to 0.
+            exact (bool, optional): If True, the KS quantiles (probability integral
+                transform of the ground truth) are computed from the CDFs of the
+                predicted PDFs instead of Monte-Carlo traces. This requires a linear
+                disentangler (e.g. identity or PCA). Defaults to False.
 
         Returns:
             dict: Dictionary containing various prediction metrics.
@@ -368,6 +655,8 @@ class DICL:
             n_features=self.n_features,
             inverse_transform=self.inverse_transform,
             burnin=burnin,
+            rng=self.iclearner.rng,
+            analytic=self._check_exact_calibration(exact),
         )
 
         metrics["perdim_ks"] = kss
@@ -539,6 +828,7 @@ class DICL:
         feature_names: Optional[List[str]] = None,
         savefigpath: Optional[str] = None,
         burnin: int = 0,
+        exact: bool = False,
     ):
         """
         Plot calibration curves based on the KS test.
@@ -550,6 +840,8 @@ class DICL:
                 Defaults to None.
             burnin (int, optional): Number of initial steps to ignore when computing
                 calibration. Defaults to 0.
+            exact (bool, optional): If True, the KS quantiles are computed without
+                sampling (see `compute_metrics`). Defaults to False.
         """
         kss, ks_quantiles = compute_ks_metric(
             groundtruth=self.X[1:],
@@ -558,6 +850,8 @@ class DICL:
             n_features=self.n_features,
             inverse_transform=self.inverse_transform,
             burnin=burnin,
+            rng=self.iclearner.rng,
+            analytic=self._check_exact_calibration(exact),
         )
 
         if not feature_names:
@@ -608,6 +902,7 @@ class vICL(DICL):
         tokenizer: "AutoTokenizer",
         rescale_factor: float = 7.0,
         up_shift: float = 1.5,
+        **iclearner_kwargs,
     ):
         """
         Initialize DICL with no disentangler (IdentityTransformer).
@@ -620,6 +915,8 @@ class vICL(DICL):
                 Defaults to 7.0.
             up_shift (float, optional): Shift factor applied to rescaled data.
                 Defaults to 1.5.
+            **iclearner_kwargs: Additional keyword arguments passed to the
+                MultiVariateICLTrainer.
         """
         super(vICL, self).__init__(
             disentangler=IdentityTransformer(),
@@ -629,6 +926,7 @@ class vICL(DICL):
             tokenizer=tokenizer,
             rescale_factor=rescale_factor,
             up_shift=up_shift,
+            **iclearner_kwargs,
         )
 
 
@@ -641,6 +939,8 @@ class DICL_PCA(DICL):
         tokenizer: "AutoTokenizer",
         rescale_factor: float = 7.0,
         up_shift: float = 1.5,
+        incremental: bool = False,
+        **iclearner_kwargs,
     ):
         """
         Initialize DICL with a PCA disentangler.
@@ -654,13 +954,22 @@ class DICL_PCA(DICL):
                 Defaults to 7.0.
             up_shift (float, optional): Shift factor applied to rescaled data.
                 Defaults to 1.5.
+            incremental (bool, optional): Whether to use an IncrementalPCA, which can
+                be updated with partial_fit_disentangler. Defaults to False.
+            **iclearner_kwargs: Additional keyword arguments passed to the
+                MultiVariateICLTrainer.
         """
         super(DICL_PCA, self).__init__(
-            disentangler=PCA(n_components=n_components),
+            disentangler=(
+                IncrementalPCA(n_components=n_components)
+                if incremental
+                else PCA(n_components=n_components)
+            ),
             n_features=n_features,
             n_components=n_components,
             model=model,
             tokenizer=tokenizer,
             rescale_factor=rescale_factor,
             up_shift=up_shift,
+            **iclearner_kwargs,
         )
@@ -4,20 +4,34 @@ from typing import TYPE_CHECKING, Optional, List
 from dataclasses import dataclass
 
 import copy
+import warnings
 from tqdm import tqdm
 
 import numpy as np
 from numpy.typing import NDArray
+import torch
 
 from dicl.utils.icl import (
     serialize_arr,
     SerializerSettings,
     calculate_multiPDF_llama3,
+    calculate_multiPDF_llama3_batch,
+    calculate_next_PDF_llama3,
+    calculate_next_PDF_llama3_batch,
+    check_token_ids_equivalence,
+    inverse_cdf_sample,
+    PDFBatch,
+    PDF_list_from_probs,
+    get_digit_token_table,
+    serialize_arr_to_ids,
 )
 
 if TYPE_CHECKING:
     from transformers import AutoModel, AutoTokenizer
     from dicl.utils.icl import MultiResolutionPDF
+    from dicl.utils.disk_cache import ICLDiskCache
+    from dicl.utils.inference_server import ICLInferenceClient
+    from dicl.utils.prefix_cache import PrefixKVCache
 
 
 @dataclass
@@ -26,11 +40,12 @@ class ICLObject:
     mean_series: Optional[NDArray[np.float32]] = None
     sigma_series: Optional[NDArray[np.float32]] = None
     str_series: Optional[str] = None
+    token_series: Optional[NDArray[np.int64]] = None
     rescaled_true_mean_arr: Optional[NDArray[np.float32]] = None
     rescaled_true_sigma_arr: Optional[NDArray[np.float32]] = None
     rescaling_min: Optional[NDArray[np.float32]] = None
     rescaling_max: Optional[NDArray[np.float32]] = None
-    PDF_list: Optional[List] = None
+    PDF_list: Optional[PDFBatch] = None
     predictions: Optional[NDArray[np.float32]] = None
     mean_arr: Optional[NDArray[np.float32]] = None
     mode_arr: Optional[NDArray[np.float32]] = None
@@ -65,6 +80,15 @@ class MultiVariateICLTrainer(ICLTrainer):
         n_features: int,
         rescale_factor: float = 7.0,
         up_shift: float = 1.5,
+        batch_features: bool = False,
+        max_batch_tokens: Optional[int] = None,
+        use_token_ids: bool = False,
+        rng: Optional[np.random.Generator] = None,
+        restrict_vocab: bool = False,
+        device: Optional[str] = None,
+        prefix_cache: Optional["PrefixKVCache"] = None,
+        disk_cache: Optional["ICLDiskCache"] = None,
+        inference_client: Optional["ICLInferenceClient"] = None,
     ):
         """
         MultiVariateICLTrainer is an implementation of ICLTrainer for multivariate time
@@ -79,6 +103,39 @@ class MultiVariateICLTrainer(ICLTrainer):
                 Default is 7.0.
             up_shift (float, optional): Shift value applied after rescaling.
                 Default is 1.5.
+            batch_features (bool, optional): If True, all the features are processed
+                by a single (padded) forward pass of the LLM instead of one forward
+                pass per feature. Default is False.
+            max_batch_tokens (Optional[int], optional): Maximum number of (padded)
+                tokens per forward pass in batched mode. If None, all the features
+                are processed at once. Default is None.
+            use_token_ids (bool, optional): If True, the rescaled time series are
+                encoded directly into token ids, bypassing the tokenizer. This is
+                only enabled if the equivalence with the tokenizer is verified
+                (one token per value, e.g. Llama-3). Default is False.
+            rng (Optional[np.random.Generator], optional): Random generator used for
+                the stochastic predictions. If None, the global NumPy random state is
+                used. Default is None.
+            restrict_vocab (bool, optional): If True, the LM head is only applied to
+                the value tokens at the positions of the PDFs instead of computing the
+                logits of the whole vocabulary at every position, which cuts the
+                memory of the logits by orders of magnitude. Default is False.
+            device (Optional[str], optional): Device on which the inputs of the LLM
+                are placed (e.g. "cpu", "cuda:0"). If None, the device of the model is
+                used. Default is None.
+            prefix_cache (Optional[PrefixKVCache], optional): Cache of the KV caches
+                of the previous contexts, from which the forward passes of contexts
+                sharing a prefix with them are resumed. It can be shared by several
+                trainers using the same model. When set, the features are processed
+                one at a time (batch_features is ignored). Default is None.
+            disk_cache (Optional[ICLDiskCache], optional): Persistent cache of the
+                probabilities computed by the LLM, read instead of calling the LLM on
+                the contexts it already holds (unless use_cache is set in icl, since
+                the KV caches are not stored). Default is None.
+            inference_client (Optional[ICLInferenceClient], optional): Client of a
+                local inference server computing the probabilities instead of
+                `model` (which can then be None). The KV caches are not available in
+                that case, and the prefix cache is not used. Default is None.
         """
         self.model: "AutoModel" = model
         self.tokenizer: "AutoTokenizer" = tokenizer
@@ -90,11 +147,93 @@ class MultiVariateICLTrainer(ICLTrainer):
         self.up_shift: float = up_shift
         self.rescale_factor: float = rescale_factor
 
+        self.batch_features: bool = batch_features
+        self.max_batch_tokens: Optional[int] = max_batch_tokens
+
+        self.rng: Optional[np.random.Generator] = rng
+        self.restrict_vocab: bool = restrict_vocab
+        self.device: Optional[str] = device
+        self.prefix_cache: Optional["PrefixKVCache"] = prefix_cache
+        self.disk_cache: Optional["ICLDiskCache"] = disk_cache
+        self.inference_client: Optional["ICLInferenceClient"] = inference_client
+        self.rescaling_pinned: bool = False
+
+        self.use_token_ids: bool = False
+        if use_token_ids:
+            if check_token_ids_equivalence(tokenizer, self._serializer_settings()):
+                self.use_token_ids = True
+            else:
+                warnings.warn(
+                    "The tokenizer does not encode one value per token, falling back "
+                    "to the tokenization of the serialized strings."
+                )
+
         self.icl_object: List[ICLObject] = [ICLObject() for _ in range(self.n_features)]
         self.kv_cache: List[Optional[NDArray[np.float32]]] = [
             None for _ in range(self.n_features)
         ]
 
+    @staticmethod
+    def _serializer_settings() -> SerializerSettings:
+        """Serialization settings used to write the rescaled values in the prompt."""
+        return SerializerSettings(
+            base=10,
+            prec=2,
+            signed=True,
+            time_sep=",",
+            bit_sep="",
+            minus_sign="-",
+            fixed_length=False,
+            max_val=10,
+        )
+
+    def pin_rescaling_bounds(
+        self, ts_min_arr: NDArray[np.float32], ts_max_arr: NDArray[np.float32]
+    ):
+        """
+        Fixes the rescaling bounds of the features: update_context does not update
+        them anymore until unpin_rescaling_bounds is called.
+
+        With fixed bounds, the contexts taken from the same trajectory are serialized
+        identically on their common timesteps, so that their prompts share prefixes.
+
+        Args:
+            ts_min_arr (NDArray[np.float32]): Minimum of each feature.
+            ts_max_arr (NDArray[np.float32]): Maximum of each feature.
+        """
+        for dim in range(self.n_features):
+            self.icl_object[dim].rescaling_min = ts_min_arr[dim]
+            self.icl_object[dim].rescaling_max = ts_max_arr[dim]
+        self.rescaling_pinned = True
+
+    def unpin_rescaling_bounds(self):
+        """Lets update_context update the rescaling bounds again."""
+        self.rescaling_pinned = False
+
+    def new_context(self):
+        """
+        Moves the internal state to fresh ICLObject instances, keeping the (possibly
+        pinned) rescaling bounds, so that the ICLObject instances returned so far
+        are not modified by the next contexts.
+        """
+        self.icl_object = [
+            ICLObject(
+                rescaling_min=icl_object.rescaling_min,
+                rescaling_max=icl_object.rescaling_max,
+            )
+            for icl_object in self.icl_object
+        ]
+
+    def reset_context(self):
+        """
+        Clears the internal state (contexts, predictions, KV caches and pinned
+        rescaling bounds), so that the trainer can be reused on a new context.
+        """
+        self.icl_object = [ICLObject() for _ in range(self.n_features)]
+        self.kv_cache = [None for _ in range(self.n_features)]
+        self.use_cache = False
+        self.rescaling_pinned = False
+
     def update_context(
         self,
         time_series: NDArray[np.float32],
@@ -114,7 +253,7 @@ class MultiVariateICLTrainer(ICLTrainer):
             context_length (Optional[int], optional): The length of the time series.
                 If None, the full time series length is used.
             update_min_max (bool, optional): Whether to update the minimum and maximum
-                rescaling values. Default is True.
+                rescaling values (ignored if they are pinned). Default is True.
 
         Returns:
             List[ICLObject]: A list of ICLObject instances representing the updated
@@ -131,18 +270,9 @@ class MultiVariateICLTrainer(ICLTrainer):
 
         for dim in range(self.n_features):
             # ------------------ serialize_gaussian ------------------
-            settings = SerializerSettings(
-                base=10,
-                prec=2,
-                signed=True,
-                time_sep=",",
-                bit_sep="",
-                minus_sign="-",
-                fixed_length=False,
-                max_val=10,
-            )
+            settings = self._serializer_settings()
 
-            if update_min_max:
+            if update_min_max and not self.rescaling_pinned:
                 self.icl_object[dim].rescaling_min = time_series[
                     : self.context_length, dim
                 ].min()
@@ -164,7 +294,16 @@ class MultiVariateICLTrainer(ICLTrainer):
                 * self.rescale_factor
             )
 
-            full_series = serialize_arr(rescaled_array, settings)
+            if self.use_token_ids:
+                full_series = None
+                token_series = serialize_arr_to_ids(
+                    rescaled_array,
+                    settings,
+                    get_digit_token_table(self.tokenizer, time_sep=settings.time_sep),
+                )
+            else:
+                full_series = serialize_arr(rescaled_array, settings)
+                token_series = None
 
             self.icl_object[dim].time_series = time_series[: self.context_length, dim]
             self.icl_object[dim].mean_series = mean_series[: self.context_length, dim]
@@ -172,6 +311,7 @@ class MultiVariateICLTrainer(ICLTrainer):
             self.icl_object[dim].rescaled_true_mean_arr = rescaled_true_mean_arr
             self.icl_object[dim].rescaled_true_sigma_arr = rescaled_true_sigma_arr
             self.icl_object[dim].str_series = full_series
+            self.icl_object[dim].token_series = token_series
         return self.icl_object
 
     def icl(
@@ -182,6 +322,7 @@ class MultiVariateICLTrainer(ICLTrainer):
         use_cache: bool = False,
         verbose: int = 0,
         if_true_mean_else_mode: bool = False,
+        batch_features: Optional[bool] = None,
     ):
         """
         Performs In-Context Learning (ICL) using the LLM for multivariate time series.
@@ -194,96 +335,334 @@ class MultiVariateICLTrainer(ICLTrainer):
             stochastic (bool, optional): If True, stochastic sampling is used for
                 predictions. Default is False.
             use_cache (bool, optional): If True, uses cached key values to improve
-                efficiency. Default is False.
+                efficiency. Ignored with an inference client, which does not return
+                the KV caches. Default is False.
             verbose (int, optional): Verbosity level for progress tracking.
                 Default is 0.
             if_true_mean_else_mode (bool, optional): Whether to use the true mean or
                 mode for prediction (only relevant if stochastic=False).
                 Default is False.
+            batch_features (Optional[bool], optional): Whether to process all the
+                features with a single batched forward pass of the LLM (no KV cache
+                is kept in that case). If None, the value given at initialization is
+                used. Ignored if the trainer has a prefix cache. Default is None.
 
         Returns:
             List[ICLObject]: A list of ICLObject instances with updated PDFs and
                 predictions for each feature.
         """
-        self.use_cache = use_cache
-        for dim in tqdm(
-            range(self.n_features), desc="icl / state dim", disable=not bool(verbose)
-        ):
-            PDF_list, _, kv_cache = calculate_multiPDF_llama3(
-                self.icl_object[dim].str_series,
+        # the KV caches are not returned by the inference server
+        self.use_cache = use_cache and self.inference_client is None
+        if batch_features is None:
+            batch_features = self.batch_features
+
+        outputs = self._calculate_PDFs(
+            [self._serialized_series(icl_object) for icl_object in self.icl_object],
+            temperature=temperature,
+            n_states=n_states,
+            batch=batch_features,
+            max_batch_tokens=self.max_batch_tokens,
+            verbose=verbose,
+        )
+        for dim, (PDF_list, kv_cache) in enumerate(outputs):
+            self.kv_cache[dim] = kv_cache
+            self._update_predictions(
+                self.icl_object[dim],
+                PDF_list,
+                stochastic=stochastic,
+                if_true_mean_else_mode=if_true_mean_else_mode,
+            )
+
+        return self.icl_object
+
+    def icl_batch(
+        self,
+        time_series_list: List[NDArray[np.float32]],
+        temperature: float = 1.0,
+        n_states: int = 1000,
+        stochastic: bool = False,
+        if_true_mean_else_mode: bool = False,
+        max_batch_tokens: Optional[int] = None,
+    ) -> List[List[ICLObject]]:
+        """
+        Performs ICL on several contexts (e.g. windows of different episodes) at
+        once: the features of all the contexts are packed into padded batches of the
+        LLM, and their statistics are computed.
+
+        Each context is rescaled with its own bounds (unless they are pinned). No KV
+        cache is kept, and the internal state is left to the last context.
+
+        Args:
+            time_series_list (List[NDArray[np.float32]]): The contexts, each of shape
+                (context_length, n_features).
+            temperature (float, optional): Sampling temperature for predictions.
+                Default is 1.0.
+            n_states (int, optional): Number of possible states for the PDF prediction.
+                Default is 1000.
+            stochastic (bool, optional): If True, stochastic sampling is used for
+                predictions. Default is False.
+            if_true_mean_else_mode (bool, optional): Whether to use the true mean or
+                mode for prediction (only relevant if stochastic=False).
+                Default is False.
+            max_batch_tokens (Optional[int], optional): Maximum number of (padded)
+                tokens per forward pass. If None, the value given at initialization
+                is used. Default is None.
+
+        Returns:
+            List[List[ICLObject]]: For each context, the ICLObject instances of its
+                features, with PDFs, predictions and statistics.
+        """
+        if max_batch_tokens is None:
+            max_batch_tokens = self.max_batch_tokens
+        self.use_cache = False
+
+        contexts = []
+        for time_series in time_series_list:
+            self.new_context()
+            self.update_context(
+                time_series=time_series,
+                mean_series=time_series,
+                sigma_series=np.zeros_like(time_series),
+                context_length=time_series.shape[0],
+            )
+            contexts.append(self.icl_object)
+
+        icl_objects = [icl_object for context in contexts for icl_object in context]
+        outputs = self._calculate_PDFs(
+            [self._serialized_series(icl_object) for icl_object in icl_objects],
+            temperature=temperature,
+            n_states=n_states,
+            batch=self.prefix_cache is None,
+            max_batch_tokens=max_batch_tokens,
+        )
+        for icl_object, (PDF_list, _) in zip(icl_objects, outputs):
+            self._update_predictions(
+                icl_object,
+                PDF_list,
+                stochastic=stochastic,
+                if_true_mean_else_mode=if_true_mean_else_mode,
+            )
+            self._compute_statistics(icl_object)
+        self.kv_cache = [None for _ in range(self.n_features)]
+        return contexts
+
+    def _calculate_PDFs(
+        self,
+        series_list: list,
+        temperature: float,
+        n_states: int,
+        batch: bool,
+        max_batch_tokens: Optional[int] = None,
+        verbose: int = 0,
+    ) -> list:
+        """
+        Computes the PDFs of serialized series with the LLM, batched or one at a
+        time (through the prefix cache if any) or on the inference server, reading and
+        filling the disk cache.
+
+        Returns:
+            list: One (PDF_list, kv_cache) tuple per series (kv_cache is None if not
+                computed).
+        """
+        outputs = [None for _ in series_list]
+        keys = [None for _ in series_list]
+        indices = list(range(len(series_list)))
+        if self.disk_cache is not None:
+            # the client exposes the identifiers of the model of the server
+            if self.inference_client is None:
+                model, restrict_vocab = self.model, self.restrict_vocab
+            else:
+                model = self.inference_client
+                restrict_vocab = self.inference_client.restrict_vocab
+            keys = [
+                self.disk_cache.key(
+                    model,
+                    self.tokenizer,
+                    series,
+                    temperature,
+                    n_states,
+                    restrict_vocab=restrict_vocab,
+                )
+                for series in series_list
+            ]
+            if not self.use_cache:
+                indices = []
+                for idx, key in enumerate(keys):
+                    probs = self.disk_cache.get(key)
+                    if probs is None:
+                        indices.append(idx)
+                    else:
+                        outputs[idx] = (PDF_list_from_probs(probs), None)
+
+        if self.inference_client is not None:
+            probs_list = self.inference_client.calculate_multiPDF_batch(
+                [series_list[idx] for idx in indices],
+                n_states=n_states,
+                temperature=temperature,
+            )
+            for idx, probs in zip(indices, probs_list):
+                self._store_probs(keys[idx], probs)
+                outputs[idx] = (PDF_list_from_probs(probs), None)
+            return outputs
+
+        if batch and self.prefix_cache is None:
+            batch_outputs = calculate_multiPDF_llama3_batch(
+                [series_list[idx] for idx in indices],
                 model=self.model,
                 tokenizer=self.tokenizer,
                 n_states=n_states,
                 temperature=temperature,
-                use_cache=self.use_cache,
+                max_batch_tokens=max_batch_tokens,
+                restrict_vocab=self.restrict_vocab,
+                device=self.device,
             )
-            self.kv_cache[dim] = kv_cache
+            for idx, (PDF_list, probs) in zip(indices, batch_outputs):
+                self._store_probs(keys[idx], probs[0].numpy())
+                outputs[idx] = (PDF_list, None)
+            return outputs
 
-            self.icl_object[dim].PDF_list = PDF_list
+        if self.prefix_cache is not None:
+            calculate_multiPDF = self.prefix_cache.calculate_multiPDF
+        else:
+            calculate_multiPDF = calculate_multiPDF_llama3
 
-            ts_min = self.icl_object[dim].rescaling_min
-            ts_max = self.icl_object[dim].rescaling_max
+        for idx in tqdm(indices, desc="icl / state dim", disable=not bool(verbose)):
+            PDF_list, probs, kv_cache = calculate_multiPDF(
+                series_list[idx],
+                model=self.model,
+                tokenizer=self.tokenizer,
+                n_states=n_states,
+                temperature=temperature,
+                use_cache=self.use_cache,
+                restrict_vocab=self.restrict_vocab,
+                device=self.device,
+            )
+            self._store_probs(keys[idx], probs[0].numpy())
+            outputs[idx] = (PDF_list, kv_cache)
+        return outputs
+
+    def _store_probs(self, key: Optional[str], probs: NDArray[np.float32]):
+        """Writes the probabilities of a context to the disk cache, if any."""
+        if self.disk_cache is not None:
+            self.disk_cache.put(key, probs)
+
+    @staticmethod
+    def _serialized_series(icl_object: ICLObject):
+        """Serialized context of a feature: token ids if available, else string."""
+        if icl_object.token_series is not None:
+            return icl_object.token_series
+        return icl_object.str_series
+
+    def _update_predictions(
+        self,
+        icl_object: ICLObject,
+        PDF_list: PDFBatch,
+        stochastic: bool = False,
+        if_true_mean_else_mode: bool = False,
+    ):
+        """
+        Stores the predicted PDFs of one feature together with the point predictions
+        (sample, mean or mode) mapped back to the original scale.
+        """
+        PDF_list = PDFBatch.from_PDFs(PDF_list)
+        icl_object.PDF_list = PDF_list
 
-            predictions = []
-            for timestep in range(len(PDF_list)):
-                PDF: "MultiResolutionPDF" = PDF_list[timestep]
-                PDF.compute_stats()
+        ts_min = icl_object.rescaling_min
+        ts_max = icl_object.rescaling_max
 
-                # Calculate the mode of the PDF
-                if stochastic:
-                    raw_state = np.random.choice(
-                        PDF.bin_center_arr,
-                        p=PDF.bin_height_arr / np.sum(PDF.bin_height_arr),
-                    )
-                else:
-                    raw_state = PDF.mean if if_true_mean_else_mode else PDF.mode
-                next_state = ((raw_state - self.up_shift) / self.rescale_factor) * (
-                    ts_max - ts_min
-                ) + ts_min
-                predictions.append(next_state)
+        if stochastic:
+            raw_states = PDF_list.sample(rng=self.rng)
+        else:
+            PDF_list.compute_stats()
+            raw_states = PDF_list.mean if if_true_mean_else_mode else PDF_list.mode
 
-            self.icl_object[dim].predictions = np.array(predictions)
+        icl_object.predictions = (
+            (raw_states - self.up_shift) / self.rescale_factor
+        ) * (ts_max - ts_min) + ts_min
 
-        return self.icl_object
+    def _predict_from_PDF(
+        self,
+        PDF: "MultiResolutionPDF",
+        ts_min: float,
+        ts_max: float,
+        stochastic: bool = False,
+        if_true_mean_else_mode: bool = False,
+    ) -> float:
+        """Point prediction (sample, mean or mode) of a PDF in the original scale."""
+        PDF.compute_stats()
+
+        # Calculate the mode of the PDF
+        if stochastic:
+            raw_state = PDF.bin_center_arr[
+                inverse_cdf_sample(
+                    (PDF.bin_height_arr * PDF.bin_width_arr)[None], rng=self.rng
+                )[0]
+            ]
+        else:
+            raw_state = PDF.mean if if_true_mean_else_mode else PDF.mode
+        return ((raw_state - self.up_shift) / self.rescale_factor) * (
+            ts_max - ts_min
+        ) + ts_min
 
     def compute_statistics(
         self,
+        statistics: Optional[List[str]] = None,
     ):
         """
         Computes statistics (mean, mode, and sigma) for the predicted PDFs in the
             internal state.
 
+        The statistics are computed in place from the bin height matrix of each
+        feature (no copy of the PDFs is made).
+
+        Args:
+            statistics (Optional[List[str]], optional): Subset of ["mean", "mode",
+                "sigma"] to compute, the others are left untouched. Default is None
+                (all of them).
+
         Returns:
             List[ICLObject]: A list of ICLObject instances with computed statistics for
                 each feature.
         """
-        for dim in range(self.n_features):
-            PDF_list = self.icl_object[dim].PDF_list
-
-            PDF_true_list = copy.deepcopy(PDF_list)
+        if statistics is None:
+            statistics = ["mean", "mode", "sigma"]
+        assert set(statistics) <= {
+            "mean",
+            "mode",
+            "sigma",
+        }, f"unknown statistics in {statistics}"
 
-            ### Extract statistics from MultiResolutionPDF
-            mean_arr = []
-            mode_arr = []
-            sigma_arr = []
-            for PDF, PDF_true, true_mean, true_sigma in zip(
-                PDF_list,
-                PDF_true_list,
-                self.icl_object[dim].rescaled_true_mean_arr,
-                self.icl_object[dim].rescaled_true_sigma_arr,
-            ):
-                PDF.compute_stats()
-                mean, mode, sigma = PDF.mean, PDF.mode, PDF.sigma
-
-                mean_arr.append(mean)
-                mode_arr.append(mode)
-                sigma_arr.append(sigma)
-
-            self.icl_object[dim].mean_arr = np.array(mean_arr)
-            self.icl_object[dim].mode_arr = np.array(mode_arr)
-            self.icl_object[dim].sigma_arr = np.array(sigma_arr)
+        for dim in range(self.n_features):
+            self._compute_statistics(self.icl_object[dim], statistics)
         return self.icl_object
 
+    @staticmethod
+    def _compute_statistics(
+        icl_object: ICLObject, statistics: Optional[List[str]] = None
+    ):
+        """Statistics of the PDFs of one feature, see compute_statistics."""
+        if statistics is None:
+            statistics = ["mean", "mode", "sigma"]
+        PDF_list = PDFBatch.from_PDFs(icl_object.PDF_list)
+        icl_object.PDF_list = PDF_list
+
+        bin_center_arr = PDF_list.bin_center_arr
+        bin_height_mat = PDF_list.bin_height_mat
+        if "mean" in statistics or "sigma" in statistics:
+            mean_arr = bin_height_mat @ (bin_center_arr * PDF_list.bin_width_arr)
+        if "mean" in statistics:
+            icl_object.mean_arr = mean_arr
+        if "mode" in statistics:
+            icl_object.mode_arr = bin_center_arr[np.argmax(bin_height_mat, axis=1)]
+        if "sigma" in statistics:
+            # Var = E[X^2] - E[X]^2, avoids a (n_PDFs, n_bins) temporary
+            second_moment_arr = bin_height_mat @ (
+                bin_center_arr**2 * PDF_list.bin_width_arr
+            )
+            icl_object.sigma_arr = np.sqrt(
+                np.maximum(second_moment_arr - mean_arr**2, 0.0)
+            )
+
     def predict_long_horizon_llm(
         self,
         prediction_horizon: int,
@@ -291,11 +670,17 @@ class MultiVariateICLTrainer(ICLTrainer):
         stochastic: bool = False,
         verbose: int = 0,
         if_true_mean_else_mode: bool = False,
+        use_cache: bool = True,
     ):
         """
         Predicts multiple steps into the future by autoregressively using previous
         predictions.
 
+        With use_cache=True, the per-feature KV cache of the context (see
+        `self.kv_cache`) is reused and only the tokens of the newly predicted value
+        are fed to the LLM at each step. Otherwise, or with an inference client, the
+        whole context is re-encoded at every step.
+
         Args:
             prediction_horizon (int): The number of future steps to predict.
             temperature (float, optional): Sampling temperature for predictions.
@@ -307,11 +692,23 @@ class MultiVariateICLTrainer(ICLTrainer):
             if_true_mean_else_mode (bool, optional): Whether to use the true mean or
                 mode for predictions (only relevant if stochastic=False).
                 Default is False.
+            use_cache (bool, optional): Whether to reuse the KV cache of the context
+                instead of re-encoding it at every step (ignored with an inference
+                client). Default is True.
 
         Returns:
             List[ICLObject]: A list of ICLObject instances with the predicted time
                 series and computed statistics.
         """
+        if use_cache and self.inference_client is None:
+            return self._predict_long_horizon_llm_cached(
+                prediction_horizon=prediction_horizon,
+                temperature=temperature,
+                stochastic=stochastic,
+                verbose=verbose,
+                if_true_mean_else_mode=if_true_mean_else_mode,
+            )
+
         last_prediction = copy.copy(
             np.concatenate(
                 [
@@ -365,3 +762,262 @@ class MultiVariateICLTrainer(ICLTrainer):
             )
 
         return self.compute_statistics()
+
+    def _predict_long_horizon_llm_cached(
+        self,
+        prediction_horizon: int,
+        temperature: float = 1.0,
+        stochastic: bool = False,
+        verbose: int = 0,
+        if_true_mean_else_mode: bool = False,
+    ):
+        """
+        Autoregressive rollout reusing the KV cache of each feature: the context is
+        encoded once and every step only feeds the tokens of the last prediction.
+        The internal state ends up identical to the one of the non-cached rollout.
+        """
+        if any(kv_cache is None for kv_cache in self.kv_cache):
+            # (re)build the cache of the context
+            self.icl(
+                temperature=temperature,
+                stochastic=stochastic,
+                use_cache=True,
+                if_true_mean_else_mode=if_true_mean_else_mode,
+                batch_features=False,
+                verbose=0,
+            )
+
+        settings = self._serializer_settings()
+        for _ in tqdm(
+            range(prediction_horizon),
+            desc="prediction_horizon",
+            disable=not bool(verbose),
+        ):
+            for dim in range(self.n_features):
+                icl_object = self.icl_object[dim]
+                ts_min = icl_object.rescaling_min
+                ts_max = icl_object.rescaling_max
+
+                last_prediction = icl_object.predictions[-1]
+                rescaled_prediction = (last_prediction - ts_min) / (
+                    ts_max - ts_min
+                ) * self.rescale_factor + self.up_shift
+                if icl_object.token_series is not None:
+                    new_series = serialize_arr_to_ids(
+                        np.array([rescaled_prediction]),
+                        settings,
+                        get_digit_token_table(
+                            self.tokenizer, time_sep=settings.time_sep
+                        ),
+                        add_special_tokens=False,
+                    )
+                    icl_object.token_series = np.concatenate(
+                        [icl_object.token_series, new_series]
+                    )
+                else:
+                    new_series = serialize_arr(
+                        np.array([rescaled_prediction]), settings
+                    )
+                    icl_object.str_series = icl_object.str_series + new_series
+
+                PDF, _, self.kv_cache[dim] = calculate_next_PDF_llama3(
+                    new_series,
+                    model=self.model,
+                    tokenizer=self.tokenizer,
+                    kv_cache_prev=self.kv_cache[dim],
+                    temperature=temperature,
+                    restrict_vocab=self.restrict_vocab,
+                    device=self.device,
+                )
+
+                icl_object.time_series = np.append(
+                    icl_object.time_series, last_prediction
+                )
+                icl_object.mean_series = np.append(
+                    icl_object.mean_series, last_prediction
+                )
+                icl_object.sigma_series = np.append(icl_object.sigma_series, 0.0)
+                icl_object.rescaled_true_mean_arr = np.append(
+                    icl_object.rescaled_true_mean_arr, rescaled_prediction
+                )
+                icl_object.rescaled_true_sigma_arr = np.append(
+                    icl_object.rescaled_true_sigma_arr, 0.0
+                )
+                icl_object.PDF_list.append(PDF)
+                icl_object.predictions = np.append(
+                    icl_object.predictions,
+                    self._predict_from_PDF(
+                        PDF,
+                        ts_min=ts_min,
+                        ts_max=ts_max,
+                        stochastic=stochastic,
+                        if_true_mean_else_mode=if_true_mean_else_mode,
+                    ),
+                )
+
+        self.context_length = len(self.icl_object[0].time_series)
+        return self.compute_statistics()
+
+    def sample_long_horizon_llm(
+        self,
+        prediction_horizon: int,
+        n_particles: int,
+        temperature: float = 1.0,
+        verbose: int = 0,
+    ) -> NDArray[np.float32]:
+        """
+        Samples trajectories of the features after the context, rolled out as one
+        batch of particles: the KV cache of the context is forked into
+        `n_particles` copies and every step feeds the sampled value of each
+        particle.
+
+        The first value of each trajectory is sampled from the last PDF of the
+        context and the `prediction_horizon` following ones are returned, which
+        matches the predicted steps of predict_long_horizon_llm. The batched
+        rollout requires the token ids encoding (use_token_ids) and a local model,
+        otherwise the particles are rolled out one after the other (re-encoding the
+        context at every step with an inference client, in which case the context
+        must already have been processed by icl). The internal state is left
+        untouched.
+
+        Args:
+            prediction_horizon (int): The number of future steps to predict.
+            n_particles (int): The number of sampled trajectories.
+            temperature (float, optional): Sampling temperature for predictions.
+                Default is 1.0.
+            verbose (int, optional): Verbosity level for progress tracking.
+                Default is 0.
+
+        Returns:
+            NDArray[np.float32]: The trajectories, of shape (n_particles,
+                prediction_horizon, n_features).
+        """
+        if self.inference_client is None and any(
+            kv_cache is None for kv_cache in self.kv_cache
+        ):
+            self.icl(
+                temperature=temperature,
+                stochastic=True,
+                use_cache=True,
+                batch_features=False,
+                verbose=0,
+            )
+
+        if self.inference_client is not None or not self.use_token_ids:
+            if self.inference_client is None:
+                warnings.warn(
+                    "Particles can only be rolled out as a batch with use_token_ids, "
+                    "falling back to sequential rollouts."
+                )
+            return self._sample_long_horizon_llm_sequential(
+                prediction_horizon=prediction_horizon,
+                n_particles=n_particles,
+                temperature=temperature,
+                verbose=verbose,
+            )
+
+        settings = self._serializer_settings()
+        token_table = get_digit_token_table(self.tokenizer, time_sep=settings.time_sep)
+        trajectories = np.empty((n_particles, prediction_horizon, self.n_features))
+        for dim in tqdm(
+            range(self.n_features),
+            desc="particles / state dim",
+            disable=not bool(verbose),
+        ):
+            icl_object = self.icl_object[dim]
+            PDF_list = icl_object.PDF_list
+            bin_idx = inverse_cdf_sample(
+                (PDF_list.bin_height_mat[-1] * PDF_list.bin_width_arr)[None],
+                n_samples=n_particles,
+                rng=self.rng,
+            )[0]
+            with torch.inference_mode():
+                kv_cache = copy.deepcopy(self.kv_cache[dim])
+            kv_cache.batch_repeat_interleave(n_particles)
+
+            raw_states = np.empty((n_particles, prediction_horizon))
+            for h in range(prediction_horizon):
+                new_ids_mat = np.stack(
+                    [
+                        token_table.value_token_ids[bin_idx],
+                        np.full(n_particles, token_table.time_sep_token_id),
+                    ],
+                    axis=1,
+                )
+                PDF_list, _, kv_cache = calculate_next_PDF_llama3_batch(
+                    new_ids_mat,
+                    model=self.model,
+                    tokenizer=self.tokenizer,
+                    kv_cache_prev=kv_cache,
+                    n_states=PDF_list.bin_height_mat.shape[1],
+                    temperature=temperature,
+                    restrict_vocab=self.restrict_vocab,
+                    device=self.device,
+                )
+                bin_idx = inverse_cdf_sample(
+                    PDF_list.bin_height_mat * PDF_list.bin_width_arr, rng=self.rng
+                )
+                raw_states[:, h] = PDF_list.bin_center_arr[bin_idx]
+            del kv_cache
+
+            ts_min = icl_object.rescaling_min
+            ts_max = icl_object.rescaling_max
+            trajectories[..., dim] = (
+                (raw_states - self.up_shift) / self.rescale_factor
+            ) * (ts_max - ts_min) + ts_min
+        return trajectories
+
+    def _sample_long_horizon_llm_sequential(
+        self,
+        prediction_horizon: int,
+        n_particles: int,
+        temperature: float = 1.0,
+        verbose: int = 0,
+    ) -> NDArray[np.float32]:
+        """
+        Fallback of sample_long_horizon_llm: one stochastic rollout per particle
+        (cached, unless there is an inference client), each starting from a copy of
+        the context state.
+        """
+        icl_object = self.icl_object
+        kv_cache = self.kv_cache
+        context_length = self.context_length
+
+        trajectories = np.empty((n_particles, prediction_horizon, self.n_features))
+        for particle in tqdm(
+            range(n_particles), desc="particles", disable=not bool(verbose)
+        ):
+            self.icl_object = copy.deepcopy(icl_object)
+            with torch.inference_mode():
+                self.kv_cache = copy.deepcopy(kv_cache)
+            # the first step is sampled independently for each particle
+            for dim_object in self.icl_object:
+                dim_object.predictions[-1] = self._predict_from_PDF(
+                    dim_object.PDF_list[len(dim_object.PDF_list) - 1],
+                    ts_min=dim_object.rescaling_min,
+                    ts_max=dim_object.rescaling_max,
+                    stochastic=True,
+                )
+            self.predict_long_horizon_llm(
+                prediction_horizon=prediction_horizon,
+                temperature=temperature,
+                stochastic=True,
+            )
+            for dim in range(self.n_features):
+                dim_object = self.icl_object[dim]
+                if self.inference_client is None:
+                    trajectory = dim_object.predictions[-prediction_horizon:]
+                else:
+                    # the re-encoded rollout resamples the predictions of the whole
+                    # context: the trajectory is the end of the extended series
+                    n_steps = len(dim_object.time_series)
+                    trajectory = np.append(
+                        dim_object.time_series[n_steps - prediction_horizon + 1 :],
+                        dim_object.predictions[-1],
+                    )
+                trajectories[particle, :, dim] = trajectory
+
+        self.icl_object = icl_object
+        self.kv_cache = kv_cache
+        self.context_length = context_length
+        return trajectories
@@ -850,7 +850,13 @@ class neural_bays_dx_tf(object):
             
         return ids
         
-    def get_ksd(self, thin_type, real = True):
+    def get_ksd(self, thin_type, real = True, estimator = 'exact', **estimator_kwargs):
+        """KSD of the latent samples and their regression targets.
+
+        estimator -- KSD estimator of ksd.estimate_KSD ('exact', 'incomplete', 'block', 'rff' or 'nystrom'), the
+                     approximate ones scale to the whole buffer
+        estimator_kwargs -- arguments of the estimator (e.g. num_pairs, num_features, num_landmarks)
+        """
         if real:
             #def thin_data_new(self, thin_type, thin_samples):
 
@@ -917,7 +923,7 @@ class neural_bays_dx_tf(object):
                 samples = smpl
                 gradients = grad
 
-                check_ksd = ksd.get_KSD(torch.Tensor(smpl), torch.Tensor(grad), kernel_type = 'rbf', h_method = 'dim')
+                check_ksd = ksd.estimate_KSD(torch.Tensor(smpl), torch.Tensor(grad), kernel_type = 'rbf', h_method = 'dim', estimator = estimator, **estimator_kwargs)
         else:
             #def thin_data_new(self, thin_type, thin_samples):
 
@@ -984,7 +990,7 @@ class neural_bays_dx_tf(object):
                 samples = smpl
                 gradients = grad
 
-                check_ksd = ksd.get_KSD(torch.Tensor(smpl), torch.Tensor(grad), kernel_type = 'rbf', h_method = 'dim')
+                check_ksd = ksd.estimate_KSD(torch.Tensor(smpl), torch.Tensor(grad), kernel_type = 'rbf', h_method = 'dim', estimator = estimator, **estimator_kwargs)
 
         return check_ksd
 
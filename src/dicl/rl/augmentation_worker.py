@@ -0,0 +1,139 @@
+"""
+Background worker for the ICL data augmentation of the SAC-DICL loop.
+
+The LLM inference runs in a thread (sharing the model with the main process)
+while the main loop keeps stepping the environment and updating the agent. Jobs
+are snapshots of windows of the replay buffer, submitted with the training step at
+which they were taken; results are collected by the main loop, which remains the
+only writer of the replay buffers.
+"""
+
+import queue
+import threading
+from typing import Any, Callable, List, Optional
+
+
+class AugmentationWorker:
+    """
+    Runs `job_fn` on the submitted jobs in a background thread.
+
+    Back-pressure: at most `max_pending` jobs wait for the worker, further jobs are
+    dropped (the main loop never blocks on the LLM). Staleness: the jobs and results
+    older than `max_staleness` training steps are discarded, since the policy that
+    collected their window is outdated by then.
+
+    Attributes:
+        n_submitted (int): Number of jobs accepted so far.
+        n_dropped (int): Number of jobs rejected because the queue was full.
+        n_stale (int): Number of jobs or results discarded because too old.
+        n_done (int): Number of results returned so far.
+    """
+
+    def __init__(
+        self,
+        job_fn: Callable[[Any], Any],
+        max_pending: int = 2,
+        max_staleness: Optional[int] = None,
+    ):
+        """
+        Args:
+            job_fn (Callable): Function computing the result of a job.
+            max_pending (int, optional): Maximum number of jobs waiting for the
+                worker (at least 1). Default is 2.
+            max_staleness (Optional[int], optional): Maximum age (in training steps)
+                of a job or result. If None, they never expire. Default is None.
+        """
+        if max_pending < 1:
+            # a Queue of maxsize 0 is unbounded, i.e. without back-pressure
+            raise ValueError(f"max_pending must be at least 1, got {max_pending}")
+        self.job_fn = job_fn
+        self.max_staleness = max_staleness
+        self.n_submitted = 0
+        self.n_dropped = 0
+        self.n_stale = 0
+        self.n_done = 0
+        self._step = 0
+        self._lock = threading.Lock()
+        self._jobs = queue.Queue(maxsize=max_pending)
+        self._results = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run, name="icl-augmentation", daemon=True
+        )
+        self._thread.start()
+
+    def _is_stale(self, job_step: int, step: int) -> bool:
+        return self.max_staleness is not None and step - job_step > self.max_staleness
+
+    def submit(self, step: int, job: Any) -> bool:
+        """
+        Queues a job without blocking.
+
+        Args:
+            step (int): Training step at which the job is created.
+            job (Any): Input of `job_fn`.
+
+        Returns:
+            bool: Whether the job was accepted (False if the queue is full).
+        """
+        self._step = step
+        try:
+            self._jobs.put_nowait((step, job))
+        except queue.Full:
+            self.n_dropped += 1
+            return False
+        self.n_submitted += 1
+        return True
+
+    def poll(self, step: int) -> List[Any]:
+        """
+        Collects the results available without blocking, and re-raises the
+        exceptions of the worker.
+
+        Args:
+            step (int): Current training step.
+
+        Returns:
+            List[Any]: The results that are not stale, in completion order.
+        """
+        self._step = step
+        results = []
+        while True:
+            try:
+                job_step, result = self._results.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(result, BaseException):
+                raise RuntimeError("the augmentation worker failed") from result
+            if self._is_stale(job_step, step):
+                with self._lock:
+                    self.n_stale += 1
+                continue
+            self.n_done += 1
+            results.append(result)
+        return results
+
+    def close(self, timeout: Optional[float] = None):
+        """Stops the worker after its current job, dropping the pending ones."""
+        while True:
+            try:
+                self._jobs.get_nowait()
+            except queue.Empty:
+                break
+        self._jobs.put(None)
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            item = self._jobs.get()
+            if item is None:
+                return
+            job_step, job = item
+            if self._is_stale(job_step, self._step):
+                with self._lock:
+                    self.n_stale += 1
+                continue
+            try:
+                result = self.job_fn(job)
+            except BaseException as error:  # forwarded to the main thread
+                result = error
+            self._results.put((job_step, result))
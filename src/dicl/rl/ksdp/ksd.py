@@ -10,18 +10,69 @@ def _row_get_pairwise_distances(base_point, A):
     """
     return torch.pow(base_point - A,2).sum(axis=1)
 
-def med_h(x):
-    raise NotImplementedError
-    pdist = _pairwise_distance(x)
+def med_h(x, max_samples=1000, generator=None):
+    """Median heuristic bandwidth: median of the squared pairwise distances between the points.
 
-    # https://stackoverflow.com/questions/43824665/tensorflow-median-value
-    lower = tfp.stats.percentile(pdist, 50.0, interpolation='lower')
-    higher = tfp.stats.percentile(pdist, 50.0, interpolation='higher')
+    arguments:
+    x -- n x d matrix of points
+    max_samples -- the median is computed on a random subset of max_samples points if there are more (O(max_samples^2) pairs)
+    generator -- torch.Generator (on the device of x) drawing the subset, defaults to the global generator
+    """
+    if x.shape[0] > max_samples:
+        x = x[torch.randperm(x.shape[0], generator=generator, device=x.device)[:max_samples]]
+    if x.shape[0] < 2:
+        return 1.0
+
+    #mean of the lower and higher medians
+    median = torch.quantile(torch.pdist(x)**2, 0.5, interpolation='midpoint')
 
-    median = (lower + higher) / 2.
-    median = tf.cast(median, tf.float32)
+    #duplicated points only
+    return float(median) if median > 0 else 1.0
 
-    return median
+class MedianSketch:
+    """Streaming estimate of the median of a stream of values (e.g. the squared distances between the points
+    added to a PruningContainer), from a reservoir sample of fixed size.
+
+    arguments:
+    size -- number of values kept
+    sliding -- if False, the reservoir is a uniform sample of the whole stream. If True, once it is full every new
+               value replaces a random slot, so that the sample forgets the old values (expected age of about size
+               values), which tracks a drifting stream
+    generator -- torch.Generator (on the device of the values) drawing the replaced slots, defaults to the global
+                 generator
+    """
+    def __init__(self, size=2048, sliding=False, generator=None):
+        self.size = size
+        self.sliding = sliding
+        self.generator = generator
+        self.reset()
+
+    def reset(self):
+        self.values = None
+        self.num_seen = 0
+
+    def update(self, values):
+        """Adds a batch of values to the stream (Algorithm R, vectorized)."""
+        values = values.reshape(-1)
+        if self.values is None:
+            self.values = values.new_empty(self.size)
+
+        positions = torch.arange(self.num_seen, self.num_seen + values.shape[0], device=values.device)
+        #the first values fill the reservoir
+        filling = positions < self.size
+        self.values[positions[filling]] = values[filling]
+        #then the t-th value replaces a random slot with probability size/(t+1) (or 1 if sliding)
+        slots = (torch.rand(positions.shape[0], generator=self.generator, device=values.device) * (self.size if self.sliding else positions + 1)).long()
+        replacing = ~filling & (slots < self.size)
+        self.values[slots[replacing]] = values[replacing]
+
+        self.num_seen += values.shape[0]
+
+    def median(self):
+        if self.num_seen == 0:
+            return None
+        median = torch.quantile(self.values[:min(self.num_seen, self.size)], 0.5, interpolation='midpoint')
+        return float(median) if median > 0 else 1.0
 
 def get_K_row(samples, gradients, kernel_type, h, index=-1):
     #assume last row is the new row
@@ -65,11 +116,91 @@ def get_K_row(samples, gradients, kernel_type, h, index=-1):
 
     return row
 
-def _get_h(samples,h_method):
+def _stein_kernel_terms(pdists, dim, kernel_type, h):
+    """Computes the kernel values k(r), the coefficients c(r) of grad_y k = c(r) (x-y) and the traces
+    tr(grad_x grad_y k) from the squared distances r.
+    """
+    if kernel_type == 'rbf':
+        kernel_values = torch.exp(-pdists / h)
+        grad_coeffs = (2 / h) * kernel_values
+        traces = kernel_values * (2 * dim / h - ((2 / h)**2) * pdists)
+
+    elif kernel_type == 'imq':
+
+        beta = -0.5
+        kernel_values = torch.pow(pdists + 1, beta)
+        grad_coeffs = -2 * beta * torch.pow(1 + pdists, beta - 1)
+        traces = -(2 * beta) * dim * torch.pow(1 + pdists, beta - 1) - 4 * beta * (beta - 1) * pdists * torch.pow(1 + pdists, beta - 2)
+
+    else:
+        raise NotImplementedError("Kernel {} not supported".format(kernel_type))
+
+    return kernel_values, grad_coeffs, traces
+
+def _stein_kernel_block(samples_a, gradients_a, samples_b, gradients_b, kernel_type, h):
+    """Computes the block of the Stein kernel matrix between the points of A (rows) and the points of B (columns) in closed form.
+
+    Same values as get_K_row, from the pairwise distance and inner-product matrices:
+    k_p(x_i,x_j) = <s_i,s_j> k + c(r) <s_i-s_j,x_i-x_j> + tr(grad_x grad_y k), where r = |x_i-x_j|^2 and grad_y k = c(r) (x_i-x_j).
+
+    arguments:
+    samples_a -- n_a x d matrix of points
+    gradients_a -- n_a x d matrix of the scores at samples_a
+    samples_b -- n_b x d matrix of points
+    gradients_b -- n_b x d matrix of the scores at samples_b
+    kernel_type -- 'rbf' or 'imq'
+    h -- bandwidth of the rbf kernel (unused for imq)
+    """
+    dim = samples_a.shape[1]
+
+    #the kernel is translation invariant, centering limits the cancellations of the expanded distances
+    center = samples_b.mean(0)
+    samples_a, samples_b = samples_a - center, samples_b - center
+
+    #in-place products, to keep the number of n_a x n_b temporaries low
+    pdists = ((samples_a**2).sum(1).unsqueeze(1) + (samples_b**2).sum(1).unsqueeze(0)).addmm_(samples_a, samples_b.T, alpha=-2).clamp_(min=0)
+
+    #<s_i-s_j,x_i-x_j>
+    cross = ((gradients_a * samples_a).sum(1).unsqueeze(1) + (gradients_b * samples_b).sum(1).unsqueeze(0)
+             ).addmm_(gradients_a, samples_b.T, alpha=-1).addmm_(samples_a, gradients_b.T, alpha=-1)
+
+    kernel_values, grad_coeffs, traces = _stein_kernel_terms(pdists, dim, kernel_type, h)
+
+    K_block = (gradients_a @ gradients_b.T).mul_(kernel_values)
+    return K_block.add_(cross.mul_(grad_coeffs)).add_(traces)
+
+def _stein_kernel_pairs(samples_a, gradients_a, samples_b, gradients_b, kernel_type, h):
+    """Computes the Stein kernel values k_p(a_i,b_i) of the pairs of rows of A and B (same closed form as
+    _stein_kernel_block).
+    """
+    pdiffs = samples_a - samples_b
+    pdists = (pdiffs**2).sum(1)
+    kernel_values, grad_coeffs, traces = _stein_kernel_terms(pdists, samples_a.shape[1], kernel_type, h)
+
+    return (gradients_a * gradients_b).sum(1) * kernel_values + ((gradients_a - gradients_b) * pdiffs).sum(1) * grad_coeffs + traces
+
+def _stein_kernel_diag(gradients, kernel_type, h):
+    """Computes the diagonal k_p(x_i,x_i) of the Stein kernel matrix, which only depends on the scores.
+
+    arguments:
+    gradients -- n x d matrix of the scores
+    kernel_type -- 'rbf' or 'imq'
+    h -- bandwidth of the rbf kernel (unused for imq)
+    """
+    dim = gradients.shape[1]
+    if kernel_type == 'rbf':
+        return (gradients**2).sum(1) + 2 * dim / h
+    elif kernel_type == 'imq':
+        beta = -0.5
+        return (gradients**2).sum(1) - 2 * beta * dim
+    else:
+        raise NotImplementedError("Kernel {} not supported".format(kernel_type))
+
+def _get_h(samples,h_method,generator=None):
     if h_method == 'dim':
         h = samples.shape[1]
     elif h_method == 'med':
-        h = _med_h(samples)
+        h = med_h(samples, generator=generator)
     else:
         raise NotImplementedError("Bandwith method {} not supported".format(h_method))
     return h
@@ -77,53 +208,271 @@ def _get_h(samples,h_method):
 def get_K_matrix(samples,
                  gradients,
                  kernel_type,
-                 h_method):
+                 h_method,
+                 block_size=None,
+                 h=None):
+    """Computes the n x n Stein kernel matrix.
 
-    rows = []
-    h = _get_h(samples=samples,h_method=h_method) if kernel_type=='rbf' else None
-
-    for i in range(samples.shape[0]):
+    arguments:
+    samples -- n x d matrix of points
+    gradients -- n x d matrix of the scores at the samples
+    kernel_type -- 'rbf' or 'imq'
+    h_method -- bandwidth method of the rbf kernel
+    block_size -- number of rows computed at once, which bounds the memory of the intermediate matrices (None: all at once)
+    h -- bandwidth of the rbf kernel, overrides h_method (e.g. the bandwidth of a PruningContainer)
+    """
+    if h is None:
+        h = _get_h(samples=samples,h_method=h_method) if kernel_type=='rbf' else None
 
-        rows.append(get_K_row(samples=samples[:i+1], gradients=gradients[:i+1], kernel_type=kernel_type, h=h))
-   
+    n = samples.shape[0]
+    if block_size is None or block_size >= n:
+        return _stein_kernel_block(samples, gradients, samples, gradients, kernel_type, h)
 
-    K_mat = rows[0].reshape(1,1)
-    for i,row in enumerate(rows[1:]):
-        K_mat = torch.cat([K_mat,row[:i+1].unsqueeze(0)])
-        K_mat = torch.cat([K_mat,row.unsqueeze(1)],dim=1)
+    K_mat = samples.new_empty((n,n))
+    for start in range(0,n,block_size):
+        stop = min(start+block_size,n)
+        K_mat[start:stop] = _stein_kernel_block(samples[start:stop], gradients[start:stop], samples, gradients, kernel_type, h)
 
     return K_mat
 
+def get_K_row_sums(samples,
+                   gradients,
+                   kernel_type,
+                   h,
+                   block_size=1024):
+    """Computes the row sums and the diagonal of the Stein kernel matrix one block of rows at a time, without
+    materializing it.
+
+    arguments:
+    samples -- n x d matrix of points
+    gradients -- n x d matrix of the scores at the samples
+    kernel_type -- 'rbf' or 'imq'
+    h -- bandwidth of the rbf kernel (unused for imq)
+    block_size -- number of rows computed at once
+    """
+    n = samples.shape[0]
+    row_sums = samples.new_empty(n)
+    for start in range(0,n,block_size):
+        stop = min(start+block_size,n)
+        row_sums[start:stop] = _stein_kernel_block(samples[start:stop], gradients[start:stop], samples, gradients, kernel_type, h).sum(dim=1)
+
+    return row_sums, _stein_kernel_diag(gradients, kernel_type, h)
+
+def _get_lower_row_sums(samples,
+                        gradients,
+                        kernel_type,
+                        h_method,
+                        block_size=None):
+    """Computes 2*sum_{j<=i} K_ij - K_ii for every row i of the Stein kernel matrix K, one block of rows at a time.
+
+    Only the lower triangle of K is computed and the matrix is never materialized, so that the peak memory is
+    O(block_size * n) instead of O(n^2).
+    """
+    h = _get_h(samples=samples,h_method=h_method) if kernel_type=='rbf' else None
+
+    n = samples.shape[0]
+    block_size = n if block_size is None else block_size
+    row_sums = samples.new_empty(n)
+    for start in range(0,n,block_size):
+        stop = min(start+block_size,n)
+        block = _stein_kernel_block(samples[start:stop], gradients[start:stop], samples[:stop], gradients[:stop], kernel_type, h)
+        diag = block[torch.arange(stop-start,device=block.device),torch.arange(start,stop,device=block.device)]
+        row_sums[start:stop] = 2.0*torch.tril(block,diagonal=start).sum(dim=1)-diag
+
+    return row_sums
+
 
 def get_KSD(samples,
             gradients,
             kernel_type,
-            h_method):
+            h_method,
+            block_size=1024):
     """Computes the Kernelized Stein Discrepancy 
     
+    block_size -- number of rows of the Stein kernel matrix computed at once, which bounds the peak memory (None: all at once)
     """
 
     num_samples = samples.shape[0]
-    print("NUM_SAMPLES ", num_samples)
-    K = get_K_matrix(samples=samples,
-                     gradients=gradients,
-                     kernel_type=kernel_type,
-                     h_method=h_method)
+    K_sums = _get_lower_row_sums(samples=samples,
+                                 gradients=gradients,
+                                 kernel_type=kernel_type,
+                                 h_method=h_method,
+                                 block_size=block_size)
 
-    return K.sum().sqrt() / num_samples
+    return K_sums.sum().sqrt() / num_samples
 
 def get_sequential_KSDs(samples,
                         gradients,
                         kernel_type,
-                        h_method):
+                        h_method,
+                        block_size=1024):
 
-    K= get_K_matrix(samples=samples,
-                 gradients=gradients,
-                 kernel_type=kernel_type,
-                 h_method=h_method)
-
-    K_sums = 2.0*torch.tril(K).sum(dim=1)-K.diag()
+    K_sums = _get_lower_row_sums(samples=samples,
+                                 gradients=gradients,
+                                 kernel_type=kernel_type,
+                                 h_method=h_method,
+                                 block_size=block_size)
 
     cum_sums = torch.cumsum(K_sums,dim=0)
 
     return [x for x in cum_sums.sqrt().divide(torch.arange(1,cum_sums.shape[0]+1).to(cum_sums.device))]
+
+def _from_offdiag_mean(offdiag_mean, diag, num_samples):
+    """KSD estimate from an estimate of the mean of the off-diagonal entries of the Stein kernel matrix and its
+    exact diagonal: sum(K)/n^2 = ((n-1) mean_{i!=j} K_ij + mean_i K_ii) / n, as in get_KSD.
+    """
+    ksd2 = ((num_samples - 1) * offdiag_mean + diag.mean()) / num_samples
+    #the off-diagonal estimates are unbiased but can be negative
+    return ksd2.clamp(min=0).sqrt()
+
+def get_incomplete_KSD(samples,
+                       gradients,
+                       kernel_type,
+                       h_method,
+                       num_pairs=None):
+    """Estimates get_KSD in O(num_pairs) from an incomplete U-statistic: the mean of the Stein kernel over
+    num_pairs random pairs of distinct samples.
+
+    arguments:
+    num_pairs -- number of pairs drawn (None: num_samples, i.e. linear time)
+    """
+    num_samples = samples.shape[0]
+    h = _get_h(samples=samples,h_method=h_method) if kernel_type=='rbf' else None
+    diag = _stein_kernel_diag(gradients, kernel_type, h)
+    if num_samples < 2:
+        return diag.sum().sqrt()
+
+    num_pairs = num_samples if num_pairs is None else num_pairs
+    first = torch.randint(num_samples, (num_pairs,), device=samples.device)
+    #uniform among the other samples
+    second = (first + torch.randint(1, num_samples, (num_pairs,), device=samples.device)) % num_samples
+    pairs = _stein_kernel_pairs(samples[first], gradients[first], samples[second], gradients[second], kernel_type, h)
+
+    return _from_offdiag_mean(pairs.mean(), diag, num_samples)
+
+def get_block_KSD(samples,
+                  gradients,
+                  kernel_type,
+                  h_method,
+                  block_size=256):
+    """Estimates get_KSD in O(num_samples * block_size) from the diagonal blocks of the Stein kernel matrix of
+    the shuffled samples: the mean of the off-diagonal entries of the blocks estimates the mean of all of them.
+
+    arguments:
+    block_size -- number of samples per block
+    """
+    num_samples = samples.shape[0]
+    h = _get_h(samples=samples,h_method=h_method) if kernel_type=='rbf' else None
+    diag = _stein_kernel_diag(gradients, kernel_type, h)
+    if num_samples < 2:
+        return diag.sum().sqrt()
+
+    permutation = torch.randperm(num_samples, device=samples.device)
+    samples = samples[permutation]
+    gradients = gradients[permutation]
+
+    offdiag_sum = 0.
+    num_pairs = 0
+    for start in range(0,num_samples,block_size):
+        stop = min(start+block_size,num_samples)
+        #a last block of one sample has no pair
+        if stop - start < 2:
+            continue
+        block = _stein_kernel_block(samples[start:stop], gradients[start:stop], samples[start:stop], gradients[start:stop], kernel_type, h)
+        offdiag_sum = offdiag_sum + block.sum() - block.diagonal().sum()
+        num_pairs += (stop - start) * (stop - start - 1)
+
+    return _from_offdiag_mean(offdiag_sum / num_pairs, diag, num_samples)
+
+def get_rff_KSD(samples,
+                gradients,
+                kernel_type,
+                h_method,
+                num_features=512,
+                block_size=4096):
+    """Estimates get_KSD for the rbf kernel in O(num_samples * num_features * d) with random Fourier features.
+
+    k(x,y) = exp(-|x-y|^2/h) = E_w[cos(w.x) cos(w.y) + sin(w.x) sin(w.y)] with w ~ N(0, 2/h I), so that the Stein
+    kernel is approximated by sum_f xi_f(x).xi_f(y) with xi_f = s phi_f + grad phi_f, and sum(K) by the squared norm
+    of sum_i xi(x_i).
+
+    arguments:
+    num_features -- number of frequencies w (each gives a cosine and a sine feature)
+    block_size -- number of samples whose features are computed at once
+    """
+    if kernel_type != 'rbf':
+        raise NotImplementedError("Random Fourier features only support the rbf kernel, not {} (use the 'nystrom' or 'block' estimator instead)".format(kernel_type))
+
+    num_samples, dim = samples.shape
+    h = _get_h(samples=samples,h_method=h_method)
+    samples = samples - samples.mean(0)
+
+    frequencies = torch.randn(num_features, dim, dtype=samples.dtype, device=samples.device) * (2 / h)**0.5
+    #sums over the samples of s cos(w.x) - sin(w.x) w and of s sin(w.x) + cos(w.x) w, num_features x d
+    cos_sum = samples.new_zeros((num_features, dim))
+    sin_sum = samples.new_zeros((num_features, dim))
+    for start in range(0,num_samples,block_size):
+        stop = min(start+block_size,num_samples)
+        projections = samples[start:stop] @ frequencies.T
+        cosines, sines = torch.cos(projections), torch.sin(projections)
+        cos_sum += cosines.T @ gradients[start:stop] - sines.sum(0).unsqueeze(1) * frequencies
+        sin_sum += sines.T @ gradients[start:stop] + cosines.sum(0).unsqueeze(1) * frequencies
+
+    return ((cos_sum**2).sum() + (sin_sum**2).sum()).div(num_features).sqrt() / num_samples
+
+def get_nystrom_KSD(samples,
+                    gradients,
+                    kernel_type,
+                    h_method,
+                    num_landmarks=256,
+                    block_size=1024,
+                    rcond=1e-6):
+    """Estimates get_KSD in O(num_samples * num_landmarks) with a Nystrom approximation K ~ K_nm K_mm^+ K_mn of
+    the Stein kernel matrix on random landmark samples: sum(K) ~ v^T K_mm^+ v where v are the row sums of K_mn.
+    K - K_nm K_mm^+ K_mn is positive semi-definite, so the estimate never exceeds the exact value.
+
+    arguments:
+    num_landmarks -- number of landmark samples
+    block_size -- number of columns of K_mn computed at once
+    rcond -- relative cutoff of the small eigenvalues of K_mm in the pseudo-inverse
+    """
+    num_samples = samples.shape[0]
+    h = _get_h(samples=samples,h_method=h_method) if kernel_type=='rbf' else None
+
+    landmarks = torch.randperm(num_samples, device=samples.device)[:num_landmarks]
+    landmark_samples, landmark_gradients = samples[landmarks], gradients[landmarks]
+
+    row_sums = samples.new_zeros(landmarks.shape[0])
+    for start in range(0,num_samples,block_size):
+        stop = min(start+block_size,num_samples)
+        row_sums += _stein_kernel_block(landmark_samples, landmark_gradients, samples[start:stop], gradients[start:stop], kernel_type, h).sum(dim=1)
+
+    K_mm = _stein_kernel_block(landmark_samples, landmark_gradients, landmark_samples, landmark_gradients, kernel_type, h)
+    ksd2 = row_sums @ torch.linalg.pinv(K_mm, rtol=rcond, hermitian=True) @ row_sums
+
+    return ksd2.clamp(min=0).sqrt() / num_samples
+
+KSD_ESTIMATORS = {
+    'exact': get_KSD,
+    'incomplete': get_incomplete_KSD,
+    'block': get_block_KSD,
+    'rff': get_rff_KSD,
+    'nystrom': get_nystrom_KSD,
+}
+
+def estimate_KSD(samples,
+                 gradients,
+                 kernel_type,
+                 h_method,
+                 estimator='exact',
+                 **kwargs):
+    """Computes the Kernelized Stein Discrepancy with one of the KSD_ESTIMATORS
+
+    arguments:
+    estimator -- 'exact' (get_KSD, O(n^2)), 'incomplete', 'block', 'rff' (rbf kernel only) or 'nystrom'
+    kwargs -- arguments of the estimator (e.g. num_pairs, block_size, num_features, num_landmarks)
+    """
+    if estimator not in KSD_ESTIMATORS:
+        raise NotImplementedError("KSD estimator {} not supported".format(estimator))
+
+    return KSD_ESTIMATORS[estimator](samples, gradients, kernel_type, h_method, **kwargs)
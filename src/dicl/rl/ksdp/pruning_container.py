@@ -2,36 +2,132 @@ import torch
 from . import ksd
 
 class PruningContainer:
-    def __init__(self,kernel_type,h_method,full_mat=True,*args,**kwargs):
+    """Points, gradients and KSD statistics of the thinned samples.
+
+    They are stored in preallocated buffers whose capacity doubles when full (amortized O(1) additions), and a
+    point is removed by moving the last point into its slot, so the order of the points (and of ids) is not
+    preserved. points, gradients, K_matrix, row_sums and ksd2_contrib are views of the active slots, with
+    ksd2_contrib = 2*row_sums - diag(K_matrix).
+
+    With the median heuristic (h_method='med'), the bandwidth h is fixed between refreshes so that the K rows can
+    be updated incrementally. The squared distances between each new point and pairs_per_point stored points feed
+    a sliding MedianSketch, and h is refreshed (and K rebuilt from scratch) when the median of the sketch differs from h
+    by more than h_tol (relative). The sketch is then reseeded with the pairs of the current points, since it
+    otherwise keeps the distances of the pruned points.
+
+    The random subsets of pairs are drawn from generator (a torch.Generator on the device of the points), or from the
+    global generator if it is None.
+    """
+    def __init__(self,kernel_type,h_method,full_mat=True,*args,capacity=64,h_tol=0.1,sketch_size=2048,pairs_per_point=64,generator=None,**kwargs):
 
         self.kernel_type = kernel_type
         self.h_method=h_method
         self.full_mat=full_mat
         self.ids = []
+        self.capacity=capacity
+        self.num_points=0
+        self._points=None
+        self._gradients=None
+        self._K_matrix=None
+        self._row_sums=None
+        self._ksd2_contrib=None
+
+        self.h=None
+        self.h_tol=h_tol
+        self.pairs_per_point=pairs_per_point
+        self.num_h_refreshes=0
+        self.generator=generator
+        self._median_sketch=ksd.MedianSketch(size=sketch_size,sliding=True,generator=generator) if h_method=='med' else None
+
+    def _bandwidth(self):
+        #bandwidth of the rbf kernel used by the K rows
+        if self.kernel_type!='rbf':
+            return None
+        if self.h_method=='med':
+            return self.h
+        return ksd._get_h(samples=self.points,h_method=self.h_method,generator=self.generator)
+
+    def _refresh_h(self):
+        #median heuristic on the current points, from a fresh sketch of their pairwise distances
+        self._median_sketch.reset()
+        points = self.points
+        #about sketch_size pairs
+        max_points = int((2*self._median_sketch.size)**0.5)+1
+        if points.shape[0]>max_points:
+            points = points[torch.randperm(points.shape[0],generator=self.generator,device=points.device)[:max_points]]
+        if points.shape[0]>1:
+            self._median_sketch.update(torch.pdist(points)**2)
+        self.h = self._median_sketch.median() or 1.0
+        self.num_h_refreshes += 1
+
+    def _h_is_stale(self):
+        #feed the sketch with the distances of the new (last) point and check the drift of the median
+        others = self.points[:-1]
+        if others.shape[0]>self.pairs_per_point:
+            others = others[torch.randint(others.shape[0],(self.pairs_per_point,),generator=self.generator,device=others.device)]
+        self._median_sketch.update(((others-self.points[-1])**2).sum(dim=1))
+        return abs(self._median_sketch.median()-self.h) > self.h_tol*self.h
+
+    @property
+    def points(self):
+        return self._points[:self.num_points]
+
+    @property
+    def gradients(self):
+        return self._gradients[:self.num_points]
+
+    @property
+    def K_matrix(self):
+        return self._K_matrix[:self.num_points,:self.num_points]
+
+    @property
+    def row_sums(self):
+        return self._row_sums[:self.num_points]
+
+    @property
+    def ksd2_contrib(self):
+        return self._ksd2_contrib[:self.num_points]
+
+    def _allocate(self, point, capacity):
+        #(re)allocate the buffers with the given capacity, keeping the active slots
+        n = self.num_points
+        old_buffers = (self._points,self._gradients,self._K_matrix,self._row_sums,self._ksd2_contrib)
+
+        self._points = point.new_empty((capacity,point.shape[0]))
+        self._gradients = point.new_empty((capacity,point.shape[0]))
+        self._K_matrix = point.new_empty((capacity,capacity)) if self.full_mat else None
+        self._row_sums = point.new_empty(capacity)
+        self._ksd2_contrib = point.new_empty(capacity)
+        self.capacity = capacity
+
+        if old_buffers[0] is not None:
+            self._points[:n] = old_buffers[0][:n]
+            self._gradients[:n] = old_buffers[1][:n]
+            if self.full_mat:
+                self._K_matrix[:n,:n] = old_buffers[2][:n,:n]
+            self._row_sums[:n] = old_buffers[3][:n]
+            self._ksd2_contrib[:n] = old_buffers[4][:n]
    
+    @torch.no_grad()
+    def _candidate_row_sums(self, candidate_points, candidate_gradients):
+        #Row sums of the K matrix of the container extended by each candidate: sum_j K(c,x_j) + K(c,c),
+        #computed for all the candidates at once from the candidate x container block
+        #the bandwidth of the container is shared by the candidates
+        h = self._bandwidth()
+        block = ksd._stein_kernel_block(candidate_points,candidate_gradients,self.points,self.gradients,self.kernel_type,h)
+
+        return block.sum(dim=1)+ksd._stein_kernel_diag(candidate_gradients,self.kernel_type,h)
+
     @torch.no_grad()
     def best_index(self, candidate_points, candidate_gradients):
         #Given an array of new points and gradients, select the KSD-optimal point
-      
-        row_sums = []
-        for candidate_point,candidate_gradient in zip(candidate_points,candidate_gradients):
-            stacked_points = torch.cat([self.points,candidate_point.unsqueeze(0)])
-            stacked_gradients= torch.cat([self.gradients,candidate_gradient.unsqueeze(0)])
-            h = ksd._get_h(stacked_points,self.h_method) if self.kernel_type=='rbf' else None
-            row_sums.append(ksd.get_K_row(samples=stacked_points,gradients=stacked_gradients,kernel_type=self.kernel_type,h=h).sum())
 
-        return torch.stack(row_sums).argmin()
+        return self._candidate_row_sums(candidate_points,candidate_gradients).argmin()
 
     def best_index_del(self, candidate_points, candidate_gradients):
         #Given an array of new points and gradients, select the KSD-optimal point
 
-        row_sums = []
-        for candidate_point,candidate_gradient in zip(candidate_points,candidate_gradients):
-            stacked_points = torch.cat([self.points,candidate_point.unsqueeze(0)])
-            stacked_gradients= torch.cat([self.gradients,candidate_gradient.unsqueeze(0)])
-            h = ksd._get_h(stacked_points,self.h_method) if self.kernel_type=='rbf' else None
-            row_sums.append(ksd.get_K_row(samples=stacked_points,gradients=stacked_gradients,kernel_type=self.kernel_type,h=h).sum())
-        beste = torch.stack(row_sums).argmin()
+        beste = self._candidate_row_sums(candidate_points,candidate_gradients).argmin()
         self.update_K_info(method='remove_row',removed_row_index=beste)  
         return beste
 
@@ -40,24 +136,20 @@ class PruningContainer:
     def add_point(self, point, gradient, global_id):
         #Add point and gradient to container and update K matrix
         
-        try:
-            assert hasattr(self,'points') and hasattr(self,'gradients') and hasattr(self,'ids') 
-            self.points = torch.cat([self.points,point.unsqueeze(0)])
-            self.gradients = torch.cat([self.gradients,gradient.unsqueeze(0)])
-            self.ids.append(global_id)
-            self.update_K_info(method='add_row')
-
-        except Exception as e:
-            
-            try:
-                assert not hasattr(self,'points') and not hasattr(self,'gradients') 
-            except:
-                raise e
+        if self._points is None:
             #pruning container not initialized, this is the first point
-            self.points = point.unsqueeze(0)
-            self.gradients = gradient.unsqueeze(0)
+            self._allocate(point,self.capacity)
+        elif self.num_points==self.capacity:
+            self._allocate(point,2*self.capacity)
+
+        self._points[self.num_points] = point
+        self._gradients[self.num_points] = gradient
+        self.num_points += 1
+        self.ids.append(global_id)
+        if self.num_points==1 or (self._median_sketch is not None and self.kernel_type=='rbf' and self._h_is_stale()):
             self.update_K_info(method="from_scratch")
-            self.ids = [global_id]
+        else:
+            self.update_K_info(method='add_row')
 
 
     @torch.no_grad()
@@ -72,44 +164,20 @@ class PruningContainer:
         #update KSD kernel matrix 
         #only supports adding one row or total recompute 
 
-        if self.h_method=="med":
-            raise ValueError("Can't update individual rows when using median heuristic, not supported for low-mem")
-
-
         if method=='add_row':
-            #if we update a row we should only have one new sample
-            assert self.ksd2_contrib.shape[0]==self.points.shape[0]-1
-            h = ksd._get_h(samples=self.points,h_method=self.h_method) if self.kernel_type=='rbf' else None
+            #the new sample is the last point
+            h = self._bandwidth()
             new_row = ksd.get_K_row(samples=self.points,gradients=self.gradients,kernel_type=self.kernel_type,h=h)
-         
-            assert new_row.shape[0] == self.ksd2_contrib.shape[0]+1 
-            #add new row contribution
-            self.ksd2_contrib = self.ksd2_contrib+2.0*new_row[:-1]
-            #add new row
-            new_row_sum = new_row.sum()
-            selfksd2_contrib = torch.cat([self.ksd2_contrib,(2.0*new_row_sum-new_row[-1]).reshape(1)])
-
-            self.row_sums += new_row[:-1]
-            self.row_sums = torch.cat([self.row_sums,new_row_sum.reshape(1)])
+            self._add_row_stats(new_row)
 
         elif method=='remove_row':
             if removed_row_index is None:
                 raise ValueError("To remove row, needs index value")
             #remove row corresponding to index
-            h = ksd._get_h(samples=self.points,h_method=self.h_method) if self.kernel_type=='rbf' else None
+            removed_row_index = int(removed_row_index)
+            h = self._bandwidth()
             removed_row = ksd.get_K_row(samples=self.points,gradients=self.gradients,kernel_type=self.kernel_type,h=h,index=removed_row_index)
-            
-            removed_row = removed_row.squeeze()
-
-            self.points = torch.cat([self.points[:removed_row_index],self.points[removed_row_index+1:]])
-            self.gradients = torch.cat([self.gradients[:removed_row_index],self.gradients[removed_row_index+1:]])
-          
-
-            self.ksd2_contrib = self.ksd2_contrib-removed_row
-            self.ksd2_contrib = torch.cat([self.ksd2_contrib[:removed_row_index],self.ksd2_contrib[removed_row_index+1:]]) 
-                
-            self.row_sums -= removed_row
-            self.row_sums = torch.cat([self.row_sums[:removed_row_index],self.row_sums[removed_row_index+1:]])
+            self._remove_row_stats(removed_row,removed_row_index)
             
         else:
             raise NotImplementedError("Method {} is not implemented for K matrix update".format(method))
@@ -119,73 +187,80 @@ class PruningContainer:
         #update KSD kernel matrix 
         #only supports adding one row or total recompute 
 
-        if self.h_method=="med":
-            try:
-                assert method=='from_scratch'
-            except:
-                raise ValueError("Can't update individual rows when using median heuristic")
-
+        n = self.num_points
         if method=='from_scratch':
-            self.K_matrix = ksd.get_K_matrix(samples=self.points,gradients=self.gradients,kernel_type=self.kernel_type,h_method=self.h_method)
-            row_sum = self.K_matrix.sum(dim=1)
-            diag = torch.diag(self.K_matrix)
+            if self._median_sketch is not None and self.kernel_type=='rbf':
+                self._refresh_h()
+            if self.full_mat:
+                K_matrix = ksd.get_K_matrix(samples=self.points,gradients=self.gradients,kernel_type=self.kernel_type,h_method=self.h_method,h=self._bandwidth())
+                self._K_matrix[:n,:n] = K_matrix
+                row_sum,diag = K_matrix.sum(dim=1),torch.diag(K_matrix)
+            else:
+                #the rows are summed block by block, K is not materialized
+                row_sum,diag = ksd.get_K_row_sums(samples=self.points,gradients=self.gradients,kernel_type=self.kernel_type,h=self._bandwidth())
 
-            self.row_sums = row_sum
-            self.ksd2_contrib = 2.0*row_sum-diag
-            if self.points.shape[0]==1:
-                self.ksd2_contrib = self.ksd2_contrib.reshape(1)
+            self._row_sums[:n] = row_sum
+            self._ksd2_contrib[:n] = 2.0*row_sum-diag
 
 
         elif method=='add_row':
-            #if e update a row we should only have one new sample
-            assert self.K_matrix.shape[0]==self.points.shape[0]-1
-            assert self.ksd2_contrib.shape[0]==self.points.shape[0]-1
-            h = ksd._get_h(samples=self.points,h_method=self.h_method) if self.kernel_type=='rbf' else None
+            #the new sample is the last point
+            h = self._bandwidth()
             new_row = ksd.get_K_row(samples=self.points,gradients=self.gradients,kernel_type=self.kernel_type,h=h)
          
-            assert new_row.shape[0] == self.K_matrix.shape[0]+1 
-            #add new row contribution
-            self.ksd2_contrib = self.ksd2_contrib+2.0*new_row[:-1]
-            #add new row
-            new_row_sum = new_row.sum()
-            self.ksd2_contrib = torch.cat([self.ksd2_contrib,(2.0*new_row_sum-new_row[-1]).reshape(1)])
-            
-            self.K_matrix = torch.cat([self.K_matrix,new_row[:-1].unsqueeze(0)])
-            self.K_matrix = torch.cat([self.K_matrix,new_row.unsqueeze(1)],dim=1)
-
-            self.row_sums += new_row[:-1]
-            self.row_sums = torch.cat([self.row_sums,new_row_sum.reshape(1)])
+            self._K_matrix[n-1,:n] = new_row
+            self._K_matrix[:n,n-1] = new_row
+            self._add_row_stats(new_row)
 
         elif method=='remove_row':
             #remove row corresponding to index
-
-            removed_row = self.K_matrix[removed_row_index].squeeze()
-            self.points = torch.cat([self.points[:removed_row_index],self.points[removed_row_index+1:]])
-            self.gradients = torch.cat([self.gradients[:removed_row_index],self.gradients[removed_row_index+1:]])
-          
-            #remove row 
-            self.K_matrix = torch.cat([self.K_matrix[:removed_row_index],self.K_matrix[removed_row_index+1:]])
-            #remove column
-            self.K_matrix = torch.cat([self.K_matrix[:,:removed_row_index],self.K_matrix[:,removed_row_index+1:]],dim=1)
-
-            self.ksd2_contrib = self.ksd2_contrib-removed_row
-            self.ksd2_contrib = torch.cat([self.ksd2_contrib[:removed_row_index],self.ksd2_contrib[removed_row_index+1:]]) 
-            
-            self.row_sums -= removed_row
-            self.row_sums = torch.cat([self.row_sums[:removed_row_index],self.row_sums[removed_row_index+1:]])
+            removed_row_index = int(removed_row_index)
+            removed_row = self.K_matrix[removed_row_index].clone()
+            self._remove_row_stats(removed_row,removed_row_index)
             
         else:
             raise NotImplementedError("Method {} is not implemented for K matrix update".format(method))
 
+    def _add_row_stats(self, new_row):
+        #in-place update of the statistics with the kernel row of the new (last) point
+        n = self.num_points
+        new_row_sum = new_row.sum()
+
+        #add new row contribution
+        self._ksd2_contrib[:n-1] += 2.0*new_row[:-1]
+        self._ksd2_contrib[n-1] = 2.0*new_row_sum-new_row[-1]
+
+        self._row_sums[:n-1] += new_row[:-1]
+        self._row_sums[n-1] = new_row_sum
+
+    def _remove_row_stats(self, removed_row, removed_row_index):
+        #in-place removal of the point at removed_row_index, whose slot is filled with the last point
+        n = self.num_points
+        last = n-1
+
+        self._row_sums[:n] -= removed_row
+        #the removed point is in both the row and the column of every other point
+        self._ksd2_contrib[:n] -= 2.0*removed_row
+
+        if removed_row_index!=last:
+            self._points[removed_row_index] = self._points[last]
+            self._gradients[removed_row_index] = self._gradients[last]
+            self._row_sums[removed_row_index] = self._row_sums[last]
+            self._ksd2_contrib[removed_row_index] = self._ksd2_contrib[last]
+            if self.full_mat:
+                #row first, then column (which also moves K[last,last] to the diagonal)
+                self._K_matrix[removed_row_index,:n] = self._K_matrix[last,:n]
+                self._K_matrix[:n,removed_row_index] = self._K_matrix[:n,last]
+            self.ids[removed_row_index] = self.ids[last]
+
+        self.ids.pop()
+        self.num_points -= 1
+
     @torch.no_grad()
     def get_ksd_squared(self):
 
-        #if the K matrix is not current recompute 
-        if self.points.shape[0]!=self.K_matrix.shape[0] and self.full_mat:
-            print("Called self.get_ksd without current K_matrix, recomputing")
-            self.update_K_info(method='from_scratch')
-
-        n = self.points.shape[0]
+        #row_sums is kept current by every update
+        n = self.num_points
        
         return self.row_sums.sum() / n**2
 
@@ -278,4 +353,4 @@ class PruningContainer:
                 pruned_ids.append(self.ids[least_influential_point])
                 self.update_K_info(method='remove_row',removed_row_index=least_influential_point)
 
-        return pruned_samples, pruned_id
+        return pruned_samples, pruned_ids
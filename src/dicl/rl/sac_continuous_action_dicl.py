@@ -1,5 +1,6 @@
 import warnings
 from typing import List, Dict, Any, Union
+import functools
 import os
 import random
 import time
@@ -26,6 +27,11 @@ from gymnasium import spaces
 from transformers import LlamaForCausalLM, AutoTokenizer
 
 from dicl import dicl
+from dicl.utils.icl import configure_cpu_inference, get_model_device
+from dicl.utils.inference_server import ICLInferenceClient
+from dicl.utils.prefix_cache import PrefixKVCache
+from dicl.utils.stub_llm import load_stub_llm
+from dicl.rl.augmentation_worker import AugmentationWorker
 
 import tensorflow.compat.v1 as tf
 from .tf_models.constructor import construct_shallow_model, construct_shallow_cost_model, construct_model, construct_cost_model
@@ -101,7 +107,9 @@ class Args:
     """frequency of policy-environment interactions (update frequency)"""
     # icl
     llm_model: str = "meta-llama/Llama-3.1-8B"
-    """the LLM used for in-context learning"""
+    """the LLM used for in-context learning ("stub": deterministic offline stub)"""
+    llm_stub_latency: float = 0.0
+    """latency (seconds) per forward pass of the stub LLM (llm_model="stub")"""
     method: str = "vicl"
     """the method used for in-context learning"""
     dicl_pca_n_components: int = -1
@@ -118,6 +126,35 @@ class Args:
     """frequency of learning for the LLM"""
     llm_batch_size: int = 25
     """batch size for the LLM"""
+    llm_batch_features: bool = False
+    """whether to process all the features in a single batched LLM forward pass"""
+    llm_token_ids: bool = False
+    """whether to encode the context directly into token ids (bypasses the tokenizer)"""
+    llm_restrict_vocab: bool = False
+    """whether to only compute the logits of the value tokens (lower memory)"""
+    llm_cpu_threads: int = 0
+    """number of torch threads for CPU inference of the LLM (0: torch default)"""
+    llm_quantize_int8: bool = False
+    """whether to dynamically quantize the LLM linear layers to int8 on CPU"""
+    llm_prefix_cache_mb: int = 0
+    """memory budget (MiB) of the KV caches shared across contexts (0: disabled)"""
+    llm_window_stride: int = 1
+    """stride of the grid of context starts within an episode (1: any timestep)"""
+    llm_server: str = ""
+    """socket of a local dicl inference server owning the LLM (empty: load it here),
+        authenticated with the DICL_LLM_AUTHKEY environment variable"""
+    llm_async: bool = False
+    """whether to run the LLM data augmentation in a background thread"""
+    llm_async_max_pending: int = 2
+    """maximum number of windows waiting for the background thread (>= 1, others
+        dropped)"""
+    llm_async_max_staleness: int = 1000
+    """maximum age (steps) of the windows and results of the background thread"""
+    llm_incremental_disentangler: bool = False
+    """whether to update the disentangler across ticks instead of refitting it
+        (defeats llm_prefix_cache_mb)"""
+    ksd_estimator: str = "exact"
+    """KSD estimator of the bayesian model ("incomplete", "block", "rff", "nystrom")"""
     train_only_from_llm: bool = False
     """whether to train only from the LLM"""
     min_episodes_to_start_icl: int = 5
@@ -306,6 +343,123 @@ def make_env(env_id, seed, idx, capture_video, run_name):
     return thunk
 
 
+def make_icl_job(rb, args, start_episode, end_episode, start_index):
+    """
+    Snapshot of the window of the replay buffer processed by an ICL tick (copied,
+    since the buffer keeps being written while the job waits or runs).
+    """
+    window = slice(start_index, start_index + args.context_length)
+    time_series = rb.observations[window]
+    if args.method == "dicl_sa_pca":
+        time_series = np.concatenate([time_series, rb.actions[window]], axis=-1)
+    job = {
+        "time_series": time_series.reshape((args.context_length, -1)).copy(),
+        "next_observations": rb.next_observations[
+            start_index : start_index + args.context_length - 1
+        ].copy(),
+        "actions": rb.actions[window].copy(),
+        "auxiliary_actions": rb.auxiliary_actions[window].copy(),
+        "rewards": rb.rewards[window].copy(),
+        "episode_series": None,
+    }
+    if args.llm_prefix_cache_mb > 0:
+        # the disentangler and the rescaling bounds are fitted on the whole episode
+        episode = slice(start_episode, end_episode + 1)
+        episode_series = rb.observations[episode]
+        if args.method == "dicl_sa_pca":
+            episode_series = np.concatenate(
+                [episode_series, rb.actions[episode]], axis=-1
+            )
+        job["episode_series"] = episode_series.reshape(
+            (episode_series.shape[0], -1)
+        ).copy()
+    return job
+
+
+def make_dicl(
+    args, n_features, model, tokenizer, prefix_cache, inference_client=None
+):
+    """
+    DICL model of the ICL ticks, built once and reused by all the jobs.
+    """
+    dicl_kwargs = dict(
+        n_features=n_features,
+        model=model,
+        tokenizer=tokenizer,
+        rescale_factor=args.rescale_factor,
+        up_shift=args.up_shift,
+        batch_features=args.llm_batch_features,
+        use_token_ids=args.llm_token_ids,
+        restrict_vocab=args.llm_restrict_vocab,
+        prefix_cache=prefix_cache,
+        inference_client=inference_client,
+    )
+    if args.method == "vicl":
+        return dicl.vICL(**dicl_kwargs)
+    elif args.method in ["dicl_s_pca", "dicl_sa_pca"]:
+        return dicl.DICL_PCA(
+            n_components=n_features
+            if args.dicl_pca_n_components == -1
+            else args.dicl_pca_n_components,
+            incremental=args.llm_incremental_disentangler,
+            **dicl_kwargs,
+        )
+    else:
+        raise ValueError(f"unknown method: {args.method}")
+
+
+def run_icl_job(job, args, DICL, n_observations):
+    """
+    Predicts the window of an ICL job with DICL and returns the synthetic
+    transitions to add to the LLM replay buffer.
+    """
+    time_series = job["time_series"]
+    fit_series = (
+        job["episode_series"] if job["episode_series"] is not None else time_series
+    )
+
+    DICL.reset_context()
+    if args.llm_incremental_disentangler:
+        DICL.partial_fit_disentangler(X=fit_series)
+    else:
+        DICL.fit_disentangler(X=fit_series)
+    if job["episode_series"] is not None:
+        DICL.pin_rescaling_bounds(X=job["episode_series"])
+    mean, mode, lb, ub = DICL.predict_single_step(X=time_series)
+
+    # compute threshold on the true error
+    true_errors = np.linalg.norm(
+        job["next_observations"].squeeze() - mean[:, :n_observations], axis=1
+    )
+    sorted_indices = true_errors.argsort()
+    n_to_keep = int(args.llm_percentage_to_keep * len(true_errors) / 100)
+    kept = np.sort(sorted_indices[:n_to_keep])
+    kept = kept[kept >= args.burnin_llm]
+
+    # new transitions created by llm prediction
+    return {
+        "observations": time_series[kept, :n_observations],
+        "next_observations": mean[kept, :n_observations],
+        "actions": job["auxiliary_actions"][kept]
+        if args.auxiliary_actions
+        else job["actions"][kept],
+        "rewards": job["rewards"][kept],
+    }
+
+
+def add_icl_transitions(rb_llm, transitions):
+    """Appends the synthetic transitions of an ICL job to the LLM replay buffer."""
+    for t in range(len(transitions["observations"])):
+        rb_llm.add(
+            transitions["observations"][t].reshape((1, -1)),
+            transitions["next_observations"][t].reshape((1, -1)),
+            transitions["actions"][t].reshape((1, -1)),
+            transitions["rewards"][t].reshape((1,)),
+            np.zeros((1,)),
+            {},  # llm_infos,
+        )
+
+
 # ALGO LOGIC: initialize agent here:
 class SoftQNetwork(nn.Module):
     def __init__(self, env):
@@ -459,22 +613,75 @@ def main():
     start_time = time.time()
 
     # ------------------------------ load model and tokenizer --------------------------
-    tokenizer = AutoTokenizer.from_pretrained(
-        args.llm_model,
-        use_fast=False,
-    )
-    model = LlamaForCausalLM.from_pretrained(
-        args.llm_model,
-        device_map="auto",
-        torch_dtype=torch.float16,
+    if args.llm_model == "stub":
+        # deterministic synthetic logits, to profile the pipeline without the LLM
+        model, tokenizer = load_stub_llm(latency=args.llm_stub_latency)
+    else:
+        tokenizer = AutoTokenizer.from_pretrained(
+            args.llm_model,
+            use_fast=False,
+        )
+    inference_client = None
+    if args.llm_server:
+        # the model is owned by a server shared by the runs of the machine
+        model = None
+        inference_client = ICLInferenceClient(args.llm_server)
+    elif args.llm_model != "stub":
+        model = LlamaForCausalLM.from_pretrained(
+            args.llm_model,
+            device_map="auto",
+            torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
+        )
+        model.eval()
+        if get_model_device(model).type == "cpu":
+            model = configure_cpu_inference(
+                model, n_threads=args.llm_cpu_threads, quantize=args.llm_quantize_int8
+            )
+    # the contexts are only serialized identically across ticks if the disentangler
+    # and the rescaling bounds are fitted on the whole episode (see below)
+    prefix_cache = (
+        PrefixKVCache(max_bytes=args.llm_prefix_cache_mb * 1024**2)
+        if args.llm_prefix_cache_mb > 0
+        else None
     )
-    model.eval()
+    if prefix_cache is not None and args.llm_incremental_disentangler:
+        # pinning the rescaling bounds does not help: the transformed series change
+        warnings.warn(
+            "llm_incremental_disentangler updates the disentangler at every tick, "
+            "hence the serialization of the whole contexts: the prefix cache "
+            "(llm_prefix_cache_mb) will hardly ever be hit."
+        )
     # ----------------------------------------------------------------------------------
 
     # ----------- define n_observations and n_actions -----------
     n_observations = envs.single_observation_space.shape[0]
     action_shape = envs.single_action_space.shape[0]
 
+    icl_dicl = make_dicl(
+        args,
+        n_features=n_observations + action_shape
+        if args.method == "dicl_sa_pca"
+        else n_observations,
+        model=model,
+        tokenizer=tokenizer,
+        prefix_cache=prefix_cache,
+        inference_client=inference_client,
+    )
+    icl_job_fn = functools.partial(
+        run_icl_job, args=args, DICL=icl_dicl, n_observations=n_observations
+    )
+    augmentation_worker = (
+        AugmentationWorker(
+            icl_job_fn,
+            max_pending=args.llm_async_max_pending,
+            max_staleness=args.llm_async_max_staleness
+            if args.llm_async_max_staleness > 0
+            else None,
+        )
+        if args.llm_async
+        else None
+    )
+
 
     dx_model = construct_shallow_model(obs_dim=n_observations, act_dim=action_shape, hidden_dim=200, num_networks=1, num_elites=1)
     #print("BEFORE NEURAL BAYS")
@@ -648,103 +855,43 @@ def main():
                         )
                     random_idx = np.random.randint(0, len(possible_episodes))
                     start_episode = int(possible_episodes[random_idx])
+                    end_episode = int(possible_episodes_endings[random_idx])
                     start_index = int(
                         np.random.randint(
                             start_episode,
-                            possible_episodes_endings[random_idx]
-                            - args.context_length
-                            - 1,
+                            end_episode - args.context_length - 1,
                         )
                     )
-                    # 1.2. Do ICL
-                    if args.method == "vicl":
-                        time_series = rb.observations[
-                            start_index : start_index + args.context_length
-                        ]
-                        time_series = time_series.reshape((args.context_length, -1))
-                        DICL = dicl.vICL(
-                            n_features=time_series.shape[1],
-                            model=model,
-                            tokenizer=tokenizer,
-                            rescale_factor=args.rescale_factor,
-                            up_shift=args.up_shift,
-                        )
-                    elif args.method == "dicl_s_pca":
-                        time_series = rb.observations[
-                            start_index : start_index + args.context_length
-                        ]
-                        time_series = time_series.reshape((args.context_length, -1))
-                        DICL = dicl.DICL_PCA(
-                            n_components=time_series.shape[1]
-                            if args.dicl_pca_n_components == -1
-                            else args.dicl_pca_n_components,
-                            n_features=time_series.shape[1],
-                            model=model,
-                            tokenizer=tokenizer,
-                            rescale_factor=args.rescale_factor,
-                            up_shift=args.up_shift,
-                        )
-                    elif args.method == "dicl_sa_pca":
-                        time_series = np.concatenate(
-                            [
-                                rb.observations[
-                                    start_index : start_index + args.context_length
-                                ],
-                                rb.actions[
-                                    start_index : start_index + args.context_length
-                                ],
-                            ],
-                            axis=-1,
+                    # snap to the grid so that contexts repeat across ticks
+                    start_index -= (
+                        start_index - start_episode
+                    ) % args.llm_window_stride
+                    # 1.2. Do ICL (in the background thread if enabled)
+                    icl_job = make_icl_job(
+                        rb, args, start_episode, end_episode, start_index
+                    )
+                    if augmentation_worker is not None:
+                        augmentation_worker.submit(global_step + local_step, icl_job)
+                    else:
+                        # 2. Append transformed transitions to augmented rb
+                        add_icl_transitions(rb_llm, icl_job_fn(icl_job))
+                    if prefix_cache is not None:
+                        writer.add_scalar(
+                            "charts/llm_prefix_cache_reused_tokens",
+                            prefix_cache.n_reused_tokens,
+                            global_step,
                         )
-                        time_series = time_series.reshape((args.context_length, -1))
-                        DICL = dicl.DICL_PCA(
-                            n_components=time_series.shape[1]
-                            if args.dicl_pca_n_components == -1
-                            else args.dicl_pca_n_components,
-                            n_features=time_series.shape[1],
-                            model=model,
-                            tokenizer=tokenizer,
-                            rescale_factor=args.rescale_factor,
-                            up_shift=args.up_shift,
+                        writer.add_scalar(
+                            "charts/llm_prefix_cache_computed_tokens",
+                            prefix_cache.n_computed_tokens,
+                            global_step,
                         )
-
-                    DICL.fit_disentangler(X=time_series)
-                    mean, mode, lb, ub = DICL.predict_single_step(X=time_series)
-
-                    # compute threshold on the true error
-                    all_groundtruth = rb.next_observations[
-                        start_index : start_index + args.context_length - 1
-                    ]
-
-                    true_errors = np.linalg.norm(
-                        all_groundtruth.squeeze() - mean[:, :n_observations], axis=1
-                    )
-
-                    sorted_indices = true_errors.argsort()
-                    n_to_keep = int(
-                        args.llm_percentage_to_keep * len(true_errors) / 100
-                    )
-
-                    for t in range(args.burnin_llm, args.context_length):
-                        if t in sorted_indices[:n_to_keep]:
-                            # 1.3. New transition created by llm prediction
-                            llm_next_obs = mean[t, :n_observations].reshape((1, -1))
-                            llm_obs = time_series[t, :n_observations].reshape((1, -1))
-                            llm_actions = rb.actions[start_index + t].reshape((1, -1))
-                            llm_rewards = rb.rewards[start_index + t].reshape((1,))
-                            llm_terminations = np.zeros((1,))
-
-                            # 2. Append transformed transition to augmented rb
-                            rb_llm.add(
-                                llm_obs,
-                                llm_next_obs,
-                                rb.auxiliary_actions[start_index + t]
-                                if args.auxiliary_actions
-                                else llm_actions,
-                                llm_rewards,
-                                llm_terminations,
-                                {},  # llm_infos,
-                            )
+                if augmentation_worker is not None:
+                    # 2. Append the transitions computed in the background
+                    for icl_transitions in augmentation_worker.poll(
+                        global_step + local_step
+                    ):
+                        add_icl_transitions(rb_llm, icl_transitions)
 
                 batches_to_train_on = [copy.copy(data)]
                 coeff_batches_to_train_on = [1.0]
@@ -762,7 +909,7 @@ def main():
                     my_dx.train(100)
                     my_dx.generate_latent_z(True)
                     post_var = my_dx.update_bays_reg()
-                    ksd_val = my_dx.get_ksd('ksd')
+                    ksd_val = my_dx.get_ksd('ksd', estimator=args.ksd_estimator)
                 if ((global_step + local_step)%1 == 0):
                             #pdb.set_trace()
                             newiter = True
@@ -988,7 +1135,18 @@ def main():
                         writer.add_scalar(
                             "losses/alpha_loss", alpha_loss.item(), global_step
                         )
+                    if augmentation_worker is not None:
+                        for name in ["n_submitted", "n_dropped", "n_stale", "n_done"]:
+                            writer.add_scalar(
+                                f"charts/llm_worker_{name}",
+                                getattr(augmentation_worker, name),
+                                global_step,
+                            )
                 local_step += 1
+    if augmentation_worker is not None:
+        augmentation_worker.close()
+    if inference_client is not None:
+        inference_client.close()
     pbar.close()
     envs.close()
     writer.close()
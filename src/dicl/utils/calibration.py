@@ -1,6 +1,5 @@
-from typing import TYPE_CHECKING, Any, Callable
-
-import copy
+from typing import TYPE_CHECKING, Any, Callable, Optional, Tuple
+import warnings
 
 import numpy as np
 from numpy.typing import NDArray
@@ -8,6 +7,9 @@ from numpy.typing import NDArray
 from scipy.stats import uniform
 from scipy.special import kolmogorov
 from scipy.stats import kstwobign
+from scipy.sparse import csr_matrix
+
+from dicl.utils.icl import PDFBatch
 
 if TYPE_CHECKING:
     from dicl.icl.iclearner import ICLObject
@@ -24,6 +26,8 @@ def compute_ks_metric(
     up_shift: float = 1.5,
     rescale_factor: float = 7.0,
     burnin: int = 0,
+    rng: Optional[np.random.Generator] = None,
+    analytic: bool = False,
 ):
     """
     Computes the Kolmogorov-Smirnov (KS) metric between the predicted and ground truth
@@ -44,6 +48,16 @@ def compute_ks_metric(
             Default is 7.0.
         burnin (int, optional): Number of initial time steps to exclude from the metric
             computation. Default is 0.
+        rng (Optional[np.random.Generator], optional): Random generator used to draw
+            the traces. If None, the global NumPy random state is used.
+            Default is None.
+        analytic (bool, optional): If True, the quantiles are computed from the CDFs
+            of the predicted PDFs instead of being estimated from sampled traces.
+            This requires `inverse_transform` to be affine: each feature is a
+            linear combination of the (independent) components and its CDF is
+            obtained by convolving the PDFs of the components (exactly read from the
+            PDF if the map is diagonal). Otherwise, the quantiles are estimated from
+            sampled traces, with a warning. Default is False.
 
     Returns:
         Tuple[NDArray, NDArray]:
@@ -52,52 +66,294 @@ def compute_ks_metric(
     """
 
     n_samples = len(icl_object[0].PDF_list)
+    if not 0 <= burnin < n_samples:
+        raise ValueError(
+            f"burnin ({burnin}) must be in [0, {n_samples}) (number of predictions)"
+        )
+    # explicit start, groundtruth[-0:] would be the whole array
+    groundtruth = groundtruth[len(groundtruth) - (n_samples - burnin) :]
 
-    kss = np.zeros((n_features,))
-    ks_quantiles = np.zeros((n_features, n_samples - burnin))
-    predictions = np.empty((n_samples - burnin, n_traces, n_components))
-    for dim in range(n_components):
-        for t in range(n_samples - burnin):
-            PDF = icl_object[dim].PDF_list[burnin + t]
+    if analytic:
+        affine_map = extract_affine_map(inverse_transform, n_components)
+        if affine_map is None:
+            # the per-feature CDFs need a monotonic map of each component
+            warnings.warn(
+                "inverse_transform is not affine, falling back to Monte-Carlo "
+                "estimation of the KS quantiles."
+            )
+            analytic = False
+
+    if analytic:
+        if not _is_diagonal(affine_map[0]):
+            quantiles = linear_pdf_cdf_quantiles(
+                groundtruth=groundtruth,
+                icl_object=icl_object,
+                n_components=n_components,
+                affine_map=affine_map,
+                up_shift=up_shift,
+                rescale_factor=rescale_factor,
+                burnin=burnin,
+            )
+        else:
+            quantiles = pdf_cdf_quantiles(
+                groundtruth=groundtruth,
+                icl_object=icl_object,
+                n_components=n_components,
+                inverse_transform=inverse_transform,
+                up_shift=up_shift,
+                rescale_factor=rescale_factor,
+                burnin=burnin,
+            )
+    else:
+        predictions = np.empty((n_samples - burnin, n_traces, n_components))
+        for dim in range(n_components):
+            PDF_list = PDFBatch.from_PDFs(icl_object[dim].PDF_list)[burnin:]
 
             ts_min = icl_object[dim].rescaling_min
             ts_max = icl_object[dim].rescaling_max
 
-            bin_center_arr = ((PDF.bin_center_arr - up_shift) / rescale_factor) * (
+            samples = PDF_list.sample(n_samples=n_traces, rng=rng)
+            predictions[:, :, dim] = ((samples - up_shift) / rescale_factor) * (
                 ts_max - ts_min
             ) + ts_min
-            bin_height_arr = PDF.bin_height_arr / np.sum(PDF.bin_height_arr)
 
-            samples = np.random.choice(
-                bin_center_arr,
-                p=bin_height_arr,
-                size=(n_traces,),
-            )
+        predictions = inverse_transform(predictions.reshape(-1, n_components)).reshape(
+            (n_samples - burnin, n_traces, n_features)
+        )
 
-            predictions[t, :, dim] = copy.copy(samples)
+        # fraction of the traces below the ground truth, per time step and feature
+        quantiles = (groundtruth[:, None, :] > predictions).sum(axis=1) / n_traces
 
-    predictions = inverse_transform(predictions.reshape(-1, n_components)).reshape(
-        (n_samples - burnin, n_traces, n_features)
-    )
+    # Compute KS metric
+    ks_quantiles = np.sort(quantiles, axis=0).T
+    uniform_quantiles = np.arange(ks_quantiles.shape[1]) / ks_quantiles.shape[1]
+    kss = np.max(np.abs(ks_quantiles - uniform_quantiles), axis=1)
+
+    return kss, ks_quantiles
+
+
+def pdf_cdf_quantiles(
+    groundtruth: NDArray,
+    icl_object: "ICLObject",
+    n_components: int,
+    inverse_transform: Callable,
+    up_shift: float = 1.5,
+    rescale_factor: float = 7.0,
+    burnin: int = 0,
+):
+    """
+    Computes the quantiles of the ground truth (probability integral transform) from
+    the CDFs of the predicted PDFs, without sampling.
 
-    for dim in range(n_features):
-        per_dim_groundtruth = groundtruth[:, dim].flatten()
+    The bin edges of the PDFs are mapped to the original space with a single call to
+    `inverse_transform`, hence the latter must map each component to the feature of
+    the same index with a monotonic function. Within a bin, the CDF is linear.
 
-        # Compute quantiles
-        quantiles = np.sort(
-            np.array(
-                [g > m for g, m in zip(per_dim_groundtruth, predictions[:, :, dim])]
-            ).sum(axis=1)
+    Args:
+        groundtruth (NDArray): The ground truth values, of shape
+            (n_samples - burnin, n_features).
+        icl_object (ICLObject): The ICL object containing predicted PDFs.
+        n_components (int): Number of components (equal to the number of features).
+        inverse_transform (Callable): A function to inverse-transform the predictions to
+            the time series oiginal space.
+        up_shift (float, optional): Up-shift value applied during rescaling.
+            Default is 1.5.
+        rescale_factor (float, optional): Rescale factor applied during normalization.
+            Default is 7.0.
+        burnin (int, optional): Number of initial time steps to exclude.
+            Default is 0.
+
+    Returns:
+        NDArray: Quantiles of shape (n_samples - burnin, n_features).
+    """
+    PDF_lists = [
+        PDFBatch.from_PDFs(icl_object[dim].PDF_list)[burnin:]
+        for dim in range(n_components)
+    ]
+
+    # bin edges of every component, in the space of the components
+    edges = []
+    for dim, PDF_list in enumerate(PDF_lists):
+        ts_min = icl_object[dim].rescaling_min
+        ts_max = icl_object[dim].rescaling_max
+        rescaled_edges = np.append(
+            PDF_list.bin_center_arr - PDF_list.bin_width_arr / 2,
+            PDF_list.bin_center_arr[-1] + PDF_list.bin_width_arr[-1] / 2,
         )
-        quantiles = quantiles / n_traces
+        edges.append(
+            ((rescaled_edges - up_shift) / rescale_factor) * (ts_max - ts_min) + ts_min
+        )
+    edges = inverse_transform(np.stack(edges, axis=1))
 
-        # Compute KS metric
-        kss[dim] = np.max(
-            np.abs(quantiles - (np.arange(len(quantiles)) / len(quantiles)))
+    quantiles = np.empty(groundtruth.shape)
+    for dim, PDF_list in enumerate(PDF_lists):
+        edge_arr = edges[:, dim]
+        prob_mat = PDF_list.bin_height_mat * PDF_list.bin_width_arr
+        prob_mat = prob_mat / prob_mat.sum(axis=1, keepdims=True)
+        if edge_arr[-1] < edge_arr[0]:  # decreasing map
+            edge_arr = edge_arr[::-1]
+            prob_mat = prob_mat[:, ::-1]
+        # CDF at the bin edges
+        cdf_mat = np.concatenate(
+            [np.zeros((len(prob_mat), 1)), np.cumsum(prob_mat, axis=1)], axis=1
         )
-        ks_quantiles[dim, :] = quantiles
 
-    return kss, ks_quantiles
+        rows = np.arange(len(prob_mat))
+        bin_idx = np.clip(
+            np.searchsorted(edge_arr, groundtruth[:, dim], side="right"),
+            1,
+            len(edge_arr) - 1,
+        )
+        left_edge_arr = edge_arr[bin_idx - 1]
+        frac = np.clip(
+            (groundtruth[:, dim] - left_edge_arr) / (edge_arr[bin_idx] - left_edge_arr),
+            0.0,
+            1.0,
+        )
+        quantiles[:, dim] = cdf_mat[rows, bin_idx - 1] + frac * (
+            cdf_mat[rows, bin_idx] - cdf_mat[rows, bin_idx - 1]
+        )
+    return quantiles
+
+
+def extract_affine_map(
+    func: Callable, n_inputs: int, n_checks: int = 8, rtol: float = 1e-6
+) -> Optional[Tuple[NDArray, NDArray]]:
+    """
+    Extracts (A, b) such that func(Y) = Y @ A.T + b, by evaluating `func` on the
+    origin and on the canonical basis, and checks the decomposition on random points.
+
+    Args:
+        func (Callable): A function mapping arrays of shape (n, n_inputs) to arrays of
+            shape (n, n_outputs), e.g. the inverse transform of a disentangler.
+        n_inputs (int): Number of inputs of `func`.
+        n_checks (int, optional): Number of random points on which the decomposition
+            is checked. Default is 8.
+        rtol (float, optional): Relative tolerance of the check. Default is 1e-6.
+
+    Returns:
+        Optional[Tuple[NDArray, NDArray]]: The matrix A of shape (n_outputs, n_inputs)
+            and the offset b of shape (n_outputs,), or None if `func` is not affine.
+    """
+    points = np.concatenate([np.zeros((1, n_inputs)), np.eye(n_inputs)], axis=0)
+    values = func(points)
+    b = values[0]
+    A = (values[1:] - b).T
+
+    test_points = np.random.default_rng(0).normal(size=(n_checks, n_inputs))
+    test_values = func(test_points)
+    scale = np.max(np.abs(test_values)) + np.max(np.abs(b))
+    if not np.allclose(test_points @ A.T + b, test_values, rtol=0, atol=rtol * scale):
+        return None
+    return A, b
+
+
+def _is_diagonal(A: NDArray) -> bool:
+    """Whether A is square with (numerically) zero off-diagonal terms."""
+    if A.shape[0] != A.shape[1]:
+        return False
+    off_diagonal = A - np.diag(np.diag(A))
+    return bool(np.all(np.abs(off_diagonal) <= 1e-12 * np.max(np.abs(A))))
+
+
+def linear_pdf_cdf_quantiles(
+    groundtruth: NDArray,
+    icl_object: "ICLObject",
+    n_components: int,
+    affine_map: Tuple[NDArray, NDArray],
+    up_shift: float = 1.5,
+    rescale_factor: float = 7.0,
+    burnin: int = 0,
+    n_grid: int = 4096,
+):
+    """
+    Computes the quantiles of the ground truth (probability integral transform) when
+    the features are affine combinations x = A y + b of the components, without
+    sampling.
+
+    The components being independent, the distribution of each feature is the
+    convolution of the (scaled) distributions of the components. Each of them is
+    interpolated on a regular grid spanning the support of the feature (`n_grid`
+    points) and the convolutions are computed with FFTs for all the time steps.
+
+    Args:
+        groundtruth (NDArray): The ground truth values, of shape
+            (n_samples - burnin, n_features).
+        icl_object (ICLObject): The ICL object containing predicted PDFs.
+        n_components (int): Number of components.
+        affine_map (Tuple[NDArray, NDArray]): The matrix A of shape
+            (n_features, n_components) and the offset b of shape (n_features,).
+        up_shift (float, optional): Up-shift value applied during rescaling.
+            Default is 1.5.
+        rescale_factor (float, optional): Rescale factor applied during normalization.
+            Default is 7.0.
+        burnin (int, optional): Number of initial time steps to exclude.
+            Default is 0.
+        n_grid (int, optional): Number of points of the grid of each feature.
+            Default is 4096.
+
+    Returns:
+        NDArray: Quantiles of shape (n_samples - burnin, n_features).
+    """
+    A, b = affine_map
+
+    # bin centers (in the space of the components) and probabilities of each PDF
+    center_arrs = []
+    prob_mats = []
+    for dim in range(n_components):
+        PDF_list = PDFBatch.from_PDFs(icl_object[dim].PDF_list)[burnin:]
+        ts_min = icl_object[dim].rescaling_min
+        ts_max = icl_object[dim].rescaling_max
+        center_arrs.append(
+            ((PDF_list.bin_center_arr - up_shift) / rescale_factor) * (ts_max - ts_min)
+            + ts_min
+        )
+        prob_mat = PDF_list.bin_height_mat * PDF_list.bin_width_arr
+        prob_mats.append(prob_mat / prob_mat.sum(axis=1, keepdims=True))
+
+    n_steps = len(groundtruth)
+    quantiles = np.empty(groundtruth.shape)
+    for feature in range(A.shape[0]):
+        value_arrs = [A[feature, dim] * center_arrs[dim] for dim in range(n_components)]
+        lower = b[feature] + sum(value_arr.min() for value_arr in value_arrs)
+        upper = b[feature] + sum(value_arr.max() for value_arr in value_arrs)
+        step = max(upper - lower, np.finfo(float).tiny) / (n_grid - 1)
+
+        # interpolate each component on the grid, starting from its minimum value
+        n_fft = n_grid + 2 * n_components
+        spectrum = np.ones((n_steps, n_fft // 2 + 1), dtype=complex)
+        for value_arr, prob_mat in zip(value_arrs, prob_mats):
+            position_arr = (value_arr - value_arr.min()) / step
+            idx_arr = np.floor(position_arr).astype(int)
+            frac_arr = position_arr - idx_arr
+            interpolation = csr_matrix(
+                (
+                    np.concatenate([1 - frac_arr, frac_arr]),
+                    (
+                        np.tile(np.arange(len(value_arr)), 2),
+                        np.concatenate([idx_arr, idx_arr + 1]),
+                    ),
+                ),
+                shape=(len(value_arr), n_fft),
+            )
+            mass_mat = (interpolation.T @ prob_mat.T).T
+            spectrum *= np.fft.rfft(mass_mat, n=n_fft, axis=1)
+        cdf_mat = np.cumsum(
+            np.clip(np.fft.irfft(spectrum, n=n_fft, axis=1), 0.0, None), axis=1
+        )
+        cdf_mat /= cdf_mat[:, -1:]
+
+        # each grid mass is spread uniformly over its cell, hence the CDF is linear
+        # within a cell
+        cdf_mat = np.concatenate([np.zeros((n_steps, 1)), cdf_mat], axis=1)
+        position_arr = (groundtruth[:, feature] - lower) / step + 0.5
+        idx_arr = np.clip(np.floor(position_arr).astype(int), 0, n_fft - 1)
+        frac_arr = np.clip(position_arr - idx_arr, 0.0, 1.0)
+        rows = np.arange(n_steps)
+        quantiles[:, feature] = cdf_mat[rows, idx_arr] + frac_arr * (
+            cdf_mat[rows, idx_arr + 1] - cdf_mat[rows, idx_arr]
+        )
+    return quantiles
 
 
 def ks_cdf(
@@ -0,0 +1,200 @@
+"""
+Persistent on-disk cache of the probabilities computed by the LLM.
+
+The entries are content-addressed: the key is a hash of the model (including its
+quantization), the tokenizer, the serialized series and the parameters of the
+computation, so that runs processing the same contexts (e.g. across seeds and
+ablations on recorded trajectories) share them.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from typing import Optional
+
+import numpy as np
+from numpy.typing import NDArray
+
+
+def _model_id(model) -> str:
+    """
+    Identifier of the weights of a model (checkpoint name, dtype and quantization
+    set by `configure_cpu_inference`, if any).
+    """
+    config = getattr(model, "config", None)
+    name = getattr(config, "_name_or_path", None) or getattr(
+        model, "name_or_path", type(model).__name__
+    )
+    model_id = f"{name}:{getattr(model, 'dtype', '')}"
+    quantization = getattr(model, "dicl_quantization", None)
+    if quantization:
+        model_id += f":{quantization}"
+    return model_id
+
+
+def _tokenizer_id(tokenizer) -> str:
+    """Identifier of a tokenizer (name and vocabulary size)."""
+    name = getattr(tokenizer, "name_or_path", type(tokenizer).__name__)
+    return f"{name}:{len(tokenizer)}"
+
+
+class ICLDiskCache:
+    """
+    A directory of `.npy` files holding the (n_PDFs, n_states) probability matrices
+    of the serialized series, read back as memory maps.
+
+    The least recently used entries (by modification time, refreshed on every hit)
+    are deleted to keep the size of the directory under `max_bytes`. The files are
+    written atomically, hence the directory can be shared by concurrent runs.
+
+    Attributes:
+        cache_dir (str): Directory of the cache.
+        max_bytes (int): Size budget of the cache.
+        n_hits (int): Number of lookups found in the cache so far.
+        n_misses (int): Number of lookups not found in the cache so far.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        max_bytes: int = 10 * 1024**3,
+        dtype: str = "float32",
+    ):
+        """
+        Args:
+            cache_dir (str): Directory of the cache (created if needed).
+            max_bytes (int, optional): Size budget of the cache, in bytes.
+                Default is 10 GiB.
+            dtype (str, optional): Storage type of the probabilities. "float16"
+                halves the size of the entries at the cost of their precision.
+                Default is "float32".
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.dtype = np.dtype(dtype)
+        self.n_hits = 0
+        self.n_misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._n_bytes = sum(os.path.getsize(path) for path in self._paths())
+
+    def _paths(self):
+        for subdir in os.scandir(self.cache_dir):
+            if subdir.is_dir():
+                for entry in os.scandir(subdir.path):
+                    if entry.name.endswith(".npy"):
+                        yield entry.path
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.npy")
+
+    @staticmethod
+    def key(
+        model,
+        tokenizer,
+        full_series,
+        temperature: float,
+        n_states: int,
+        restrict_vocab: bool = False,
+    ) -> str:
+        """
+        Content hash of a call to `calculate_multiPDF_llama3`.
+
+        Args:
+            model: The LLM.
+            tokenizer: The tokenizer associated with the LLM.
+            full_series (str or array of int): The serialized series, as a string or
+                as token ids.
+            temperature (float): Softmax temperature.
+            n_states (int): Number of possible states.
+            restrict_vocab (bool, optional): Whether the logits are computed with
+                the restricted LM head (slightly different rounding). Default is
+                False.
+
+        Returns:
+            str: The hexadecimal key of the entry.
+        """
+        header = json.dumps(
+            {
+                "model": _model_id(model),
+                "tokenizer": _tokenizer_id(tokenizer),
+                "temperature": float(temperature),
+                "n_states": int(n_states),
+                "token_ids": not isinstance(full_series, str),
+                "restrict_vocab": bool(restrict_vocab),
+            },
+            sort_keys=True,
+        )
+        digest = hashlib.sha256(header.encode())
+        if isinstance(full_series, str):
+            digest.update(full_series.encode())
+        else:
+            digest.update(np.ascontiguousarray(full_series, dtype=np.int64).tobytes())
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[NDArray]:
+        """
+        Reads an entry.
+
+        Args:
+            key (str): The key of the entry.
+
+        Returns:
+            Optional[NDArray]: The read-only memory map of the probabilities, or None
+                if the entry is not cached.
+        """
+        path = self._path(key)
+        try:
+            probs = np.load(path, mmap_mode="r")
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            # ValueError: entry evicted or truncated by a concurrent run
+            self.n_misses += 1
+            return None
+        self.n_hits += 1
+        return probs
+
+    def put(self, key: str, probs: NDArray):
+        """
+        Writes an entry and evicts the least recently used ones if the size budget
+        is exceeded.
+
+        Args:
+            key (str): The key of the entry.
+            probs (NDArray): The probabilities, of shape (n_PDFs, n_states).
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, np.asarray(probs, dtype=self.dtype))
+        old_size = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(tmp_path, path)
+        self._n_bytes += os.path.getsize(path) - old_size
+        if self._n_bytes > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        for path in self._paths():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        self._n_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self._n_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._n_bytes -= size
+
+    def clear(self):
+        """Deletes all the entries."""
+        for path in list(self._paths()):
+            os.remove(path)
+        self._n_bytes = 0
@@ -12,8 +12,9 @@ By:
 
 
 from functools import partial
+import weakref
 import numpy as np
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import matplotlib.pyplot as plt
 import torch
 
@@ -408,6 +409,286 @@ class MultiResolutionPDF:
             plt.show()
 
 
+def inverse_cdf_sample(prob_mat, n_samples=None, rng=None):
+    """
+    Draws bin indices from a batch of discrete distributions by inverse transform
+    sampling: one cumulative sum, one matrix of uniform draws and a single
+    searchsorted for all the distributions.
+
+    Args:
+        prob_mat (numpy.array): Probabilities (not necessarily normalized) of the
+            bins, of shape (n_PDFs, n_bins).
+        n_samples (int, optional): Number of samples per distribution. If None, a
+            single sample is drawn and the output has shape (n_PDFs,).
+        rng (numpy.random.Generator, optional): Random generator. Defaults to the
+            global NumPy random state.
+
+    Returns:
+        numpy.array: Bin indices of shape (n_PDFs, n_samples) or (n_PDFs,).
+    """
+    n_PDFs, n_bins = prob_mat.shape
+    cdf_mat = np.cumsum(prob_mat, axis=1, dtype=np.float64)
+    cdf_mat /= cdf_mat[:, -1:]
+    size = (n_PDFs, 1 if n_samples is None else n_samples)
+    uniform_mat = rng.random(size) if rng is not None else np.random.random(size)
+    # offset the rows so that a single searchsorted handles all the distributions
+    offsets = np.arange(n_PDFs)[:, None]
+    bin_idx = (
+        np.searchsorted(
+            (cdf_mat + offsets).ravel(),
+            (uniform_mat + offsets).ravel(),
+            side="right",
+        ).reshape(size)
+        - offsets * n_bins
+    )
+    bin_idx = np.minimum(bin_idx, n_bins - 1)
+    return bin_idx[:, 0] if n_samples is None else bin_idx
+
+
+class PDFBatch:
+    """
+    A batch of PDFs sharing the same bins, e.g. the PDFs predicted by the LLM at
+    every timestep of a series, stored as a single (n_PDFs, n_bins) matrix of bin
+    heights.
+
+    The statistics are computed for all the PDFs at once with NumPy reductions.
+    Indexing with an integer returns a MultiResolutionPDF holding copies of the
+    bins, so that a PDFBatch can be used in place of a list of MultiResolutionPDF
+    and in-place updates of that PDF (e.g. `refine`) leave the batch untouched.
+    Slicing returns a PDFBatch viewing the rows of the matrix.
+
+    Attributes:
+        bin_center_arr (numpy.array): The centers of the bins, shared by all PDFs.
+        bin_width_arr (numpy.array): The widths of the bins, shared by all PDFs.
+        bin_height_mat (numpy.array): The heights of the bins, one row per PDF.
+        mode (numpy.array): The modes of the PDFs, computed in `compute_stats`.
+        mean (numpy.array): The means of the PDFs, computed in `compute_stats`.
+        sigma (numpy.array): The standard deviations of the PDFs, computed in
+            `compute_stats`.
+    """
+
+    def __init__(self, bin_height_mat, bin_center_arr=None, bin_width_arr=None):
+        """
+        Constructor for the PDFBatch class.
+
+        Args:
+            bin_height_mat (array_like): Heights of the bins, of shape
+                (n_PDFs, n_bins).
+            bin_center_arr (array_like, optional): Centers of the bins. Defaults to
+                the bins of the LLM predictions (`BIN_CENTER_ARR`).
+            bin_width_arr (array_like, optional): Widths of the bins. Defaults to the
+                bins of the LLM predictions (`BIN_WIDTH_ARR`).
+        """
+        bin_height_mat = np.asarray(bin_height_mat)
+        assert bin_height_mat.ndim == 2, "bin_height_mat must be 2D"
+        n_bins = bin_height_mat.shape[1]
+        if bin_center_arr is None:
+            bin_center_arr = BIN_CENTER_ARR[:n_bins]
+        if bin_width_arr is None:
+            bin_width_arr = BIN_WIDTH_ARR[:n_bins]
+        assert (
+            len(bin_center_arr) == len(bin_width_arr) == n_bins
+        ), "bin_center_arr, bin_width_arr, bin_height_mat must have the same n_bins"
+        self.bin_center_arr = bin_center_arr
+        self.bin_width_arr = bin_width_arr
+        # rows beyond self._n_PDFs are preallocated space for `append`
+        self._bin_height_buf = bin_height_mat
+        self._n_PDFs = len(bin_height_mat)
+        self.mode = None
+        self.mean = None
+        self.sigma = None
+
+    @classmethod
+    def from_PDFs(cls, PDF_list):
+        """
+        Stacks a list of MultiResolutionPDF with identical bins into a PDFBatch.
+
+        Args:
+            PDF_list (list): List of MultiResolutionPDF.
+
+        Returns:
+            PDFBatch: The batch of PDFs.
+        """
+        if isinstance(PDF_list, PDFBatch):
+            return PDF_list
+        assert len(PDF_list) > 0, "cannot infer the bins of an empty list of PDFs"
+        bin_center_arr = PDF_list[0].bin_center_arr
+        for PDF in PDF_list:
+            assert np.array_equal(
+                PDF.bin_center_arr, bin_center_arr
+            ), "Only PDFs of the same discretization can be batched"
+        return cls(
+            np.stack([PDF.bin_height_arr for PDF in PDF_list]),
+            bin_center_arr=bin_center_arr,
+            bin_width_arr=PDF_list[0].bin_width_arr,
+        )
+
+    @property
+    def bin_height_mat(self):
+        return self._bin_height_buf[: self._n_PDFs]
+
+    @bin_height_mat.setter
+    def bin_height_mat(self, bin_height_mat):
+        self._bin_height_buf = bin_height_mat
+        self._n_PDFs = len(bin_height_mat)
+        self.mode = self.mean = self.sigma = None
+
+    def __len__(self):
+        return self._n_PDFs
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            batch = PDFBatch(
+                self.bin_height_mat[idx], self.bin_center_arr, self.bin_width_arr
+            )
+            if self.mean is not None:
+                batch.mode, batch.mean, batch.sigma = (
+                    self.mode[idx],
+                    self.mean[idx],
+                    self.sigma[idx],
+                )
+            return batch
+        PDF = MultiResolutionPDF()
+        PDF.bin_center_arr = np.array(self.bin_center_arr)
+        PDF.bin_width_arr = np.array(self.bin_width_arr)
+        PDF.bin_height_arr = np.array(self.bin_height_mat[idx])
+        if self.mean is not None:
+            PDF.mode, PDF.mean, PDF.sigma = (
+                self.mode[idx],
+                self.mean[idx],
+                self.sigma[idx],
+            )
+        return PDF
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def append(self, PDF):
+        """
+        Appends a PDF (with the same bins) to the batch, e.g. during autoregressive
+        rollouts. The storage grows geometrically to amortize the copies.
+
+        Args:
+            PDF (MultiResolutionPDF or array_like): The PDF or its bin heights.
+        """
+        bin_height_arr = getattr(PDF, "bin_height_arr", PDF)
+        assert len(bin_height_arr) == len(
+            self.bin_center_arr
+        ), "Only PDFs of the same discretization can be batched"
+        if self._n_PDFs == len(self._bin_height_buf):
+            buf = np.empty(
+                (max(2 * self._n_PDFs, 1), self._bin_height_buf.shape[1]),
+                dtype=np.result_type(self._bin_height_buf, bin_height_arr),
+            )
+            buf[: self._n_PDFs] = self.bin_height_mat
+            self._bin_height_buf = buf
+        self._bin_height_buf[self._n_PDFs] = bin_height_arr
+        self._n_PDFs += 1
+        self.mode = self.mean = self.sigma = None
+
+    def normalize(self):
+        """
+        Normalizes the PDFs so that the total area under the bins of each equals 1.
+        """
+        total_area = self.bin_height_mat @ self.bin_width_arr
+        self.bin_height_mat = self.bin_height_mat / total_area[:, None]
+
+    def compute_stats(self):
+        """
+        Computes and updates the statistical properties of the PDFs: mean, mode, and
+        standard deviation (sigma), as arrays of length n_PDFs.
+        """
+        bin_height_mat = self.bin_height_mat
+        self.mean = np.sum(
+            self.bin_center_arr * self.bin_width_arr * bin_height_mat, axis=1
+        )
+        self.mode = self.bin_center_arr[np.argmax(bin_height_mat, axis=1)]
+        variance = np.sum(
+            (self.bin_center_arr - self.mean[:, None]) ** 2
+            * bin_height_mat
+            * self.bin_width_arr,
+            axis=1,
+        )
+        self.sigma = np.sqrt(variance)
+
+    def compute_moment(self, n):
+        """
+        Computes the nth mean-centered moment of the PDFs.
+
+        Args:
+            n (int): The order of the moment to compute.
+
+        Returns:
+            numpy.array: The nth moment of each PDF.
+        """
+        if self.mean is None:
+            self.compute_stats()
+        return np.sum(
+            (self.bin_center_arr - self.mean[:, None]) ** n
+            * self.bin_height_mat
+            * self.bin_width_arr,
+            axis=1,
+        )
+
+    def rescale_temperature(self, alpha):
+        """
+        Rescale bins as if the original temperature
+        of softmax is scaled from T to alpha T
+        """
+        self.bin_height_mat = self.bin_height_mat ** (1 / alpha)
+        self.normalize()
+
+    def sample(self, n_samples=None, rng=None):
+        """
+        Draws samples (bin centers) from every PDF by inverse transform sampling.
+
+        Args:
+            n_samples (int, optional): Number of samples per PDF. If None, a single
+                sample is drawn and the output has shape (n_PDFs,).
+            rng (numpy.random.Generator, optional): Random generator. Defaults to the
+                global NumPy random state.
+
+        Returns:
+            numpy.array: Samples of shape (n_PDFs, n_samples) or (n_PDFs,).
+        """
+        bin_idx = inverse_cdf_sample(
+            self.bin_height_mat * self.bin_width_arr, n_samples=n_samples, rng=rng
+        )
+        return self.bin_center_arr[bin_idx]
+
+    def _other_height_mat(self, Multi_PDF):
+        assert np.all(
+            self.bin_center_arr == Multi_PDF.bin_center_arr
+        ), "Only PDFs of the same discretization are comparable"
+        if isinstance(Multi_PDF, PDFBatch):
+            return Multi_PDF.bin_height_mat
+        return Multi_PDF.bin_height_arr
+
+    def BT_dist(self, Multi_PDF):
+        """
+        Calculate the Bhattacharyya distances with another PDFBatch (PDF-wise) or
+        with a MultiResolutionPDF (broadcasted)
+        """
+        weighted_PQ_mat = (
+            np.sqrt(self.bin_height_mat * self._other_height_mat(Multi_PDF))
+            * self.bin_width_arr
+        )
+        return -np.log(np.sum(weighted_PQ_mat, axis=1))
+
+    def KL_div(self, Multi_PDF):
+        """
+        Calculate the KL divergences D_KL(self||Multi_PDF) with another PDFBatch
+        (PDF-wise) or with a MultiResolutionPDF (broadcasted)
+        Prone to numerical instabilities
+        """
+        log_ratio = np.log(self.bin_height_mat) - np.log(
+            self._other_height_mat(Multi_PDF)
+        )
+        weighted_log_ratio = log_ratio * self.bin_height_mat * self.bin_width_arr
+        return np.sum(weighted_log_ratio, axis=1)
+
+
 def vec_num2repr(val, base, prec, max_val):
     """
     Convert numbers to a representation in a specified base with precision.
@@ -520,35 +801,331 @@ def serialize_arr(arr, settings: SerializerSettings):
     sign_arr, digits_arr = vnum2repr(np.where(np.isnan(arr), np.zeros_like(arr), arr))
     ismissing = np.isnan(arr)
 
-    def tokenize(arr):
-        return "".join([settings.bit_sep + str(b) for b in arr])
-
-    bit_strs = []
-    for sign, digits, missing in zip(sign_arr, digits_arr, ismissing):
-        if not settings.fixed_length:
-            # remove leading zeros
-            nonzero_indices = np.where(digits != 0)[0]
-            if len(nonzero_indices) == 0:
-                digits = np.array([0])
-            else:
-                digits = digits[nonzero_indices[0] :]
-            # add a decimal point
-            prec = settings.prec
-            if len(settings.decimal_point):
-                digits = np.concatenate(
-                    [digits[:-prec], np.array([settings.decimal_point]), digits[-prec:]]
-                )
-        digits = tokenize(digits)
-        sign_sep = plus_sign if sign == 1 else minus_sign
-        if missing:
-            bit_strs.append(settings.missing_str)
+    n_steps, n_digits = digits_arr.shape
+    if n_steps == 0:
+        return settings.time_sep
+
+    # Each time step is written as one row of tokens:
+    #   [sign, digit_0, ..., (decimal point), ..., digit_n, time_sep]
+    # and masked tokens are replaced by the empty string, so that the whole series
+    # is obtained by a single join over the flattened token matrix.
+    digit_values, digit_ids = np.unique(digits_arr, return_inverse=True)
+    vocabulary = np.array(
+        [
+            "",
+            plus_sign,
+            minus_sign,
+            settings.missing_str,
+            settings.time_sep,
+            settings.bit_sep + settings.decimal_point,
+        ]
+        + [settings.bit_sep + str(digit) for digit in digit_values],
+        dtype=object,
+    )
+    EMPTY, PLUS, MINUS, MISSING, TIME_SEP, DECIMAL_POINT = range(6)
+    digit_ids = digit_ids.reshape(digits_arr.shape) + 6
+
+    if not settings.fixed_length:
+        # remove leading zeros (keep the last digit if they are all zero)
+        nonzero = digits_arr != 0
+        first_digit = np.where(
+            nonzero.any(axis=1), np.argmax(nonzero, axis=1), n_digits - 1
+        )
+        digit_ids[np.arange(n_digits)[None, :] < first_digit[:, None]] = EMPTY
+
+    if not settings.fixed_length and len(settings.decimal_point):
+        # the decimal point precedes the last `prec` digits, or the first kept digit
+        # when fewer digits are kept (the preceding tokens are then empty anyway)
+        split = max(n_digits - settings.prec, 0) if settings.prec else 0
+        digit_ids = np.concatenate(
+            [
+                digit_ids[:, :split],
+                np.full((n_steps, 1), DECIMAL_POINT, dtype=digit_ids.dtype),
+                digit_ids[:, split:],
+            ],
+            axis=1,
+        )
+    sign_ids = np.where(sign_arr == 1, PLUS, MINUS).astype(digit_ids.dtype)
+    token_ids = np.concatenate([sign_ids[:, None], digit_ids], axis=1)
+
+    # missing values are written with missing_str only
+    token_ids[ismissing] = EMPTY
+    token_ids[ismissing, 0] = MISSING
+
+    token_ids = np.concatenate(
+        [token_ids, np.full((n_steps, 1), TIME_SEP, dtype=token_ids.dtype)], axis=1
+    )
+    # the trailing time_sep avoids ambiguity in number of digits in the last step
+    return "".join(vocabulary[token_ids.ravel()].tolist())
+
+
+# bins of the PDFs predicted by the LLM (one bin per value "0", ..., "999"),
+# shared by all the PDFs and hence read-only
+BIN_CENTER_ARR = np.arange(0, 1000) / 100
+BIN_CENTER_ARR.setflags(write=False)
+BIN_WIDTH_ARR = np.array(1000 * [0.01])
+BIN_WIDTH_ARR.setflags(write=False)
+
+
+def PDF_list_from_probs(probs):
+    """
+    Build the PDFs of the LLM predictions from a probability matrix.
+
+    Parameters:
+    - probs (np.array): Probabilities of the values, of shape (n_steps, n_states).
+
+    Returns:
+    - PDFBatch: The n_steps PDFs, sharing the bin arrays.
+    """
+    return PDFBatch(probs * 100)
+
+
+@dataclass
+class DigitTokenTable:
+    """
+    Token ids of the values "0", "1", ..., "999" and of the time separator for a
+    given tokenizer, used to encode rescaled time series directly into token ids.
+
+    Attributes:
+    - value_token_ids (np.array): Token id of each value (index = value).
+    - time_sep_token_id (int): Token id of the time separator.
+    - prefix_token_ids (np.array): Special tokens added in front of a prompt
+        (e.g. BOS).
+    - equivalence (dict): Results of `check_token_ids_equivalence`, by settings.
+    """
+
+    value_token_ids: np.ndarray
+    time_sep_token_id: int
+    prefix_token_ids: np.ndarray
+    equivalence: dict = field(default_factory=dict)
+    _index_tensors: dict = field(default_factory=dict, repr=False)
+
+    def value_token_index(self, n_states=1000, device="cpu"):
+        """
+        Token ids of the values 0, ..., n_states - 1 as a tensor on `device`
+        (memoized), to gather the corresponding logits.
+        """
+        key = (n_states, str(device))
+        if key not in self._index_tensors:
+            self._index_tensors[key] = torch.as_tensor(
+                self.value_token_ids[:n_states], device=device
+            )
+        return self._index_tensors[key]
+
+
+_DIGIT_TOKEN_TABLES = weakref.WeakKeyDictionary()
+
+
+def get_digit_token_table(tokenizer, time_sep=",", n_values=1000):
+    """
+    Get the DigitTokenTable of a tokenizer. Tables are computed once per tokenizer
+    (and time separator) and cached.
+
+    Parameters:
+    - tokenizer: The tokenizer associated with the LLM.
+    - time_sep (str): Separator for different time steps.
+    - n_values (int): Number of values with a dedicated token.
+
+    Returns:
+    - DigitTokenTable: The lookup table of the tokenizer.
+    """
+    tables = _DIGIT_TOKEN_TABLES.setdefault(tokenizer, {})
+    if (time_sep, n_values) not in tables:
+        tables[(time_sep, n_values)] = DigitTokenTable(
+            value_token_ids=np.array(
+                [tokenizer.convert_tokens_to_ids(str(num)) for num in range(n_values)],
+                dtype=np.int64,
+            ),
+            time_sep_token_id=tokenizer.convert_tokens_to_ids(time_sep),
+            prefix_token_ids=np.array(
+                tokenizer.build_inputs_with_special_tokens([]), dtype=np.int64
+            ),
+        )
+    return tables[(time_sep, n_values)]
+
+
+def serialize_arr_to_ids(
+    arr, settings: SerializerSettings, token_table, add_special_tokens=True
+):
+    """
+    Serialize an array of numbers directly into the token ids that the tokenizer
+    would produce for `serialize_arr(arr, settings)`, assuming one token per value
+    and one token per time separator (e.g. Llama-3).
+    The assumption should be verified with `check_token_ids_equivalence`.
+
+    Parameters:
+    - arr (np.array): Array of non-negative numbers to serialize.
+    - settings (SerializerSettings): Settings for serialization.
+    - token_table (DigitTokenTable): Lookup table of the tokenizer.
+    - add_special_tokens (bool): Whether to prepend the special tokens (e.g. BOS).
+
+    Returns:
+    - np.array: Token ids of the serialized array.
+    """
+    if (
+        settings.base != 10
+        or settings.fixed_length
+        or settings.bit_sep
+        or settings.decimal_point
+    ):
+        raise ValueError(
+            "Only base 10, variable length serialization without bit or decimal "
+            "separators can be encoded directly into token ids"
+        )
+    assert not np.any(np.isnan(arr)), "missing values cannot be encoded into ids"
+    assert np.all(
+        np.abs(arr) <= settings.max_val
+    ), f"abs(arr) must be <= max_val, but max(abs(arr))={np.abs(arr).max()}"
+
+    sign_arr, digits_arr = vec_num2repr(
+        arr, base=settings.base, prec=settings.prec, max_val=settings.max_val
+    )
+    if settings.signed and np.any(sign_arr != 1):
+        raise ValueError("negative values cannot be encoded directly into token ids")
+
+    # the digits without leading zeros are the decimal writing of an integer
+    values = digits_arr @ (
+        settings.base ** np.arange(digits_arr.shape[1] - 1, -1, -1, dtype=np.int64)
+    )
+    if np.any(values >= len(token_table.value_token_ids)) or np.any(values < 0):
+        raise ValueError(
+            f"values must be in [0, {len(token_table.value_token_ids)}) once "
+            "serialized to be encoded with one token"
+        )
+
+    input_ids = np.stack(
+        [
+            token_table.value_token_ids[values],
+            np.full(len(values), token_table.time_sep_token_id, dtype=np.int64),
+        ],
+        axis=1,
+    ).ravel()
+    if add_special_tokens:
+        input_ids = np.concatenate([token_table.prefix_token_ids, input_ids])
+    return input_ids
+
+
+def check_token_ids_equivalence(tokenizer, settings: SerializerSettings):
+    """
+    Check that `serialize_arr_to_ids` reproduces the tokenization of
+    `serialize_arr` for every representable value, for the given tokenizer.
+    The result is cached in the DigitTokenTable of the tokenizer.
+
+    Parameters:
+    - tokenizer: The tokenizer associated with the LLM.
+    - settings (SerializerSettings): Settings for serialization.
+
+    Returns:
+    - bool: True if both paths produce the same token ids.
+    """
+    token_table = get_digit_token_table(tokenizer, time_sep=settings.time_sep)
+    key = repr(settings)
+    if key not in token_table.equivalence:
+        # every value from 0 to max_val, with repetitions and varying neighbours
+        n_values = int(settings.max_val * settings.base**settings.prec)
+        probe = np.concatenate(
+            [np.arange(n_values), np.arange(n_values)[::-1], np.zeros(3)]
+        ) / (settings.base**settings.prec)
+        try:
+            input_ids = serialize_arr_to_ids(probe, settings, token_table)
+        except ValueError:
+            token_table.equivalence[key] = False
         else:
-            bit_strs.append(sign_sep + digits)
-    bit_str = settings.time_sep.join(bit_strs)
-    bit_str += (
-        settings.time_sep
-    )  # otherwise there is ambiguity in number of digits in the last time step
-    return bit_str
+            reference = tokenizer(
+                [serialize_arr(probe, settings)], add_special_tokens=True
+            )["input_ids"][0]
+            token_table.equivalence[key] = list(reference) == input_ids.tolist()
+    return token_table.equivalence[key]
+
+
+def _to_input_ids(full_series, tokenizer, add_special_tokens=True):
+    """
+    Token ids (as a list) of a series given either as a serialized string or as
+    token ids already (see `serialize_arr_to_ids`).
+    """
+    if isinstance(full_series, str):
+        return list(
+            tokenizer([full_series], add_special_tokens=add_special_tokens)[
+                "input_ids"
+            ][0]
+        )
+    return [int(token_id) for token_id in full_series]
+
+
+def get_model_device(model):
+    """
+    Device of the inputs of the LLM (the device of its input embeddings when the
+    model is dispatched over several devices).
+    """
+    device = getattr(model, "device", None)
+    if device is None:
+        device = next(model.parameters()).device
+    return torch.device(device)
+
+
+def configure_cpu_inference(model, n_threads=None, quantize=False):
+    """
+    Prepares an LLM for CPU inference.
+
+    Parameters:
+    - model: The LLM (on CPU).
+    - n_threads (int, optional): Number of intra-op threads used by torch. Defaults to
+        None (torch default).
+    - quantize (bool, optional): If True, the linear layers of the base model are
+        dynamically quantized to int8 (the LM head is kept in full precision).
+        Layers that are not `torch.nn.Linear` (e.g. the Conv1D of GPT-2) are left
+        untouched. The model is flagged with a `dicl_quantization` attribute, which
+        separates its entries in `ICLDiskCache`. Defaults to False.
+
+    Returns:
+    - The model in eval mode.
+    """
+    if n_threads:
+        torch.set_num_threads(n_threads)
+    model.eval()
+    if quantize:
+        torch.ao.quantization.quantize_dynamic(
+            model.base_model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+        model.dicl_quantization = "int8-dynamic"
+    return model
+
+
+def _empty_cache(device):
+    """Releases the cached memory of the accelerator (no-op on CPU)."""
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+
+
+def _forward(model, input_ids, restrict_vocab=False, **kwargs):
+    """
+    Runs the LLM on `input_ids` and returns the logits together with the outputs of
+    the model. If restrict_vocab, the LM head is skipped and the last hidden states
+    are returned instead of the logits, the logits of the value tokens being computed
+    later by `_value_logits`.
+    """
+    if restrict_vocab:
+        out = model.base_model(input_ids, **kwargs)
+        return out["last_hidden_state"], out
+    out = model(input_ids, **kwargs)
+    return out["logits"], out
+
+
+def _value_logits(model, state_mat, good_tokens, restrict_vocab=False):
+    """
+    Logits of the value tokens `good_tokens` from (a selection of the positions of)
+    the output of `_forward`. If restrict_vocab, only the rows of the LM head weight
+    corresponding to the value tokens are multiplied with the hidden states.
+    """
+    if not restrict_vocab:
+        return state_mat[..., good_tokens]
+    lm_head = model.get_output_embeddings()
+    bias = getattr(lm_head, "bias", None)
+    return torch.nn.functional.linear(
+        state_mat,
+        lm_head.weight[good_tokens],
+        bias[good_tokens] if bias is not None else None,
+    )
 
 
 def calculate_multiPDF_llama3(
@@ -560,66 +1137,314 @@ def calculate_multiPDF_llama3(
     number_of_tokens_original=None,
     use_cache=False,
     kv_cache_prev=None,
+    restrict_vocab=False,
+    device=None,
 ):
     """
     This function calculates the multi-resolution probability density function (PDF)
         for a given series.
 
     Parameters:
-    full_series (str): The series for which the PDF is to be calculated.
+    full_series (str or array of int): The series for which the PDF is to be
+        calculated, serialized either as a string or as token ids (see
+        `serialize_arr_to_ids`).
     prec (int): The precision of the PDF.
     mode (str, optional): The mode of calculation. Defaults to 'neighbor'.
     refine_depth (int, optional): The depth of refinement for the PDF. Defaults to 1.
     llama_size (str, optional): The size of the llama model. Defaults to '13b'.
+    restrict_vocab (bool, optional): If True, the logits are only computed for the
+        value tokens at the positions of the PDFs, from the last hidden states of the
+        model, instead of materializing the logits of the whole vocabulary at every
+        position. Defaults to False.
+    device (str or torch.device, optional): Device of the inputs of the model.
+        Defaults to None (the device of the model).
 
     Returns:
-    list: A list of PDFs for the series.
+    tuple: The PDFs of the series (PDFBatch), the corresponding probabilities (tensor
+        of shape (1, n_PDFs, n_states)) and the KV cache (if use_cache).
     """
     assert (
         n_states <= 1000
     ), f"if n_states ({n_states}) is larger than 1000, there will be more than 1 token"
     "per value!"
 
-    good_tokens_str = []
-    for num in range(n_states):
-        good_tokens_str.append(str(num))
-    good_tokens = [tokenizer.convert_tokens_to_ids(token) for token in good_tokens_str]
-
-    batch = tokenizer([full_series], return_tensors="pt", add_special_tokens=True)
-
-    torch.cuda.empty_cache()
-    with torch.no_grad():
-        out = model(
-            batch["input_ids"].cuda(),
+    batch = {
+        "input_ids": torch.tensor(
+            [_to_input_ids(full_series, tokenizer, add_special_tokens=True)]
+        )
+    }
+
+    device = torch.device(device) if device else get_model_device(model)
+    _empty_cache(device)
+    with torch.inference_mode():
+        state_mat, out = _forward(
+            model,
+            batch["input_ids"].to(device),
+            restrict_vocab=restrict_vocab,
             use_cache=use_cache,
             past_key_values=kv_cache_prev,
         )
 
-    logit_mat = out["logits"]
+        kv_cache_main = out["past_key_values"] if use_cache else None
+
+        # the PDFs are read at every other position (time separators) of the window
+        # starting after the first token, or covering the last tokens
+        n_tokens = state_mat.shape[1]
+        start = 1
+        if number_of_tokens_original:
+            start = n_tokens - (number_of_tokens_original - 1)
+        positions = torch.arange(start + 1, n_tokens, 2, device=state_mat.device)
+        good_tokens = get_digit_token_table(tokenizer).value_token_index(
+            n_states, device=state_mat.device
+        )
+        logit_mat_good = _value_logits(
+            model, state_mat[:, positions], good_tokens, restrict_vocab=restrict_vocab
+        )
+
+    probs = torch.nn.functional.softmax(logit_mat_good / temperature, dim=-1).cpu()
+    PDF_list = PDF_list_from_probs(probs[0].numpy())
 
-    kv_cache_main = out["past_key_values"] if use_cache else None
-    logit_mat_good = logit_mat[:, :, good_tokens].clone()
+    # release memory
+    del state_mat, logit_mat_good, out, kv_cache_prev  # , kv_cache_main
+    return PDF_list, probs, kv_cache_main
 
-    if number_of_tokens_original:
-        probs = torch.nn.functional.softmax(
-            logit_mat_good[:, -(number_of_tokens_original - 1) :, :] / temperature,
-            dim=-1,
+
+def calculate_next_PDF_llama3(
+    new_series,
+    model,
+    tokenizer,
+    kv_cache_prev,
+    n_states=1000,
+    temperature=1.0,
+    restrict_vocab=False,
+    device=None,
+):
+    """
+    Incremental version of `calculate_multiPDF_llama3`: only the tokens of the newly
+        appended values are fed to the model, the rest of the context being provided
+        through its KV cache.
+
+    Parameters:
+    new_series (str or array of int): The serialized values appended to the context,
+        ending with the time separator (e.g. "352,"), or their token ids.
+    model: The LLM.
+    tokenizer: The tokenizer associated with the LLM.
+    kv_cache_prev: The KV cache of the context the new values are appended to.
+    n_states (int, optional): Number of possible states. Defaults to 1000.
+    temperature (float, optional): Softmax temperature. Defaults to 1.0.
+    restrict_vocab (bool, optional): If True, only the logits of the value tokens are
+        computed (see `calculate_multiPDF_llama3`). Defaults to False.
+    device (str or torch.device, optional): Device of the inputs of the model.
+        Defaults to None (the device of the model).
+
+    Returns:
+    tuple: The PDF of the value following `new_series`, its probabilities and the
+        updated KV cache.
+    """
+    assert (
+        n_states <= 1000
+    ), f"if n_states ({n_states}) is larger than 1000, there will be more than 1 token"
+    "per value!"
+    assert kv_cache_prev is not None, "a KV cache of the context is required"
+
+    batch = {
+        "input_ids": torch.tensor(
+            [_to_input_ids(new_series, tokenizer, add_special_tokens=False)]
         )
-    else:
-        probs = torch.nn.functional.softmax(
-            logit_mat_good[:, 1:, :] / temperature, dim=-1
+    }
+
+    device = torch.device(device) if device else get_model_device(model)
+    with torch.inference_mode():
+        state_mat, out = _forward(
+            model,
+            batch["input_ids"].to(device),
+            restrict_vocab=restrict_vocab,
+            use_cache=True,
+            past_key_values=kv_cache_prev,
         )
 
-    PDF_list = []
+        kv_cache_main = out["past_key_values"]
+        good_tokens = get_digit_token_table(tokenizer).value_token_index(
+            n_states, device=state_mat.device
+        )
+        logit_mat_good = _value_logits(
+            model, state_mat[:, -1:], good_tokens, restrict_vocab=restrict_vocab
+        )
+    probs = torch.nn.functional.softmax(logit_mat_good / temperature, dim=-1).cpu()
+    (PDF,) = PDF_list_from_probs(probs[0].numpy())
 
-    # start_loop_from = 1 if use_instruct else 0
-    for i in range(1, int(probs.shape[1]), 2):
-        PDF = MultiResolutionPDF()
-        PDF.bin_center_arr = np.arange(0, 1000) / 100
-        PDF.bin_width_arr = np.array(1000 * [0.01])
-        PDF.bin_height_arr = probs[0, i, :].cpu().numpy() * 100
-        PDF_list.append(PDF)
+    del state_mat, logit_mat_good, out
+    return PDF, probs, kv_cache_main
 
-    # release memory
-    del logit_mat, kv_cache_prev  # , kv_cache_main
+
+def calculate_next_PDF_llama3_batch(
+    new_ids_mat,
+    model,
+    tokenizer,
+    kv_cache_prev,
+    n_states=1000,
+    temperature=1.0,
+    restrict_vocab=False,
+    device=None,
+):
+    """
+    Batched version of `calculate_next_PDF_llama3` for rollouts of the same length
+        (e.g. particles forked from a common context): row i of `new_ids_mat` is
+        appended to the context of row i of the KV cache.
+
+    Parameters:
+    new_ids_mat (array of int): Token ids of the appended values, of shape
+        (batch_size, n_new_tokens).
+    model: The LLM.
+    tokenizer: The tokenizer associated with the LLM.
+    kv_cache_prev: The KV cache of the contexts, with batch size `batch_size` (see
+        `batch_repeat_interleave` to fork a single context).
+    n_states (int, optional): Number of possible states. Defaults to 1000.
+    temperature (float, optional): Softmax temperature. Defaults to 1.0.
+    restrict_vocab (bool, optional): If True, only the logits of the value tokens are
+        computed (see `calculate_multiPDF_llama3`). Defaults to False.
+    device (str or torch.device, optional): Device of the inputs of the model.
+        Defaults to None (the device of the model).
+
+    Returns:
+    tuple: The PDFs of the values following each row (PDFBatch), their probabilities
+        and the updated KV cache.
+    """
+    assert (
+        n_states <= 1000
+    ), f"if n_states ({n_states}) is larger than 1000, there will be more than 1 token"
+    "per value!"
+    assert kv_cache_prev is not None, "a KV cache of the contexts is required"
+
+    device = torch.device(device) if device else get_model_device(model)
+    with torch.inference_mode():
+        state_mat, out = _forward(
+            model,
+            torch.as_tensor(new_ids_mat, dtype=torch.long).to(device),
+            restrict_vocab=restrict_vocab,
+            use_cache=True,
+            past_key_values=kv_cache_prev,
+        )
+
+        kv_cache_main = out["past_key_values"]
+        good_tokens = get_digit_token_table(tokenizer).value_token_index(
+            n_states, device=state_mat.device
+        )
+        logit_mat_good = _value_logits(
+            model, state_mat[:, -1], good_tokens, restrict_vocab=restrict_vocab
+        )
+    probs = torch.nn.functional.softmax(logit_mat_good / temperature, dim=-1).cpu()
+    PDF_list = PDF_list_from_probs(probs.numpy())
+
+    del state_mat, logit_mat_good, out
     return PDF_list, probs, kv_cache_main
+
+
+def calculate_multiPDF_llama3_batch(
+    full_series_list,
+    model,
+    tokenizer,
+    n_states=1000,
+    temperature=1.0,
+    max_batch_tokens=None,
+    restrict_vocab=False,
+    device=None,
+):
+    """
+    Batched version of `calculate_multiPDF_llama3`: the series are tokenized
+        separately, right-padded into a single batch and processed by one forward
+        pass of the model (or a few ones if `max_batch_tokens` is set).
+
+    Right padding keeps the logits of the real tokens untouched since the model is
+        causal, hence each element of the output matches the output of
+        `calculate_multiPDF_llama3` on the corresponding series.
+
+    Parameters:
+    full_series_list (list of str or arrays of int): The series for which the PDFs
+        are calculated, serialized as strings or as token ids.
+    model: The LLM.
+    tokenizer: The tokenizer associated with the LLM.
+    n_states (int, optional): Number of possible states. Defaults to 1000.
+    temperature (float, optional): Softmax temperature. Defaults to 1.0.
+    max_batch_tokens (int, optional): Upper bound on the number of (padded) tokens
+        processed per forward pass. Defaults to None (a single forward pass).
+    restrict_vocab (bool, optional): If True, only the logits of the value tokens are
+        computed (see `calculate_multiPDF_llama3`). Defaults to False.
+    device (str or torch.device, optional): Device of the inputs of the model.
+        Defaults to None (the device of the model).
+
+    Returns:
+    list: A list of (PDF_list, probs) tuples, one per series, PDF_list being a
+        PDFBatch.
+    """
+    assert (
+        n_states <= 1000
+    ), f"if n_states ({n_states}) is larger than 1000, there will be more than 1 token"
+    "per value!"
+
+    all_input_ids = [
+        _to_input_ids(full_series, tokenizer, add_special_tokens=True)
+        for full_series in full_series_list
+    ]
+    pad_token_id = tokenizer.pad_token_id
+    if pad_token_id is None:
+        pad_token_id = tokenizer.eos_token_id if tokenizer.eos_token_id else 0
+
+    # greedily pack consecutive series into batches under the token budget
+    batches = []
+    current = []
+    for idx, input_ids in enumerate(all_input_ids):
+        max_len = max([len(all_input_ids[i]) for i in current + [idx]])
+        if (
+            current
+            and max_batch_tokens is not None
+            and (len(current) + 1) * max_len > max_batch_tokens
+        ):
+            batches.append(current)
+            current = []
+        current.append(idx)
+    if current:
+        batches.append(current)
+
+    device = torch.device(device) if device else get_model_device(model)
+    outputs = [None] * len(all_input_ids)
+    for batch_indices in batches:
+        lengths = [len(all_input_ids[i]) for i in batch_indices]
+        max_len = max(lengths)
+        input_ids = torch.full(
+            (len(batch_indices), max_len), pad_token_id, dtype=torch.long
+        )
+        attention_mask = torch.zeros((len(batch_indices), max_len), dtype=torch.long)
+        for row, (idx, length) in enumerate(zip(batch_indices, lengths)):
+            input_ids[row, :length] = torch.tensor(all_input_ids[idx])
+            attention_mask[row, :length] = 1
+
+        _empty_cache(device)
+        with torch.inference_mode():
+            state_mat, out = _forward(
+                model,
+                input_ids.to(device),
+                restrict_vocab=restrict_vocab,
+                attention_mask=attention_mask.to(device),
+                use_cache=False,
+            )
+            del out
+            good_tokens = get_digit_token_table(tokenizer).value_token_index(
+                n_states, device=state_mat.device
+            )
+
+            for row, (idx, length) in enumerate(zip(batch_indices, lengths)):
+                positions = torch.arange(2, length, 2, device=state_mat.device)
+                logit_mat_good = _value_logits(
+                    model,
+                    state_mat[row : row + 1, positions],
+                    good_tokens,
+                    restrict_vocab=restrict_vocab,
+                )
+                probs = torch.nn.functional.softmax(
+                    logit_mat_good / temperature, dim=-1
+                ).cpu()
+                outputs[idx] = (PDF_list_from_probs(probs[0].numpy()), probs)
+        del state_mat
+
+    return outputs
@@ -0,0 +1,360 @@
+"""
+Local inference server sharing one LLM between several processes (e.g. the seeds
+of a sweep running on the same machine).
+
+The server owns the model and listens on a Unix socket. Each connected process
+sends the serialized series of its features, the requests received within a short
+window are dynamically batched into padded forward passes
+(`calculate_multiPDF_llama3_batch`), and the probability matrices are sent back.
+`ICLInferenceClient` is the client side, to pass to `MultiVariateICLTrainer`.
+
+The messages are pickled, so the connections are authenticated with a shared key
+(`authkey`, by default the DICL_LLM_AUTHKEY environment variable) and the socket
+is only accessible to its owner.
+
+Usage:
+    export DICL_LLM_AUTHKEY=$(python -c "import secrets; print(secrets.token_hex())")
+    python -m dicl.utils.inference_server --model meta-llama/Llama-3.1-8B
+"""
+
+import argparse
+import os
+import queue
+import tempfile
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from typing import List, Optional, Union
+
+import numpy as np
+from numpy.typing import NDArray
+
+from dicl.utils.icl import calculate_multiPDF_llama3_batch
+
+AUTHKEY_ENV_VAR = "DICL_LLM_AUTHKEY"
+
+
+def default_address() -> str:
+    """
+    Path of the socket in a directory only accessible to the current user
+    ($XDG_RUNTIME_DIR, or a private directory of the temporary directory).
+    """
+    directory = os.environ.get("XDG_RUNTIME_DIR")
+    if not directory:
+        directory = os.path.join(tempfile.gettempdir(), f"dicl-{os.getuid()}")
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        if os.stat(directory).st_uid != os.getuid():
+            raise PermissionError(f"{directory} is owned by another user")
+        os.chmod(directory, 0o700)
+    return os.path.join(directory, "dicl_llm.sock")
+
+
+def _get_authkey(authkey: Optional[Union[str, bytes]]) -> bytes:
+    """The given key, or the one of the DICL_LLM_AUTHKEY environment variable."""
+    if authkey is None:
+        authkey = os.environ.get(AUTHKEY_ENV_VAR)
+    if not authkey:
+        raise ValueError(
+            "An authentication key is required to connect to the inference server "
+            f"(authkey argument or {AUTHKEY_ENV_VAR} environment variable)."
+        )
+    return authkey.encode() if isinstance(authkey, str) else authkey
+
+
+class ICLInferenceServer:
+    """
+    Serves `calculate_multiPDF_llama3` requests over a Unix socket with dynamic
+    batching.
+
+    A request holds the serialized series (strings or token ids) of one client
+    call. The batching thread waits at most `max_wait` seconds after the first
+    pending request to gather others (up to `max_batch_series` series), then runs
+    them through the model, grouped by temperature and number of states. Only the
+    clients holding the same `authkey` are served.
+
+    Attributes:
+        n_requests (int): Number of requests served so far.
+        n_forward_batches (int): Number of batching rounds so far.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        address: Optional[str] = None,
+        authkey: Optional[Union[str, bytes]] = None,
+        max_batch_tokens: Optional[int] = None,
+        max_batch_series: int = 64,
+        max_wait: float = 0.005,
+        restrict_vocab: bool = False,
+        device: Optional[str] = None,
+    ):
+        """
+        Args:
+            model: The LLM.
+            tokenizer: The tokenizer associated with the LLM.
+            address (Optional[str], optional): Path of the Unix socket. If None,
+                `default_address()` is used. Default is None.
+            authkey (Optional[Union[str, bytes]], optional): Key shared with the
+                clients. If None, the DICL_LLM_AUTHKEY environment variable is used.
+                Default is None.
+            max_batch_tokens (Optional[int], optional): Maximum number of (padded)
+                tokens per forward pass. If None, each batching round is processed
+                at once. Default is None.
+            max_batch_series (int, optional): Maximum number of series gathered per
+                batching round. Default is 64.
+            max_wait (float, optional): Time (in seconds) waited for other requests
+                after the first one of a batching round. Default is 0.005.
+            restrict_vocab (bool, optional): If True, only the logits of the value
+                tokens are computed. Default is False.
+            device (Optional[str], optional): Device of the inputs of the model. If
+                None, the device of the model is used. Default is None.
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.address = address if address is not None else default_address()
+        self.authkey = _get_authkey(authkey)
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_series = max_batch_series
+        self.max_wait = max_wait
+        self.restrict_vocab = restrict_vocab
+        self.device = device
+        self.n_requests = 0
+        self.n_forward_batches = 0
+        self._requests = queue.Queue()
+        self._stop = threading.Event()
+        self._listener = None
+
+    def info(self) -> dict:
+        """Identifiers of the model and tokenizer, sent to the clients."""
+        return {
+            "name_or_path": getattr(self.model.config, "_name_or_path", ""),
+            "dtype": str(getattr(self.model, "dtype", "")),
+            "quantization": getattr(self.model, "dicl_quantization", None),
+            "restrict_vocab": self.restrict_vocab,
+            "tokenizer": getattr(self.tokenizer, "name_or_path", ""),
+        }
+
+    def serve_forever(self):
+        """Accepts clients until close is called (from another thread)."""
+        self._listener = Listener(self.address, family="AF_UNIX", authkey=self.authkey)
+        os.chmod(self.address, 0o600)
+        threading.Thread(target=self._batch_loop, daemon=True).start()
+        while True:
+            try:
+                conn = self._listener.accept()
+            except (AuthenticationError, EOFError, OSError):
+                # rejected client
+                if self._stop.is_set():
+                    break
+                continue
+            if self._stop.is_set():
+                conn.close()
+                break
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        self._listener.close()
+
+    def close(self):
+        """Stops the server."""
+        self._stop.set()
+        if self._listener is not None:
+            # wake up the accept call of serve_forever
+            Client(self.address, family="AF_UNIX", authkey=self.authkey).close()
+
+    def _handle(self, conn):
+        """Serves the requests of one client, one at a time."""
+        with conn:
+            conn.send(self.info())
+            while not self._stop.is_set():
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    return
+                reply = queue.Queue(maxsize=1)
+                self._requests.put((request, reply))
+                conn.send(reply.get())
+
+    def _batch_loop(self):
+        while not self._stop.is_set():
+            try:
+                pending = [self._requests.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            n_series = len(pending[0][0]["series_list"])
+            deadline = time.monotonic() + self.max_wait
+            while n_series < self.max_batch_series:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(self._requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                n_series += len(pending[-1][0]["series_list"])
+            self._process(pending)
+
+    def _process(self, pending):
+        groups = {}
+        for request, reply in pending:
+            key = (request["temperature"], request["n_states"])
+            groups.setdefault(key, []).append((request, reply))
+
+        for (temperature, n_states), group in groups.items():
+            try:
+                outputs = calculate_multiPDF_llama3_batch(
+                    [
+                        series
+                        for request, _ in group
+                        for series in request["series_list"]
+                    ],
+                    model=self.model,
+                    tokenizer=self.tokenizer,
+                    n_states=n_states,
+                    temperature=temperature,
+                    max_batch_tokens=self.max_batch_tokens,
+                    restrict_vocab=self.restrict_vocab,
+                    device=self.device,
+                )
+            except Exception as error:
+                for _, reply in group:
+                    reply.put(error)
+                continue
+            start = 0
+            for request, reply in group:
+                n_series = len(request["series_list"])
+                reply.put(
+                    [probs[0].numpy() for _, probs in outputs[start : start + n_series]]
+                )
+                start += n_series
+        self.n_requests += len(pending)
+        self.n_forward_batches += 1
+
+
+class ICLInferenceClient:
+    """
+    Client of an `ICLInferenceServer`, to pass to `MultiVariateICLTrainer` as
+    `inference_client` instead of loading the model in the process.
+
+    Attributes:
+        name_or_path (str): Name of the model of the server (identifies the model in
+            the keys of `ICLDiskCache`).
+        dtype (str): Data type of the model of the server.
+        dicl_quantization (Optional[str]): Quantization of the model of the server.
+        restrict_vocab (bool): Whether the server uses the restricted LM head.
+    """
+
+    def __init__(
+        self,
+        address: Optional[str] = None,
+        authkey: Optional[Union[str, bytes]] = None,
+    ):
+        """
+        Args:
+            address (Optional[str], optional): Path of the Unix socket of the server.
+                If None, `default_address()` is used. Default is None.
+            authkey (Optional[Union[str, bytes]], optional): Key of the server. If
+                None, the DICL_LLM_AUTHKEY environment variable is used. Default is
+                None.
+        """
+        self.address = address if address is not None else default_address()
+        self._conn = Client(
+            self.address, family="AF_UNIX", authkey=_get_authkey(authkey)
+        )
+        self._lock = threading.Lock()
+        info = self._conn.recv()
+        self.name_or_path = info["name_or_path"]
+        self.dtype = info["dtype"]
+        self.dicl_quantization = info["quantization"]
+        self.restrict_vocab = info["restrict_vocab"]
+
+    def calculate_multiPDF_batch(
+        self, series_list: list, n_states: int = 1000, temperature: float = 1.0
+    ) -> List[NDArray]:
+        """
+        Computes the probabilities of the values at each position of the series on
+        the server (see `calculate_multiPDF_llama3`).
+
+        Args:
+            series_list (list of str or arrays of int): The serialized series.
+            n_states (int, optional): Number of possible states. Default is 1000.
+            temperature (float, optional): Softmax temperature. Default is 1.0.
+
+        Returns:
+            List[NDArray]: The probabilities of each series, of shape
+                (n_PDFs, n_states).
+        """
+        request = {
+            "series_list": [
+                series if isinstance(series, str) else np.asarray(series)
+                for series in series_list
+            ],
+            "n_states": n_states,
+            "temperature": temperature,
+        }
+        with self._lock:
+            self._conn.send(request)
+            reply = self._conn.recv()
+        if isinstance(reply, BaseException):
+            raise RuntimeError("the inference server failed") from reply
+        return reply
+
+    def close(self):
+        """Closes the connection to the server."""
+        self._conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, default="meta-llama/Llama-3.1-8B")
+    parser.add_argument("--address", type=str, default=None)
+    parser.add_argument(
+        "--authkey",
+        type=str,
+        default=None,
+        help=f"shared key of the clients (default: ${AUTHKEY_ENV_VAR})",
+    )
+    parser.add_argument("--max-batch-tokens", type=int, default=None)
+    parser.add_argument("--max-batch-series", type=int, default=64)
+    parser.add_argument("--max-wait", type=float, default=0.005)
+    parser.add_argument("--restrict-vocab", action="store_true")
+    parser.add_argument("--stub-latency", type=float, default=0.0)
+    args = parser.parse_args()
+    # fail before loading the model
+    authkey = _get_authkey(args.authkey)
+
+    if args.model == "stub":
+        from dicl.utils.stub_llm import load_stub_llm
+
+        model, tokenizer = load_stub_llm(latency=args.stub_latency)
+    else:
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(args.model, use_fast=False)
+        model = AutoModelForCausalLM.from_pretrained(
+            args.model,
+            device_map="auto",
+            torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
+        )
+        model.eval()
+
+    server = ICLInferenceServer(
+        model,
+        tokenizer,
+        args.address,
+        authkey=authkey,
+        max_batch_tokens=args.max_batch_tokens,
+        max_batch_series=args.max_batch_series,
+        max_wait=args.max_wait,
+        restrict_vocab=args.restrict_vocab,
+    )
+    print(f"serving {args.model} on {server.address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.close()
+
+
+if __name__ == "__main__":
+    main()
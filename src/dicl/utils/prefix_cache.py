@@ -0,0 +1,272 @@
+"""
+Prefix-sharing KV cache for the forward passes of the LLM.
+
+Contexts that start with the same tokens (e.g. DICL windows taken from the same
+episode with pinned rescaling bounds) share the KV cache and the value logits of
+their common prefix: only the remaining tokens are fed to the LLM.
+"""
+
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import copy
+
+import torch
+
+from dicl.utils.icl import (
+    PDF_list_from_probs,
+    _forward,
+    _to_input_ids,
+    _value_logits,
+    get_digit_token_table,
+    get_model_device,
+)
+
+
+@dataclass
+class _TrieNode:
+    children: dict = field(default_factory=dict)
+    # keys of the cached sequences going through this node
+    entry_keys: set = field(default_factory=set)
+
+
+@dataclass
+class _CacheEntry:
+    key: int
+    token_ids: tuple
+    kv_cache: object
+    logit_mat: torch.Tensor
+    n_bytes: int
+
+
+def _n_bytes(obj):
+    """Memory used by the tensors of a KV cache (or of any nesting of tensors)."""
+    if isinstance(obj, torch.Tensor):
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, (list, tuple)):
+        return sum(_n_bytes(item) for item in obj)
+    if hasattr(obj, "layers"):  # transformers Cache
+        return sum(_n_bytes([layer.keys, layer.values]) for layer in obj.layers)
+    if hasattr(obj, "key_cache"):  # legacy transformers Cache
+        return _n_bytes(obj.key_cache) + _n_bytes(obj.value_cache)
+    return 0
+
+
+def _n_PDF_positions(n_tokens):
+    """Number of PDF positions (2, 4, ...) among the first n_tokens positions."""
+    return max(n_tokens - 1, 0) // 2
+
+
+class PrefixKVCache:
+    """
+    A cache of the KV caches and value logits of the contexts processed by the LLM,
+    indexed by a trie of their token ids.
+
+    A new context is resumed from its longest prefix shared with a cached context:
+    the KV cache of the latter is cropped to the common prefix and only the remaining
+    tokens are processed. The cached contexts are evicted in least recently used
+    order to keep the memory (on the device of the model) under `max_bytes`.
+
+    The outputs only depend on the tokens (and the model), hence a single cache can
+    be shared by all the features.
+
+    Attributes:
+        max_bytes (int): Memory budget of the cached KV caches and logits.
+        n_bytes (int): Memory currently used.
+        n_reused_tokens (int): Number of tokens read from the cache so far.
+        n_computed_tokens (int): Number of tokens processed by the LLM so far.
+    """
+
+    def __init__(self, max_bytes: int = 2 * 1024**3):
+        """
+        Args:
+            max_bytes (int, optional): Memory budget of the cache, in bytes.
+                Default is 2 GiB.
+        """
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.n_reused_tokens = 0
+        self.n_computed_tokens = 0
+        self._root = _TrieNode()
+        self._entries = OrderedDict()
+        self._next_key = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """Removes all the cached contexts."""
+        self._root = _TrieNode()
+        self._entries.clear()
+        self.n_bytes = 0
+
+    def lookup(self, token_ids):
+        """
+        Finds the cached context sharing the longest prefix with `token_ids`.
+
+        Args:
+            token_ids (list of int): The token ids of the context.
+
+        Returns:
+            Tuple[int, Optional[_CacheEntry]]: The length of the common prefix and the
+                most recently used cached context starting with it (None if no token
+                is shared).
+        """
+        node = self._root
+        n_matched = 0
+        for token_id in token_ids:
+            child = node.children.get(token_id)
+            if child is None:
+                break
+            node = child
+            n_matched += 1
+        if n_matched == 0:
+            return 0, None
+        # most recently used entry among the ones going through the node
+        for key in reversed(self._entries):
+            if key in node.entry_keys:
+                self._entries.move_to_end(key)
+                return n_matched, self._entries[key]
+
+    def insert(self, token_ids, kv_cache, logit_mat):
+        """
+        Adds a context to the cache and evicts the least recently used contexts if
+        the memory budget is exceeded.
+
+        Args:
+            token_ids (list of int): The token ids of the context.
+            kv_cache: The KV cache of the context (owned by the cache afterwards).
+            logit_mat (torch.Tensor): The value logits at the PDF positions of the
+                context, of shape (n_PDFs, n_values).
+        """
+        n_bytes = _n_bytes(kv_cache) + _n_bytes(logit_mat)
+        if n_bytes > self.max_bytes:
+            return
+
+        key = self._next_key
+        self._next_key += 1
+        node = self._root
+        for token_id in token_ids:
+            node = node.children.setdefault(token_id, _TrieNode())
+            node.entry_keys.add(key)
+        self._entries[key] = _CacheEntry(
+            key, tuple(token_ids), kv_cache, logit_mat, n_bytes
+        )
+        self.n_bytes += n_bytes
+
+        while self.n_bytes > self.max_bytes:
+            self._evict(next(iter(self._entries)))
+
+    def _evict(self, key):
+        entry = self._entries.pop(key)
+        self.n_bytes -= entry.n_bytes
+        node = self._root
+        for token_id in entry.token_ids:
+            child = node.children[token_id]
+            child.entry_keys.discard(key)
+            if not child.entry_keys:
+                # no other cached context goes through the rest of the path
+                del node.children[token_id]
+                break
+            node = child
+
+    def calculate_multiPDF(
+        self,
+        full_series,
+        model,
+        tokenizer,
+        n_states=1000,
+        temperature=1.0,
+        use_cache=False,
+        restrict_vocab=False,
+        device=None,
+    ):
+        """
+        Same as `dicl.utils.icl.calculate_multiPDF_llama3`, resuming the forward pass
+        from the longest cached prefix of the series and caching the result.
+
+        Args:
+            full_series (str or array of int): The serialized series, as a string or
+                as token ids.
+            model: The LLM.
+            tokenizer: The tokenizer associated with the LLM.
+            n_states (int, optional): Number of possible states. Default is 1000.
+            temperature (float, optional): Softmax temperature. Default is 1.0.
+            use_cache (bool, optional): Whether to return the KV cache of the series.
+                Default is False.
+            restrict_vocab (bool, optional): If True, only the logits of the value
+                tokens are computed. Default is False.
+            device (str or torch.device, optional): Device of the inputs of the
+                model. Default is None (the device of the model).
+
+        Returns:
+            tuple: The PDFs of the series (PDFBatch), the corresponding probabilities
+                and the KV cache (if use_cache).
+        """
+        assert (
+            n_states <= 1000
+        ), f"if n_states ({n_states}) is larger than 1000, there will be more than 1"
+        "token per value!"
+
+        token_ids = _to_input_ids(full_series, tokenizer, add_special_tokens=True)
+        device = torch.device(device) if device else get_model_device(model)
+
+        n_matched, entry = self.lookup(token_ids)
+        with torch.inference_mode():
+            kv_cache = None
+            logit_mat = None
+            if entry is not None:
+                logit_mat = entry.logit_mat[: _n_PDF_positions(n_matched)]
+                if use_cache or n_matched < len(token_ids):
+                    # the cached KV cache is extended in place by the model
+                    kv_cache = copy.deepcopy(entry.kv_cache)
+                    n_cropped = kv_cache.get_seq_length() - n_matched
+                    if n_cropped > 0:
+                        kv_cache.crop(-n_cropped)
+            self.n_reused_tokens += n_matched
+
+            if n_matched < len(token_ids):
+                # the last token is always processed since its logits are needed
+                state_mat, out = _forward(
+                    model,
+                    torch.tensor([token_ids[n_matched:]]).to(device),
+                    restrict_vocab=restrict_vocab,
+                    use_cache=True,
+                    past_key_values=kv_cache,
+                )
+                kv_cache = out["past_key_values"]
+                positions = torch.arange(
+                    2 * _n_PDF_positions(n_matched) + 2,
+                    len(token_ids),
+                    2,
+                    device=state_mat.device,
+                )
+                good_tokens = get_digit_token_table(tokenizer).value_token_index(
+                    device=state_mat.device
+                )
+                new_logit_mat = _value_logits(
+                    model,
+                    state_mat[0, positions - n_matched],
+                    good_tokens,
+                    restrict_vocab=restrict_vocab,
+                )
+                if logit_mat is not None:
+                    new_logit_mat = torch.cat([logit_mat, new_logit_mat], dim=0)
+                logit_mat = new_logit_mat
+                self.n_computed_tokens += len(token_ids) - n_matched
+                del state_mat, out
+
+                if entry is not None and len(entry.token_ids) == n_matched:
+                    # the resumed context is a prefix of the new one
+                    self._evict(entry.key)
+                self.insert(
+                    token_ids,
+                    copy.deepcopy(kv_cache) if use_cache else kv_cache,
+                    logit_mat,
+                )
+
+            probs = torch.nn.functional.softmax(
+                logit_mat[None, :, :n_states] / temperature, dim=-1
+            ).cpu()
+
+        PDF_list = PDF_list_from_probs(probs[0].numpy())
+        return PDF_list, probs, kv_cache if use_cache else None
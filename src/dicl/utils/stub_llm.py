@@ -0,0 +1,272 @@
+"""
+Deterministic stub of the LLM and its tokenizer, to run and benchmark the DICL
+pipeline offline on CPU without downloading a model.
+
+The tokenizer mimics Llama-3 on serialized time series (one token per value of at
+most 3 digits, one token per separator) and the model mimics the call signature of
+a Hugging Face causal LM (`model(input_ids, ...)["logits"]`, `base_model`, KV cache
+with `crop`, `batch_repeat_interleave` and `batch_select_indices`). After a time
+separator, the logits of the values are a Gaussian centred on a damped linear
+extrapolation of the last two values, so that the predictions follow the context.
+The outputs only depend on the tokens, and a configurable latency emulates the
+cost of a real forward pass.
+"""
+
+import re
+import time
+from types import SimpleNamespace
+from typing import List, Optional
+
+import torch
+
+STUB_SPECIAL_TOKENS = [",", "-", " ", ".", "<|begin_of_text|>", "<|end_of_text|>"]
+
+
+class StubTokenizer:
+    """
+    Tokenizer of the values "0", ..., "999", of a few separators and of the BOS and
+    EOS tokens, splitting digits into groups of at most 3 like Llama-3.
+    """
+
+    name_or_path = "dicl-stub"
+    pad_token_id = None
+
+    def __init__(self):
+        self.vocab = {str(value): value for value in range(1000)}
+        for token in STUB_SPECIAL_TOKENS:
+            self.vocab[token] = len(self.vocab)
+        self.bos_token_id = self.vocab["<|begin_of_text|>"]
+        self.eos_token_id = self.vocab["<|end_of_text|>"]
+        self._inverse_vocab = {
+            token_id: token for token, token_id in self.vocab.items()
+        }
+
+    def __len__(self):
+        return len(self.vocab)
+
+    def convert_tokens_to_ids(self, tokens):
+        if isinstance(tokens, str):
+            return self.vocab[tokens]
+        return [self.vocab[token] for token in tokens]
+
+    def build_inputs_with_special_tokens(self, token_ids_0, token_ids_1=None):
+        token_ids = [self.bos_token_id] + list(token_ids_0)
+        if token_ids_1 is not None:
+            token_ids += list(token_ids_1)
+        return token_ids
+
+    def encode(self, text: str, add_special_tokens: bool = True) -> List[int]:
+        token_ids = [self.vocab[token] for token in re.findall(r"\d{1,3}|.", text)]
+        if add_special_tokens:
+            token_ids = self.build_inputs_with_special_tokens(token_ids)
+        return token_ids
+
+    def decode(self, token_ids, skip_special_tokens: bool = False) -> str:
+        tokens = [self._inverse_vocab[int(token_id)] for token_id in token_ids]
+        if skip_special_tokens:
+            tokens = [token for token in tokens if not token.startswith("<|")]
+        return "".join(tokens)
+
+    def __call__(self, texts, return_tensors=None, add_special_tokens=True, **kwargs):
+        single = isinstance(texts, str)
+        input_ids = [
+            self.encode(text, add_special_tokens=add_special_tokens)
+            for text in ([texts] if single else texts)
+        ]
+        if return_tensors == "pt":
+            return {"input_ids": torch.tensor(input_ids)}
+        return {"input_ids": input_ids[0] if single else input_ids}
+
+
+class _StubCacheLayer:
+    def __init__(self, keys: torch.Tensor):
+        self.keys = keys
+        self.values = keys[..., :0]
+
+
+class StubCache:
+    """
+    KV cache of the stub model: the token ids processed so far, of shape
+    (batch_size, seq_length), which is all the stub needs to resume.
+    """
+
+    def __init__(self, token_ids: Optional[torch.Tensor] = None):
+        if token_ids is None:
+            token_ids = torch.zeros((1, 0), dtype=torch.long)
+        self.token_ids = token_ids
+
+    @property
+    def layers(self):
+        return [_StubCacheLayer(self.token_ids)]
+
+    def get_seq_length(self, layer_idx: int = 0) -> int:
+        return self.token_ids.shape[1]
+
+    def crop(self, max_length: int):
+        """Keeps the first max_length tokens (all but the last -max_length if
+        negative)."""
+        if max_length < 0:
+            max_length = self.get_seq_length() + max_length
+        self.token_ids = self.token_ids[:, :max_length]
+
+    def batch_repeat_interleave(self, repeats: int):
+        self.token_ids = self.token_ids.repeat_interleave(repeats, dim=0)
+
+    def batch_select_indices(self, indices: torch.Tensor):
+        self.token_ids = self.token_ids[indices]
+
+
+class _StubBaseModel(torch.nn.Module):
+    def __init__(self, lm: "StubLM"):
+        super().__init__()
+        self._lm = [lm]  # not registered as a submodule (cycle)
+
+    def forward(self, input_ids, **kwargs):
+        hidden_states, cache = self._lm[0]._run(input_ids, **kwargs)
+        return {"last_hidden_state": hidden_states, "past_key_values": cache}
+
+
+class StubLM(torch.nn.Module):
+    """
+    Stub of a causal LM over the vocabulary of `StubTokenizer`.
+
+    The hidden states are the logits themselves and the LM head is the identity,
+    so that the restricted-vocabulary path (`base_model` + rows of the LM head)
+    gives the same logits as the full one.
+    """
+
+    def __init__(
+        self,
+        tokenizer: Optional[StubTokenizer] = None,
+        sigma: float = 25.0,
+        momentum: float = 0.5,
+        latency: float = 0.0,
+        latency_per_token: float = 0.0,
+    ):
+        """
+        Args:
+            tokenizer (Optional[StubTokenizer], optional): The tokenizer whose
+                vocabulary is modelled. Default is None (a new StubTokenizer).
+            sigma (float, optional): Width of the predicted distribution of the next
+                value, in token units (0 to 999). Default is 25.0.
+            momentum (float, optional): Weight of the last increment in the
+                extrapolation of the next value. Default is 0.5.
+            latency (float, optional): Time (in seconds) slept per forward pass.
+                Default is 0.0.
+            latency_per_token (float, optional): Time (in seconds) slept per
+                processed token. Default is 0.0.
+        """
+        super().__init__()
+        tokenizer = tokenizer if tokenizer is not None else StubTokenizer()
+        vocab_size = len(tokenizer)
+        self.config = SimpleNamespace(
+            _name_or_path=tokenizer.name_or_path, vocab_size=vocab_size
+        )
+        self.sigma = sigma
+        self.momentum = momentum
+        self.latency = latency
+        self.latency_per_token = latency_per_token
+        self.time_sep_token_id = tokenizer.vocab[","]
+        self.lm_head = torch.nn.Linear(vocab_size, vocab_size, bias=False)
+        with torch.no_grad():
+            self.lm_head.weight.copy_(torch.eye(vocab_size))
+        self.lm_head.requires_grad_(False)
+        self.base_model = _StubBaseModel(self)
+
+    @property
+    def dtype(self):
+        return self.lm_head.weight.dtype
+
+    @property
+    def device(self):
+        return self.lm_head.weight.device
+
+    def get_output_embeddings(self):
+        return self.lm_head
+
+    def forward(self, input_ids, **kwargs):
+        logits, cache = self._run(input_ids, **kwargs)
+        return {"logits": logits, "past_key_values": cache}
+
+    def _run(
+        self,
+        input_ids: torch.Tensor,
+        past_key_values: Optional[StubCache] = None,
+        use_cache: bool = False,
+        **kwargs,
+    ):
+        """Logits of the positions of input_ids and the updated cache (attention
+        masks are ignored: the stub is causal, and right padding never matters)."""
+        n_past = past_key_values.get_seq_length() if past_key_values else 0
+        input_ids = input_ids.to(self.device)
+        if n_past:
+            token_ids = torch.cat(
+                [past_key_values.token_ids.to(self.device), input_ids], dim=1
+            )
+        else:
+            token_ids = input_ids
+
+        latency = self.latency + self.latency_per_token * input_ids.numel()
+        if latency > 0:
+            time.sleep(latency)
+
+        logits = self._logits(token_ids)[:, n_past:]
+        cache = None
+        if use_cache:
+            cache = past_key_values if past_key_values is not None else StubCache()
+            cache.token_ids = token_ids
+        return logits, cache
+
+    def _logits(self, token_ids: torch.Tensor) -> torch.Tensor:
+        batch_size, seq_length = token_ids.shape
+        vocab_size = self.config.vocab_size
+        positions = torch.arange(seq_length, device=token_ids.device).expand(
+            batch_size, -1
+        )
+
+        # position and value of the last and second to last values up to each token
+        is_value = token_ids < 1000
+        last_pos = torch.where(is_value, positions, -1).cummax(dim=1).values
+        prev_pos = torch.where(
+            last_pos > 0,
+            last_pos.gather(1, (last_pos - 1).clamp(min=0)),
+            -1,
+        )
+        last_value = token_ids.gather(1, last_pos.clamp(min=0)).float()
+        prev_value = token_ids.gather(1, prev_pos.clamp(min=0)).float()
+        prediction = torch.where(
+            prev_pos >= 0,
+            last_value + self.momentum * (last_value - prev_value),
+            last_value,
+        ).clamp(0, 999)
+
+        values = torch.arange(1000, device=token_ids.device, dtype=torch.float32)
+        value_logits = -0.5 * ((values - prediction[..., None]) / self.sigma) ** 2
+        # no value read yet: uniform distribution
+        value_logits = torch.where(
+            (last_pos >= 0)[..., None], value_logits, torch.zeros_like(value_logits)
+        )
+
+        logits = torch.full(
+            (batch_size, seq_length, vocab_size), -1e4, device=token_ids.device
+        )
+        logits[..., :1000] = value_logits
+        # after a value, the next token is the time separator
+        logits[..., self.time_sep_token_id] = torch.where(is_value, 10.0, -1e4)
+        return logits.to(self.dtype)
+
+
+def load_stub_llm(**kwargs):
+    """
+    Stub model and tokenizer, to use in place of
+    `AutoModelForCausalLM.from_pretrained` and `AutoTokenizer.from_pretrained`.
+
+    Args:
+        **kwargs: Keyword arguments passed to StubLM (e.g. latency).
+
+    Returns:
+        Tuple[StubLM, StubTokenizer]: The model (in eval mode) and the tokenizer.
+    """
+    tokenizer = StubTokenizer()
+    model = StubLM(tokenizer, **kwargs).eval()
+    return model, tokenizer
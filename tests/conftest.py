@@ -0,0 +1,16 @@
+import numpy as np
+import pytest
+
+from dicl.utils.stub_llm import load_stub_llm
+
+
+@pytest.fixture
+def stub():
+    """Stub model and tokenizer (see `dicl.utils.stub_llm`)."""
+    return load_stub_llm()
+
+
+@pytest.fixture
+def time_series():
+    """Random walk of 3 features over 80 steps."""
+    return np.cumsum(np.random.RandomState(0).randn(80, 3), axis=0)
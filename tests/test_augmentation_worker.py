@@ -0,0 +1,27 @@
+import threading
+
+import pytest
+
+from dicl.rl.augmentation_worker import AugmentationWorker
+
+
+def test_max_pending_must_be_positive():
+    with pytest.raises(ValueError):
+        AugmentationWorker(job_fn=lambda job: job, max_pending=0)
+
+
+def test_back_pressure():
+    release = threading.Event()
+
+    def job_fn(job):
+        release.wait(5)
+        return job
+
+    worker = AugmentationWorker(job_fn=job_fn, max_pending=1)
+    accepted = [worker.submit(step, step) for step in range(5)]
+    # one job held by the worker (or waiting), the others dropped
+    assert sum(accepted) <= 2
+    assert worker.n_dropped == 5 - sum(accepted)
+
+    release.set()
+    worker.close(timeout=5)
@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+
+from dicl import dicl
+from dicl.utils.calibration import (
+    _is_diagonal,
+    compute_ks_metric,
+    extract_affine_map,
+)
+
+
+@pytest.fixture
+def fitted_vicl(stub, time_series):
+    model, tokenizer = stub
+    vicl = dicl.vICL(
+        n_features=3, model=model, tokenizer=tokenizer, rng=np.random.default_rng(0)
+    )
+    vicl.fit_disentangler(time_series)
+    vicl.predict_single_step(time_series)
+    return vicl
+
+
+def _ks_metric(vicl, **kwargs):
+    return compute_ks_metric(
+        groundtruth=vicl.X[1:],
+        icl_object=vicl.icl_object,
+        n_components=3,
+        n_features=3,
+        **kwargs,
+    )
+
+
+def test_burnin(fitted_vicl):
+    n_samples = len(fitted_vicl.icl_object[0].PDF_list)
+    kss, ks_quantiles = _ks_metric(
+        fitted_vicl,
+        inverse_transform=fitted_vicl.inverse_transform,
+        burnin=n_samples - 1,
+        analytic=True,
+    )
+    assert kss.shape == (3,)
+    assert ks_quantiles.shape == (3, 1)
+
+    with pytest.raises(ValueError):
+        _ks_metric(
+            fitted_vicl,
+            inverse_transform=fitted_vicl.inverse_transform,
+            burnin=n_samples,
+        )
+
+
+def test_non_affine_analytic_falls_back_to_sampling(fitted_vicl):
+    def inverse_transform(X):
+        # neither affine nor one monotonic map per component
+        X = fitted_vicl.inverse_transform(X)
+        return np.tanh(X + X[:, ::-1])
+
+    with pytest.warns(UserWarning, match="Monte-Carlo"):
+        kss, _ = _ks_metric(
+            fitted_vicl,
+            inverse_transform=inverse_transform,
+            analytic=True,
+            rng=np.random.default_rng(1),
+        )
+    expected_kss, _ = _ks_metric(
+        fitted_vicl,
+        inverse_transform=inverse_transform,
+        rng=np.random.default_rng(1),
+    )
+    np.testing.assert_array_equal(kss, expected_kss)
+
+
+def test_analytic_quantiles_match_sampling_for_pca(stub, time_series):
+    model, tokenizer = stub
+    pca = dicl.DICL_PCA(
+        n_features=3,
+        n_components=3,
+        model=model,
+        tokenizer=tokenizer,
+        rng=np.random.default_rng(0),
+    )
+    pca.fit_disentangler(time_series)
+    pca.predict_single_step(time_series)
+    # the features mix the components, so their CDFs are convolutions
+    affine_map = extract_affine_map(pca.inverse_transform, 3)
+    assert not _is_diagonal(affine_map[0])
+
+    kss, ks_quantiles = _ks_metric(
+        pca, inverse_transform=pca.inverse_transform, analytic=True
+    )
+    sampled_kss, sampled_ks_quantiles = _ks_metric(
+        pca,
+        inverse_transform=pca.inverse_transform,
+        n_traces=20_000,
+        rng=np.random.default_rng(1),
+    )
+
+    np.testing.assert_allclose(ks_quantiles, sampled_ks_quantiles, atol=0.02)
+    np.testing.assert_allclose(kss, sampled_kss, atol=0.02)
+    np.testing.assert_array_equal(pca.compute_metrics(exact=True)["perdim_ks"], kss)
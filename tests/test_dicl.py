@@ -0,0 +1,80 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from dicl import dicl
+
+
+@pytest.mark.parametrize("n_components", [4, 2])
+def test_partial_fit_disentangler_matches_full_fit(stub, n_components):
+    model, tokenizer = stub
+    rs = np.random.RandomState(0)
+    mixing = rs.randn(4, 4)
+    X_old = rs.randn(300, 4) @ mixing
+    # the new data widens the min-max range
+    X_new = 3.0 * rs.randn(200, 4) @ mixing + 1.0
+
+    incremental = dicl.DICL_PCA(
+        n_features=4,
+        n_components=n_components,
+        model=model,
+        tokenizer=tokenizer,
+        incremental=True,
+    )
+    incremental.fit_disentangler(X_old)
+    incremental.partial_fit_disentangler(X_new)
+
+    full = dicl.DICL_PCA(
+        n_features=4,
+        n_components=4,
+        model=model,
+        tokenizer=tokenizer,
+        incremental=True,
+    )
+    full.fit_disentangler(np.vstack([X_old, X_new]))
+
+    pca, full_pca = incremental.disentangler[-1], full.disentangler[-1]
+    np.testing.assert_allclose(pca.mean_, full_pca.mean_, atol=1e-10)
+    np.testing.assert_allclose(pca.var_, full_pca.var_, atol=1e-10)
+    if n_components == 4:
+        # the full-rank incremental PCA is exact
+        np.testing.assert_allclose(
+            pca.explained_variance_, full_pca.explained_variance_, rtol=1e-8
+        )
+        np.testing.assert_allclose(
+            np.abs(pca.components_ @ full_pca.components_.T), np.eye(4), atol=1e-8
+        )
+    else:
+        # the leading axes are close to the exact ones
+        overlap = np.abs(pca.components_ @ full_pca.components_[:2].T)
+        assert np.all(np.diag(overlap) > 0.95)
+
+
+def test_sample_multi_step_leaves_predictions_untouched(stub, time_series):
+    model, tokenizer = stub
+    model_dicl = dicl.vICL(
+        n_features=3,
+        model=model,
+        tokenizer=tokenizer,
+        use_token_ids=True,
+        rng=np.random.default_rng(0),
+    )
+    model_dicl.fit_disentangler(time_series)
+    mean, _, _, _ = model_dicl.predict_single_step(time_series)
+    expected_metrics = model_dicl.compute_metrics(exact=True)
+
+    with warnings.catch_warnings():
+        # the particles are rolled out as one batch, without fallback
+        warnings.simplefilter("error")
+        trajectories = model_dicl.sample_multi_step(
+            time_series[:40], prediction_horizon=5, n_particles=4, verbose=0
+        )
+
+    assert trajectories.shape == (4, 5, 3)
+    assert np.isfinite(trajectories).all()
+    assert not np.allclose(trajectories[0], trajectories[1:])
+    assert model_dicl.mean is mean
+    metrics = model_dicl.compute_metrics(exact=True)
+    for key, value in expected_metrics.items():
+        np.testing.assert_array_equal(metrics[key], value)
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from dicl.icl.iclearner import MultiVariateICLTrainer
+from dicl.utils.disk_cache import ICLDiskCache
+from dicl.utils.icl import configure_cpu_inference
+
+
+@pytest.mark.filterwarnings("ignore::DeprecationWarning")  # torch.ao.quantization
+def test_key_separates_numerics(stub):
+    model, tokenizer = stub
+    series = "512,498,"
+
+    key = ICLDiskCache.key(model, tokenizer, series, 1.0, 1000)
+    assert key == ICLDiskCache.key(model, tokenizer, series, 1.0, 1000)
+    assert key != ICLDiskCache.key(
+        model, tokenizer, series, 1.0, 1000, restrict_vocab=True
+    )
+
+    configure_cpu_inference(model, quantize=True)
+    assert key != ICLDiskCache.key(model, tokenizer, series, 1.0, 1000)
+
+
+@pytest.mark.parametrize("batch_features", [False, True])
+def test_hits_match_computed_probabilities(stub, time_series, tmp_path, batch_features):
+    model, tokenizer = stub
+    disk_cache = ICLDiskCache(str(tmp_path))
+
+    outputs = []
+    for model_disk_cache in [None, disk_cache, disk_cache]:
+        trainer = MultiVariateICLTrainer(
+            model=model,
+            tokenizer=tokenizer,
+            n_features=3,
+            batch_features=batch_features,
+            disk_cache=model_disk_cache,
+        )
+        trainer.update_context(
+            time_series=time_series,
+            mean_series=time_series,
+            sigma_series=np.zeros_like(time_series),
+        )
+        trainer.icl()
+        outputs.append([dim.PDF_list.bin_height_mat for dim in trainer.icl_object])
+
+    # the first run with the cache fills it, the second one reads it
+    assert disk_cache.n_misses == 3
+    assert disk_cache.n_hits == 3
+    for computed, filled, read in zip(*outputs):
+        np.testing.assert_array_equal(filled, computed)
+        np.testing.assert_allclose(read, computed, rtol=1e-6)
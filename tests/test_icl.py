@@ -0,0 +1,209 @@
+from functools import partial
+
+import numpy as np
+import pytest
+
+from dicl.icl.iclearner import MultiVariateICLTrainer
+from dicl.utils.icl import (
+    MultiResolutionPDF,
+    PDFBatch,
+    SerializerSettings,
+    calculate_multiPDF_llama3,
+    calculate_multiPDF_llama3_batch,
+    get_digit_token_table,
+    inverse_cdf_sample,
+    serialize_arr,
+    serialize_arr_to_ids,
+    vec_num2repr,
+)
+
+
+def _rescaled(time_series, dim):
+    series = time_series[:, dim]
+    return (series - series.min()) / (series.max() - series.min()) * 7.0 + 1.5
+
+
+@pytest.fixture
+def serialized(stub, time_series):
+    _, tokenizer = stub
+    settings = MultiVariateICLTrainer._serializer_settings()
+    token_table = get_digit_token_table(tokenizer, time_sep=settings.time_sep)
+    # series of different lengths, to exercise the padding
+    arrays = [_rescaled(time_series[: 40 + 15 * dim], dim) for dim in range(3)]
+    return (
+        [serialize_arr(array, settings) for array in arrays],
+        [serialize_arr_to_ids(array, settings, token_table) for array in arrays],
+    )
+
+
+def test_token_ids_match_strings(stub, serialized):
+    model, tokenizer = stub
+    for string, token_ids in zip(*serialized):
+        np.testing.assert_array_equal(
+            token_ids, tokenizer(string, add_special_tokens=True)["input_ids"]
+        )
+        _, probs, _ = calculate_multiPDF_llama3(string, model, tokenizer)
+        _, probs_ids, _ = calculate_multiPDF_llama3(token_ids, model, tokenizer)
+        np.testing.assert_array_equal(probs.numpy(), probs_ids.numpy())
+
+
+@pytest.mark.parametrize("max_batch_tokens", [None, 100])
+def test_batch_matches_single_series(stub, serialized, max_batch_tokens):
+    model, tokenizer = stub
+    strings, _ = serialized
+    outputs = calculate_multiPDF_llama3_batch(
+        strings, model, tokenizer, max_batch_tokens=max_batch_tokens
+    )
+    assert len(outputs) == len(strings)
+    for string, (PDF_list, probs) in zip(strings, outputs):
+        _, expected_probs, _ = calculate_multiPDF_llama3(string, model, tokenizer)
+        np.testing.assert_allclose(
+            probs.numpy(), expected_probs.numpy(), rtol=1e-5, atol=1e-7
+        )
+        assert len(PDF_list) == expected_probs.shape[1]
+
+
+def test_restrict_vocab(stub, serialized):
+    model, tokenizer = stub
+    for string in serialized[0]:
+        _, probs, _ = calculate_multiPDF_llama3(string, model, tokenizer)
+        _, restricted_probs, _ = calculate_multiPDF_llama3(
+            string, model, tokenizer, restrict_vocab=True
+        )
+        np.testing.assert_allclose(
+            restricted_probs.numpy(), probs.numpy(), rtol=1e-5, atol=1e-7
+        )
+
+
+def test_pdf_batch_item_is_a_copy():
+    rng = np.random.RandomState(0)
+    batch = PDFBatch(rng.rand(3, 10))
+    batch.normalize()
+    expected = batch.bin_height_mat.copy()
+
+    coarse = MultiResolutionPDF()
+    coarse.add_bin(np.array([0.045, 0.145]), np.array([0.1, 0.1]), np.ones(2))
+    coarse.normalize()
+    # refine scales the heights of the finer PDF in place
+    coarse.refine(batch[1])
+    PDF = batch[0]
+    PDF.bin_height_arr *= 2
+    PDF.bin_center_arr += 1
+
+    np.testing.assert_array_equal(batch.bin_height_mat, expected)
+    np.testing.assert_array_equal(batch[0].bin_center_arr, np.arange(10) / 100)
+
+
+def _serialize_arr_per_step(arr, settings):
+    """Former serialize_arr, which formats the time steps one at a time."""
+    if not settings.signed:
+        plus_sign = minus_sign = ""
+    else:
+        plus_sign = settings.plus_sign
+        minus_sign = settings.minus_sign
+
+    vnum2repr = partial(
+        vec_num2repr, base=settings.base, prec=settings.prec, max_val=settings.max_val
+    )
+    sign_arr, digits_arr = vnum2repr(np.where(np.isnan(arr), np.zeros_like(arr), arr))
+    ismissing = np.isnan(arr)
+
+    def tokenize(arr):
+        return "".join([settings.bit_sep + str(b) for b in arr])
+
+    bit_strs = []
+    for sign, digits, missing in zip(sign_arr, digits_arr, ismissing):
+        if not settings.fixed_length:
+            # remove leading zeros
+            nonzero_indices = np.where(digits != 0)[0]
+            if len(nonzero_indices) == 0:
+                digits = np.array([0])
+            else:
+                digits = digits[nonzero_indices[0] :]
+            # add a decimal point
+            prec = settings.prec
+            if len(settings.decimal_point):
+                digits = np.concatenate(
+                    [digits[:-prec], np.array([settings.decimal_point]), digits[-prec:]]
+                )
+        digits = tokenize(digits)
+        sign_sep = plus_sign if sign == 1 else minus_sign
+        if missing:
+            bit_strs.append(settings.missing_str)
+        else:
+            bit_strs.append(sign_sep + digits)
+    return settings.time_sep.join(bit_strs) + settings.time_sep
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_serialize_arr_matches_per_step_serialization(seed):
+    rng = np.random.default_rng(seed)
+    settings = SerializerSettings(
+        base=int(rng.choice([10, 2])),
+        prec=int(rng.integers(0, 4)),
+        signed=bool(rng.integers(2)),
+        fixed_length=bool(rng.integers(2)),
+        max_val=1e3,
+        time_sep=str(rng.choice([" ,", ",", ";"])),
+        bit_sep=str(rng.choice(["", " "])),
+        decimal_point=str(rng.choice(["", "."])),
+    )
+    arr = rng.uniform(-1, 1, 50) * 10.0 ** rng.integers(-3, 3, 50)
+    # zeros, values rounding to zero, the largest value and missing values
+    arr[:4] = [0.0, 1e-6, -1e-6, settings.max_val]
+    arr[rng.random(50) < 0.1] = np.nan
+    if not settings.signed:
+        arr = np.abs(arr)
+
+    assert serialize_arr(arr, settings) == _serialize_arr_per_step(arr, settings)
+    assert serialize_arr(arr[:0], settings) == settings.time_sep
+
+
+def _prob_mat():
+    prob_mat = np.random.default_rng(0).random((6, 8))
+    # zero-probability edge bins, on either side and on both
+    prob_mat[0, :3] = 0.0
+    prob_mat[1, -3:] = 0.0
+    prob_mat[2, [0, -1]] = 0.0
+    # all the mass in the first, last or a single inner bin
+    prob_mat[3] = np.eye(8)[0]
+    prob_mat[4] = np.eye(8)[-1]
+    prob_mat[5] = 3.0 * np.eye(8)[5]
+    return prob_mat
+
+
+@pytest.mark.parametrize("n_samples", [None, 1000])
+def test_inverse_cdf_sample_matches_per_row_search(n_samples):
+    prob_mat = _prob_mat()
+    bin_idx = inverse_cdf_sample(
+        prob_mat, n_samples=n_samples, rng=np.random.default_rng(1)
+    )
+
+    # same uniform draws, one searchsorted per row
+    uniform_mat = np.random.default_rng(1).random((6, n_samples or 1))
+    expected = np.stack(
+        [
+            np.searchsorted(np.cumsum(probs) / probs.sum(), uniforms, side="right")
+            for probs, uniforms in zip(prob_mat, uniform_mat)
+        ]
+    )
+    if n_samples is None:
+        expected = expected[:, 0]
+    np.testing.assert_array_equal(bin_idx, expected)
+
+
+def test_inverse_cdf_sample_distribution():
+    prob_mat = _prob_mat()
+    n_samples = 100_000
+    bin_idx = inverse_cdf_sample(
+        prob_mat, n_samples=n_samples, rng=np.random.default_rng(2)
+    )
+
+    assert bin_idx.shape == (6, n_samples)
+    frequencies = (
+        np.stack([np.bincount(row_idx, minlength=8) for row_idx in bin_idx]) / n_samples
+    )
+    expected = prob_mat / prob_mat.sum(axis=1, keepdims=True)
+    np.testing.assert_allclose(frequencies, expected, atol=0.006)
+    # the zero-probability bins are never drawn
+    assert np.all(frequencies[expected == 0] == 0)
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from dicl.icl.iclearner import MultiVariateICLTrainer
+from dicl.utils.prefix_cache import PrefixKVCache
+
+
+def _trainer(stub, **kwargs):
+    model, tokenizer = stub
+    return MultiVariateICLTrainer(
+        model=model, tokenizer=tokenizer, n_features=3, **kwargs
+    )
+
+
+def _update_context(trainer, time_series):
+    trainer.update_context(
+        time_series=time_series,
+        mean_series=time_series,
+        sigma_series=np.zeros_like(time_series),
+    )
+
+
+@pytest.mark.parametrize("use_token_ids", [False, True])
+def test_cached_rollout_matches_uncached(stub, time_series, use_token_ids):
+    statistics = []
+    for use_cache in [True, False]:
+        trainer = _trainer(stub, use_token_ids=use_token_ids)
+        _update_context(trainer, time_series[:50])
+        trainer.icl(use_cache=use_cache)
+        icl_object = trainer.predict_long_horizon_llm(
+            prediction_horizon=5, use_cache=use_cache
+        )
+        statistics.append(
+            [(dim.mean_arr, dim.mode_arr, dim.sigma_arr) for dim in icl_object]
+        )
+
+    for cached, uncached in zip(*statistics):
+        assert len(cached[0]) == 50 + 5
+        for cached_arr, uncached_arr in zip(cached, uncached):
+            np.testing.assert_allclose(cached_arr, uncached_arr, rtol=1e-4, atol=1e-6)
+
+
+def test_prefix_cache_reuse(stub, time_series):
+    prefix_cache = PrefixKVCache()
+    trainer = _trainer(stub, prefix_cache=prefix_cache)
+    reference = _trainer(stub)
+    for model_trainer in [trainer, reference]:
+        model_trainer.pin_rescaling_bounds(time_series.min(0), time_series.max(0))
+
+    for context_length in [40, 60]:
+        for model_trainer in [trainer, reference]:
+            _update_context(model_trainer, time_series[:context_length])
+            model_trainer.icl()
+        for dim, reference_object in zip(trainer.icl_object, reference.icl_object):
+            np.testing.assert_allclose(
+                dim.PDF_list.bin_height_mat,
+                reference_object.PDF_list.bin_height_mat,
+                rtol=1e-5,
+                atol=1e-7,
+            )
+
+    # the second contexts are resumed from the first ones (2 tokens per step)
+    assert prefix_cache.n_reused_tokens >= 3 * 2 * 40
+    assert prefix_cache.n_computed_tokens < 3 * 2 * (40 + 60)
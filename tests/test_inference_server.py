@@ -0,0 +1,100 @@
+import os
+import stat
+import threading
+from multiprocessing import AuthenticationError
+
+import numpy as np
+import pytest
+
+from dicl import dicl
+from dicl.utils.inference_server import (
+    AUTHKEY_ENV_VAR,
+    ICLInferenceClient,
+    ICLInferenceServer,
+)
+
+AUTHKEY = b"test-key"
+
+
+@pytest.fixture
+def server(stub, tmp_path):
+    model, tokenizer = stub
+    server = ICLInferenceServer(
+        model, tokenizer, str(tmp_path / "dicl_llm.sock"), authkey=AUTHKEY
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    # the listener is created by serve_forever
+    for _ in range(100):
+        if os.path.exists(server.address):
+            break
+        thread.join(0.05)
+    yield server
+    server.close()
+    thread.join(5)
+
+
+@pytest.fixture
+def client(server):
+    client = ICLInferenceClient(server.address, authkey=AUTHKEY)
+    yield client
+    client.close()
+
+
+@pytest.fixture
+def X():
+    return np.cumsum(np.random.RandomState(0).randn(60, 3), axis=0)
+
+
+def test_predict_multi_step_with_client(stub, client, X):
+    model, tokenizer = stub
+    local = dicl.vICL(n_features=3, model=model, tokenizer=tokenizer)
+    remote = dicl.vICL(
+        n_features=3, model=None, tokenizer=tokenizer, inference_client=client
+    )
+    for model_dicl in [local, remote]:
+        model_dicl.fit_disentangler(X)
+
+    expected = local.predict_multi_step(X, prediction_horizon=5, verbose=0)
+    outputs = remote.predict_multi_step(X, prediction_horizon=5, verbose=0)
+
+    for output, expected_output in zip(outputs, expected):
+        assert output.shape == (X.shape[0] - 1, 3)
+        np.testing.assert_allclose(output, expected_output, rtol=1e-5, atol=1e-5)
+
+
+def test_sample_multi_step_with_client(stub, client, X):
+    _, tokenizer = stub
+    remote = dicl.vICL(
+        n_features=3,
+        model=None,
+        tokenizer=tokenizer,
+        inference_client=client,
+        rng=np.random.default_rng(0),
+    )
+    remote.fit_disentangler(X)
+
+    trajectories = remote.sample_multi_step(
+        X, prediction_horizon=4, n_particles=3, verbose=0
+    )
+
+    assert trajectories.shape == (3, 4, 3)
+    assert np.isfinite(trajectories).all()
+
+
+def test_authentication(server, monkeypatch):
+    assert stat.S_IMODE(os.stat(server.address).st_mode) == 0o600
+
+    with pytest.raises(AuthenticationError):
+        ICLInferenceClient(server.address, authkey=b"wrong-key")
+
+    monkeypatch.delenv(AUTHKEY_ENV_VAR, raising=False)
+    with pytest.raises(ValueError):
+        ICLInferenceClient(server.address)
+
+    # the server still serves the authenticated clients
+    monkeypatch.setenv(AUTHKEY_ENV_VAR, AUTHKEY.decode())
+    client = ICLInferenceClient(server.address)
+    (probs,) = client.calculate_multiPDF_batch(["512,498,"])
+    client.close()
+    assert probs.shape == (2, 1000)
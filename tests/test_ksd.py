@@ -0,0 +1,143 @@
+import pytest
+import torch
+
+from dicl.rl.ksdp import ksd
+
+
+def _samples(n=60, d=4):
+    torch.manual_seed(0)
+    samples = torch.randn(n, d, dtype=torch.float64) + 3.0
+    gradients = -(samples - 3.0) + 0.3 * torch.randn_like(samples)
+    return samples, gradients
+
+
+def _K_matrix_from_rows(samples, gradients, kernel_type, h):
+    """Stein kernel matrix built row by row with get_K_row."""
+    return torch.stack(
+        [
+            ksd.get_K_row(samples, gradients, kernel_type, h, index=i)
+            for i in range(samples.shape[0])
+        ]
+    )
+
+
+@pytest.mark.parametrize("block_size", [None, 7, 1000])
+@pytest.mark.parametrize(
+    "kernel_type,h_method", [("rbf", "dim"), ("rbf", "med"), ("imq", "dim")]
+)
+def test_K_matrix_matches_rows(kernel_type, h_method, block_size):
+    samples, gradients = _samples()
+    h = ksd._get_h(samples, h_method) if kernel_type == "rbf" else None
+
+    K_matrix = ksd.get_K_matrix(
+        samples, gradients, kernel_type, h_method, block_size=block_size
+    )
+
+    torch.testing.assert_close(
+        K_matrix, _K_matrix_from_rows(samples, gradients, kernel_type, h)
+    )
+
+
+@pytest.mark.parametrize("block_size", [None, 7])
+@pytest.mark.parametrize("kernel_type", ["rbf", "imq"])
+def test_KSDs_match_full_matrix(kernel_type, block_size, capsys):
+    samples, gradients = _samples()
+    h = ksd._get_h(samples, "dim") if kernel_type == "rbf" else None
+    K_matrix = _K_matrix_from_rows(samples, gradients, kernel_type, h)
+    n = samples.shape[0]
+
+    KSD = ksd.get_KSD(samples, gradients, kernel_type, "dim", block_size=block_size)
+    torch.testing.assert_close(KSD, K_matrix.sum().sqrt() / n)
+    assert capsys.readouterr().out == ""
+
+    # cumulative formula of the KSDs of the first i samples
+    K_sums = 2.0 * torch.tril(K_matrix).sum(dim=1) - K_matrix.diag()
+    expected = torch.cumsum(K_sums, dim=0).sqrt() / torch.arange(1, n + 1)
+    KSDs = ksd.get_sequential_KSDs(
+        samples, gradients, kernel_type, "dim", block_size=block_size
+    )
+    torch.testing.assert_close(torch.stack(KSDs), expected)
+
+
+def test_med_h_uses_generator():
+    samples, _ = _samples(n=300)
+    rng_state = torch.get_rng_state()
+
+    h = ksd.med_h(samples, max_samples=50, generator=torch.Generator().manual_seed(0))
+
+    assert h == ksd.med_h(
+        samples, max_samples=50, generator=torch.Generator().manual_seed(0)
+    )
+    assert torch.equal(torch.get_rng_state(), rng_state)
+    # the median of the subset is close to the one of all the points
+    assert h == pytest.approx(ksd.med_h(samples), rel=0.2)
+
+
+@pytest.mark.parametrize("sliding", [False, True])
+def test_median_sketch_stationary_stream(sliding):
+    generator = torch.Generator().manual_seed(0)
+    sketch = ksd.MedianSketch(size=2048, sliding=sliding, generator=generator)
+    assert sketch.median() is None
+
+    stream = torch.rand(50_000, generator=torch.Generator().manual_seed(1))
+    for batch in stream.split(1000):
+        sketch.update(batch)
+
+    assert sketch.num_seen == 50_000
+    assert sketch.median() == pytest.approx(0.5, abs=0.03)
+
+
+def test_median_sketch_sliding_forgets():
+    values = torch.rand(40_000, generator=torch.Generator().manual_seed(1))
+    # the stream jumps from [0, 1] to [10, 11] halfway
+    values[20_000:] += 10.0
+    sketches = {
+        sliding: ksd.MedianSketch(
+            size=512, sliding=sliding, generator=torch.Generator().manual_seed(0)
+        )
+        for sliding in [False, True]
+    }
+    for batch in values.split(100):
+        for sketch in sketches.values():
+            sketch.update(batch)
+
+    # the uniform reservoir keeps about half of the old values
+    assert sketches[False].median() < 10.0
+    assert sketches[True].median() == pytest.approx(10.5, abs=0.1)
+
+
+@pytest.mark.parametrize(
+    "kernel_type,estimator,kwargs",
+    [
+        (kernel_type, estimator, kwargs)
+        for kernel_type in ["rbf", "imq"]
+        for estimator, kwargs in [
+            ("incomplete", {"num_pairs": 10**5}),
+            ("block", {}),
+            ("rff", {}),
+            ("nystrom", {"num_landmarks": 512}),
+        ]
+        # random Fourier features are only defined for rbf
+        if (kernel_type, estimator) != ("imq", "rff")
+    ],
+)
+def test_estimators_match_exact_KSD(kernel_type, estimator, kwargs):
+    torch.manual_seed(0)
+    # shifted and scaled gaussian samples scored against a standard gaussian
+    samples = 1.2 * torch.randn(2000, 5, dtype=torch.float64) + 0.3
+    gradients = -samples
+
+    exact = ksd.estimate_KSD(samples, gradients, kernel_type, "dim")
+    estimate = ksd.estimate_KSD(
+        samples, gradients, kernel_type, "dim", estimator=estimator, **kwargs
+    )
+
+    assert float(estimate) == pytest.approx(float(exact), rel=0.05)
+
+
+def test_rff_rejects_imq():
+    samples, gradients = _samples()
+    with pytest.raises(NotImplementedError, match="only support the rbf kernel"):
+        ksd.estimate_KSD(samples, gradients, "imq", "dim", estimator="rff")
+    with pytest.raises(NotImplementedError, match="estimator"):
+        ksd.estimate_KSD(samples, gradients, "rbf", "dim", estimator="unknown")
@@ -0,0 +1,123 @@
+import pytest
+import torch
+
+from dicl.rl.ksdp import PruningContainer, ksd
+
+
+def _check_statistics(container, samples):
+    """Compares the incremental statistics with a full recompute."""
+    K_matrix = ksd.get_K_matrix(
+        container.points,
+        container.gradients,
+        container.kernel_type,
+        container.h_method,
+        h=container._bandwidth(),
+    )
+    if container.full_mat:
+        torch.testing.assert_close(container.K_matrix, K_matrix)
+    torch.testing.assert_close(container.row_sums, K_matrix.sum(1))
+    torch.testing.assert_close(
+        container.ksd2_contrib, 2 * K_matrix.sum(1) - K_matrix.diag()
+    )
+    torch.testing.assert_close(
+        container.get_ksd_squared(), K_matrix.sum() / container.num_points**2
+    )
+    for point, global_id in zip(container.points, container.ids):
+        assert torch.equal(point, samples[global_id])
+
+
+@pytest.mark.parametrize("full_mat", [True, False])
+@pytest.mark.parametrize(
+    "kernel_type,h_method", [("rbf", "dim"), ("imq", "dim"), ("rbf", "med")]
+)
+def test_statistics_match_full_recompute(full_mat, kernel_type, h_method):
+    torch.manual_seed(0)
+    samples = torch.randn(150, 4, dtype=torch.float64)
+    gradients = -samples + 0.3 * torch.randn_like(samples)
+    container = PruningContainer(
+        kernel_type=kernel_type, h_method=h_method, full_mat=full_mat, capacity=4
+    )
+
+    all_pruned_ids = []
+    for i in range(samples.shape[0]):
+        container.add_point(samples[i], gradients[i], global_id=i)
+        if i % 10 == 9:
+            pruned_samples, pruned_ids = container.prune_to_cutoff(
+                cutoff=0.0, min_samples=20
+            )
+            for sample, global_id in zip(pruned_samples, pruned_ids):
+                assert torch.equal(sample.squeeze(0), samples[global_id])
+            all_pruned_ids += pruned_ids
+        _check_statistics(container, samples)
+
+    assert sorted(all_pruned_ids + container.ids) == list(range(samples.shape[0]))
+
+
+def test_best_index_matches_row_sums():
+    torch.manual_seed(0)
+    samples = torch.randn(30, 3, dtype=torch.float64)
+    container = PruningContainer(kernel_type="rbf", h_method="dim")
+    for i in range(20):
+        container.add_point(samples[i], -samples[i], global_id=i)
+
+    candidates = samples[20:]
+    scores = []
+    for candidate in candidates:
+        points = torch.cat([container.points, candidate[None]])
+        scores.append(ksd.get_K_matrix(points, -points, "rbf", "dim")[-1].sum())
+
+    assert container.best_index(candidates, -candidates) == torch.stack(scores).argmin()
+
+
+def _med_container(seed, **kwargs):
+    return PruningContainer(
+        kernel_type="rbf",
+        h_method="med",
+        generator=torch.Generator().manual_seed(seed),
+        **kwargs,
+    )
+
+
+@pytest.mark.parametrize("full_mat", [True, False])
+def test_h_refresh_policy(full_mat):
+    torch.manual_seed(0)
+    samples = torch.randn(400, 3, dtype=torch.float64)
+    # the scale of the samples jumps after 200 points
+    samples[200:] *= 4.0
+    container = _med_container(0, full_mat=full_mat, h_tol=0.1)
+
+    num_refreshes = []
+    for i in range(samples.shape[0]):
+        container.add_point(samples[i], -samples[i], global_id=i)
+        num_refreshes.append(container.num_h_refreshes)
+        if i == 199:
+            stationary_h = container.h
+        if i % 50 == 49:
+            # the statistics are rebuilt with the refreshed h
+            _check_statistics(container, samples)
+
+    # h is refreshed while the sketch fills, then mostly kept
+    assert num_refreshes[199] - num_refreshes[99] <= 5
+    assert stationary_h == pytest.approx(ksd.med_h(samples[:200]), rel=0.25)
+    # the jump is tracked
+    assert num_refreshes[399] - num_refreshes[199] > 10
+    assert container.h > 2 * stationary_h
+
+
+def test_generator_makes_pruning_reproducible():
+    torch.manual_seed(0)
+    samples = torch.randn(200, 3, dtype=torch.float64)
+    rng_state = torch.get_rng_state()
+
+    results = []
+    for _ in range(2):
+        container = _med_container(0, full_mat=False, sketch_size=256)
+        pruned_ids = []
+        for i in range(samples.shape[0]):
+            container.add_point(samples[i], -samples[i], global_id=i)
+            if i % 20 == 19:
+                pruned_ids += container.prune_to_cutoff(cutoff=0.0, min_samples=20)[1]
+        results.append((container.h, container.num_h_refreshes, pruned_ids))
+
+    assert results[0] == results[1]
+    assert torch.equal(torch.get_rng_state(), rng_state)